@@ -11,7 +11,7 @@ setup(name="django-reversion",
       zip_safe=False,
       packages=["reversion", "reversion.management", "reversion.templatetags", "reversion.management.commands", "reversion.migrations"],
       package_dir={"": "src"},
-      package_data = {"reversion": ["locale/*/LC_MESSAGES/django.*", "templates/reversion/*.html"]},
+      package_data = {"reversion": ["locale/*/LC_MESSAGES/django.*", "templates/reversion/*.html", "sql/*.sql"]},
       classifiers=["Development Status :: 5 - Production/Stable",
                    "Environment :: Web Environment",
                    "Intended Audience :: Developers",
@@ -15,3 +15,8 @@ register = revision.register
 is_registered = revision.is_registered
 unregister = revision.unregister
 
+# Bulk operations, added to the current revision.
+bulk_save = revision.bulk_save
+bulk_update = revision.bulk_update
+bulk_delete = revision.bulk_delete
+
@@ -21,6 +21,7 @@ from django.utils.translation import ugettext as _
 from django.utils.encoding import force_unicode
 
 import reversion
+from reversion.managers import get_key_values
 from reversion.models import Version
 from reversion.revisions import DEFAULT_SERIALIZATION_FORMAT
 
@@ -150,7 +151,7 @@ class VersionAdmin(admin.ModelAdmin):
             fk_name = FormSet.ct_fk_field.name
         # Look up the revision data.
         revision_versions = version.revision.version_set.all()
-        related_versions = dict([(related_version.object_id, related_version)
+        related_versions = dict([(related_version.object_pk, related_version)
                                  for related_version in revision_versions
                                  if ContentType.objects.get_for_id(related_version.content_type_id).model_class() == FormSet.model
                                  and unicode(related_version.field_dict[fk_name]) == unicode(object_id)])
@@ -210,7 +211,7 @@ class VersionAdmin(admin.ModelAdmin):
                     for related_obj, related_form in zip(related_objects, formset.saved_forms):
                         for field in related_obj._meta.fields:
                             if isinstance(field, models.FileField) and related_form._raw_value(field.name) is None:
-                                related_info = formset.related_versions.get(unicode(related_obj.pk))
+                                related_info = formset.related_versions.get(related_obj.pk)
                                 if related_info:
                                     setattr(related_obj, field.name, related_info.field_dict[field.name])
                         related_obj.save()
@@ -244,8 +245,8 @@ class VersionAdmin(admin.ModelAdmin):
                 initial = []
                 related_versions = self.get_related_versions(obj, version, FormSet)
                 for related_obj in formset.queryset:
-                    if unicode(related_obj.pk) in related_versions:
-                        initial.append(related_versions.pop(unicode(related_obj.pk)).field_dict)
+                    if related_obj.pk in related_versions:
+                        initial.append(related_versions.pop(related_obj.pk).field_dict)
                     else:
                         initial_data = model_to_dict(related_obj)
                         initial_data["DELETE"] = True
@@ -323,7 +324,7 @@ class VersionAdmin(admin.ModelAdmin):
     def revision_view(self, request, object_id, version_id, extra_context=None):
         """Displays the contents of the given revision."""
         obj = get_object_or_404(self.model, pk=object_id)
-        version = get_object_or_404(Version, pk=version_id, object_id=unicode(obj.pk))
+        version = get_object_or_404(Version, pk=version_id, **get_key_values(self.model, obj.pk))
         # Generate the context.
         context = {"title": _("Revert %(name)s") % {"name": force_unicode(self.model._meta.verbose_name)},}
         context.update(extra_context or {})
@@ -361,7 +362,7 @@ class VersionAdmin(admin.ModelAdmin):
         """Renders the history view."""
         opts = self.model._meta
         action_list = [{"revision": version.revision,
-                        "url": reverse("%s:%s_%s_revision" % (self.admin_site.name, opts.app_label, opts.module_name), args=(version.object_id, version.id))}
+                        "url": reverse("%s:%s_%s_revision" % (self.admin_site.name, opts.app_label, opts.module_name), args=(version.object_pk, version.id))}
                        for version in Version.objects.get_for_object_reference(self.model, object_id).select_related("revision__user")]
         # Compile the context.
         context = {"action_list": action_list}
@@ -0,0 +1,259 @@
+"""
+Cold storage for the serialized data of old versions.
+
+Archived payloads are appended, compressed, to local segment files.  The
+`serialized_data` of an archived version is replaced by a pointer to its
+payload, which is read back through memory-mapped segment files.
+
+The archive directory is set by the REVERSION_ARCHIVE_ROOT setting.
+"""
+
+
+from __future__ import with_statement
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # fcntl is not available on Windows.
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+
+# The prefix of the pointer stored in the serialized_data of archived versions.
+ARCHIVE_PREFIX = "archive:"
+
+# Each record in a segment starts with the version id and payload length.
+RECORD_HEADER = struct.Struct(">QI")
+
+# The number of versions updated by each statement of _update_serialized_data().
+UPDATE_CHUNK_SIZE = 300
+
+DEFAULT_MAX_SEGMENT_SIZE = 256 * 1024 * 1024
+
+DEFAULT_MAX_OPEN_SEGMENTS = 32
+
+
+def is_archived(serialized_data):
+    """Checks whether the given serialized data is an archive pointer."""
+    return serialized_data.startswith(ARCHIVE_PREFIX)
+
+
+class SegmentArchive(object):
+
+    """An append-only store of compressed payloads in local segment files."""
+
+    def __init__(self, root, max_segment_size=DEFAULT_MAX_SEGMENT_SIZE,
+                 max_open_segments=DEFAULT_MAX_OPEN_SEGMENTS):
+        """Initializes the SegmentArchive."""
+        self.root = root
+        self.max_segment_size = max_segment_size
+        self.max_open_segments = max_open_segments
+        self._lock = threading.RLock()
+        self._maps = {}
+        self._map_order = []
+
+    def _get_segment_path(self, segment):
+        """Returns the path of the given segment file."""
+        return os.path.join(self.root, "segment-%06d.dat" % segment)
+
+    def _get_current_segment(self):
+        """Returns the number of the segment that new payloads are appended to."""
+        segments = [int(name[8:14]) for name in os.listdir(self.root)
+                    if name.startswith("segment-") and name.endswith(".dat")]
+        if not segments:
+            return 1
+        segment = max(segments)
+        if os.path.getsize(self._get_segment_path(segment)) >= self.max_segment_size:
+            segment += 1
+        return segment
+
+    def append(self, payloads):
+        """
+        Appends the given list of (version_id, serialized_data) pairs to the
+        archive, and returns a list of pointers to them.
+
+        The segment is locked while the payloads are appended, so that other
+        processes appending to the archive cannot interleave their writes, and
+        is flushed to disk before returning.
+        """
+        with self._lock:
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root)
+            segment = self._get_current_segment()
+            data_file = open(self._get_segment_path(segment), "ab")
+            try:
+                if fcntl is not None:
+                    fcntl.flock(data_file.fileno(), fcntl.LOCK_EX)
+                # The end of the segment is only known once it is locked.
+                data_file.seek(0, os.SEEK_END)
+                offset = data_file.tell()
+                pointers = []
+                for version_id, serialized_data in payloads:
+                    if isinstance(serialized_data, unicode):
+                        serialized_data = serialized_data.encode("utf8")
+                    compressed = zlib.compress(serialized_data)
+                    record = RECORD_HEADER.pack(version_id, len(compressed)) + compressed
+                    data_file.write(record)
+                    pointers.append("%s%d:%d:%d" % (ARCHIVE_PREFIX, segment, offset, len(record)))
+                    offset += len(record)
+                data_file.flush()
+                os.fsync(data_file.fileno())
+            finally:
+                # Closing the segment releases its lock.
+                data_file.close()
+            return pointers
+
+    def _get_map(self, segment, end):
+        """
+        Returns a memory map of the given segment that extends to at least the
+        given offset, opening it if required.
+        """
+        segment_map = self._maps.get(segment)
+        if segment_map is not None and len(segment_map) >= end:
+            self._map_order.remove(segment)
+            self._map_order.append(segment)
+            return segment_map
+        # The segment is not mapped, or has grown since it was mapped.
+        if segment_map is not None:
+            segment_map.close()
+            self._map_order.remove(segment)
+        segment_file = open(self._get_segment_path(segment), "rb")
+        try:
+            segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            segment_file.close()
+        self._maps[segment] = segment_map
+        self._map_order.append(segment)
+        # Close the least recently used segments.
+        while len(self._map_order) > self.max_open_segments:
+            self._maps.pop(self._map_order.pop(0)).close()
+        return segment_map
+
+    def read(self, pointer):
+        """Returns the serialized data referred to by the given pointer."""
+        segment, offset, length = [int(part) for part in pointer[len(ARCHIVE_PREFIX):].split(":")]
+        with self._lock:
+            segment_map = self._get_map(segment, offset + length)
+            record = segment_map[offset:offset+length]
+        version_id, compressed_length = RECORD_HEADER.unpack(record[:RECORD_HEADER.size])
+        return zlib.decompress(record[RECORD_HEADER.size:RECORD_HEADER.size+compressed_length]).decode("utf8")
+
+    def close(self):
+        """Closes all open segment files."""
+        with self._lock:
+            for segment_map in self._maps.values():
+                segment_map.close()
+            self._maps = {}
+            self._map_order = []
+
+
+_archive = None
+
+
+def get_archive():
+    """Returns the archive configured by the REVERSION_ARCHIVE_ROOT setting."""
+    global _archive
+    if _archive is None:
+        root = getattr(settings, "REVERSION_ARCHIVE_ROOT", None)
+        if not root:
+            raise ValueError("The REVERSION_ARCHIVE_ROOT setting is required to archive versions.")
+        _archive = SegmentArchive(root,
+                                  max_segment_size=getattr(settings, "REVERSION_ARCHIVE_MAX_SEGMENT_SIZE", DEFAULT_MAX_SEGMENT_SIZE))
+    return _archive
+
+
+def read_serialized_data(serialized_data):
+    """Returns the given serialized data, reading it from the archive if required."""
+    if is_archived(serialized_data):
+        return get_archive().read(serialized_data)
+    return serialized_data
+
+
+def archive_versions(before, chunk_size=1000, callback=None):
+    """
+    Moves the serialized data of versions in revisions created before the
+    given date into the archive.
+
+    Each chunk of `chunk_size` versions is appended to the archive and then
+    updated in its own transaction.  After each chunk, `callback` is called
+    with the number of versions archived so far.
+
+    Returns the number of versions archived.
+    """
+    from reversion.models import Version
+    archive = get_archive()
+    versions = Version.objects.filter(revision__date_created__lt=before)
+    versions = versions.exclude(serialized_data__startswith=ARCHIVE_PREFIX).order_by("pk")
+    count = 0
+    last_pk = 0
+    while True:
+        chunk = list(versions.filter(pk__gt=last_pk).values_list("pk", "serialized_data")[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1][0]
+        pointers = archive.append(chunk)
+        _update_serialized_data([(version_id, pointer) for (version_id, serialized_data), pointer in zip(chunk, pointers)])
+        count += len(chunk)
+        if callback is not None:
+            callback(count)
+    return count
+
+
+def rehydrate_versions(versions=None, chunk_size=1000, callback=None):
+    """
+    Moves the serialized data of archived versions back into the database.
+
+    If `versions` is given, only archived versions in that queryset are
+    rehydrated.  Returns the number of versions rehydrated.
+    """
+    from reversion.models import Version
+    archive = get_archive()
+    if versions is None:
+        versions = Version.objects.all()
+    versions = versions.filter(serialized_data__startswith=ARCHIVE_PREFIX).order_by("pk")
+    count = 0
+    last_pk = 0
+    while True:
+        chunk = list(versions.filter(pk__gt=last_pk).values_list("pk", "serialized_data")[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1][0]
+        _update_serialized_data([(version_id, archive.read(pointer)) for version_id, pointer in chunk])
+        count += len(chunk)
+        if callback is not None:
+            callback(count)
+    return count
+
+
+@transaction.commit_on_success
+def _update_serialized_data(updates):
+    """
+    Sets the serialized data of the given versions, with one statement for
+    each chunk of versions.
+    """
+    from reversion.models import Version
+    connection = connections[router.db_for_write(Version)]
+    qn = connection.ops.quote_name
+    opts = Version._meta
+    pk_column = qn(opts.pk.column)
+    cursor = connection.cursor()
+    for start in xrange(0, len(updates), UPDATE_CHUNK_SIZE):
+        chunk = updates[start:start+UPDATE_CHUNK_SIZE]
+        params = []
+        for version_id, serialized_data in chunk:
+            params.extend((version_id, serialized_data))
+        params.extend([version_id for version_id, serialized_data in chunk])
+        cursor.execute("UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % (
+            qn(opts.db_table),
+            qn(opts.get_field("serialized_data").column),
+            pk_column,
+            " ".join(["WHEN %s THEN %s"] * len(chunk)),
+            pk_column,
+            ", ".join(["%s"] * len(chunk))), params)
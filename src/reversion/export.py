@@ -0,0 +1,271 @@
+"""Streaming NDJSON export and import of revision history."""
+
+
+import datetime
+import hashlib
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import simplejson
+
+from reversion.models import Revision, Version, VersionHead, ActivityRollup
+from reversion.stores import get_version_store
+
+
+DATE_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S")
+
+# The number of source keys looked up by each query of _import_batch().
+SOURCE_KEY_CHUNK_SIZE = 500
+
+# How the users of imported revisions are found.
+
+USERS_BY_USERNAME = "username"
+USERS_BY_ID = "id"
+USERS_NONE = "none"
+
+USER_MAPPINGS = (USERS_BY_USERNAME, USERS_BY_ID, USERS_NONE)
+
+
+def _format_date(date):
+    """Formats a datetime for export."""
+    return date.isoformat()
+
+
+def _parse_date(value):
+    """Parses an exported datetime."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid date: %r" % value)
+
+
+def export_versions(stream, model_classes=None, date_from=None, date_to=None,
+                    revision_from=None, revision_to=None, chunk_size=1000):
+    """
+    Writes revisions and their versions to the given stream as NDJSON.
+
+    Each revision is written as one line, followed by a line for each of its
+    versions.  Revisions are read in chunks of `chunk_size`, paging on the
+    primary key, so memory use does not grow with the size of the history.
+
+    The export can be limited to versions of the given model classes, to
+    revisions created within a date range, or to a range of revision ids.
+
+    Returns the number of revisions and versions written.
+    """
+    revisions = Revision.objects.all()
+    versions = Version.objects.all()
+    if model_classes:
+        content_types = [ContentType.objects.get_for_model(model_class) for model_class in model_classes]
+        revisions = revisions.filter(version__content_type__in=content_types).distinct()
+        versions = versions.filter(content_type__in=content_types)
+    if date_from is not None:
+        revisions = revisions.filter(date_created__gte=date_from)
+    if date_to is not None:
+        revisions = revisions.filter(date_created__lte=date_to)
+    if revision_from is not None:
+        revisions = revisions.filter(pk__gte=revision_from)
+    if revision_to is not None:
+        revisions = revisions.filter(pk__lte=revision_to)
+    revisions = revisions.order_by("pk")
+    store = get_version_store()
+    revision_count = 0
+    version_count = 0
+    last_pk = None
+    while True:
+        chunk = revisions
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk.values("id", "date_created", "user", "user__username", "comment")[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1]["id"]
+        chunk_versions = versions.filter(revision__in=[revision["id"] for revision in chunk])
+        chunk_versions = chunk_versions.order_by("revision", "pk").values_list(
+            "revision", "content_type", "object_id", "object_key", "format", "serialized_data", "object_repr", "action_flag")
+        versions_by_revision = {}
+        for row in chunk_versions.iterator():
+            versions_by_revision.setdefault(row[0], []).append(row)
+        for revision in chunk:
+            stream.write(simplejson.dumps({"model": "revision",
+                                           "id": revision["id"],
+                                           "date_created": _format_date(revision["date_created"]),
+                                           "user": revision["user"],
+                                           "username": revision["user__username"],
+                                           "comment": revision["comment"]}))
+            stream.write("\n")
+            revision_count += 1
+            for revision_id, content_type_id, object_id, object_key, format, serialized_data, object_repr, action_flag in versions_by_revision.get(revision["id"], ()):
+                content_type = ContentType.objects.get_for_id(content_type_id)
+                stream.write(simplejson.dumps({"model": "version",
+                                               "revision": revision_id,
+                                               "content_type": [content_type.app_label, content_type.model],
+                                               "object_id": object_id,
+                                               "object_key": object_key,
+                                               "format": format,
+                                               "serialized_data": store.decode(serialized_data),
+                                               "object_repr": object_repr,
+                                               "action_flag": action_flag}))
+                stream.write("\n")
+                version_count += 1
+    return revision_count, version_count
+
+
+def _iter_batches(stream, chunk_size):
+    """Yields lists of up to `chunk_size` records read from the given stream."""
+    batch = []
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        batch.append(simplejson.loads(line))
+        if len(batch) >= chunk_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_versions(stream, chunk_size=1000, users=USERS_BY_USERNAME):
+    """
+    Reads revisions and versions written by `export_versions` from the given
+    stream, and inserts them into the database.
+
+    Revisions are given new primary keys, and the versions that refer to them
+    are remapped.  Revisions and versions are inserted in bulk, and each chunk
+    of `chunk_size` records is committed in its own transaction.  Revisions
+    that have already been imported are skipped, along with their versions.
+
+    The users of revisions are found as given by `users`: USERS_BY_USERNAME
+    matches users with the same username, USERS_BY_ID keeps user ids that
+    exist in this database, and USERS_NONE leaves revisions without a user.
+    Revisions whose user is not found are imported without a user.
+
+    The version heads and activity rollups of the imported versions are
+    rebuilt once all records have been imported.
+
+    Returns the number of revisions and versions imported.
+    """
+    revision_count = 0
+    version_count = 0
+    first_revision_id = None
+    first_day = None
+    if users not in USER_MAPPINGS:
+        raise ValueError("Unknown user mapping: %r" % users)
+    revisions = {}
+    for batch in _iter_batches(stream, chunk_size):
+        revisions, imported_revisions, imported_version_count = _import_batch(batch, revisions, users)
+        revision_count += len(imported_revisions)
+        version_count += imported_version_count
+        for revision in imported_revisions:
+            if first_revision_id is None:
+                first_revision_id = revision.pk
+            if first_day is None or revision.date_created.date() < first_day:
+                first_day = revision.date_created.date()
+    if first_revision_id is not None:
+        _rebuild_heads(first_revision_id)
+        ActivityRollup.objects.rebuild(since=first_day)
+    return revision_count, version_count
+
+
+@transaction.commit_on_success
+def _rebuild_heads(first_revision_id):
+    """Rebuilds the heads of the objects with versions in the given or later revisions."""
+    keys = Version.objects.filter(revision__gte=first_revision_id).values_list(
+        "content_type", "object_id", "object_key").order_by().distinct()
+    VersionHead.objects.rebuild_objects(keys)
+
+
+def _get_source_key(record):
+    """Returns the source key of an exported revision record."""
+    return "import:%s" % hashlib.sha1(simplejson.dumps(record, sort_keys=True)).hexdigest()
+
+
+def _get_imported_keys(batch):
+    """Returns the set of source keys of the revisions in the batch that have already been imported."""
+    source_keys = [_get_source_key(record) for record in batch if record["model"] == "revision"]
+    imported_keys = set()
+    for start in xrange(0, len(source_keys), SOURCE_KEY_CHUNK_SIZE):
+        imported_keys.update(Revision.objects.filter(
+            source_key__in=source_keys[start:start+SOURCE_KEY_CHUNK_SIZE]).values_list("source_key", flat=True))
+    return imported_keys
+
+
+def _get_user_ids(batch, users):
+    """
+    Returns a dictionary mapping the exported user ids of the revisions in the
+    batch to the ids of the matching users in this database.
+    """
+    records = [record for record in batch if record["model"] == "revision" and record["user"] is not None]
+    if users == USERS_BY_USERNAME:
+        exported_ids = dict([(record["username"], record["user"]) for record in records if record.get("username")])
+        rows = User.objects.filter(username__in=exported_ids.keys()).values_list("username", "pk")
+        return dict([(exported_ids[username], user_id) for username, user_id in rows])
+    if users == USERS_BY_ID:
+        user_ids = User.objects.filter(pk__in=set([record["user"] for record in records])).values_list("pk", flat=True)
+        return dict([(user_id, user_id) for user_id in user_ids])
+    return {}
+
+
+@transaction.commit_on_success
+def _import_batch(batch, revisions, users):
+    """
+    Imports a batch of exported records, given a dictionary mapping exported
+    revision ids to imported revisions, or to None for revisions that were
+    skipped.
+    
+    Returns the mapping needed by the next batch, the imported revisions and
+    the number of imported versions.
+    """
+    imported_keys = _get_imported_keys(batch)
+    user_ids = _get_user_ids(batch, users)
+    imported_revisions = []
+    last_revision_id = None
+    for record in batch:
+        if record["model"] == "revision":
+            last_revision_id = record["id"]
+            source_key = _get_source_key(record)
+            if source_key in imported_keys:
+                revisions[record["id"]] = None
+                continue
+            revision = Revision(user_id=user_ids.get(record["user"]),
+                                comment=record["comment"],
+                                date_created=_parse_date(record["date_created"]),
+                                source_key=source_key)
+            revisions[record["id"]] = revision
+            imported_revisions.append(revision)
+            imported_keys.add(source_key)
+        elif record["model"] != "version":
+            raise ValueError("Unknown record type: %r" % record["model"])
+    # A raw insert keeps the exported creation dates.
+    Revision.objects.insert_many(imported_revisions, raw=True)
+    Revision.objects.assign_pks(imported_revisions)
+    versions = []
+    for record in batch:
+        if record["model"] == "version":
+            try:
+                revision = revisions[record["revision"]]
+            except KeyError:
+                raise ValueError("Version refers to revision %r, which has not been imported." % record["revision"])
+            if revision is None:
+                continue
+            content_type = ContentType.objects.get_by_natural_key(*record["content_type"])
+            versions.append(Version(revision=revision,
+                                    content_type=content_type,
+                                    object_id=record["object_id"],
+                                    object_key=record.get("object_key", u""),
+                                    format=record["format"],
+                                    serialized_data=record["serialized_data"],
+                                    object_repr=record["object_repr"],
+                                    action_flag=record["action_flag"]))
+    # Heads and rollups are rebuilt after the import, since imported versions
+    # are older than their primary keys suggest.
+    get_version_store().write_batch(versions, update_summaries=False)
+    # Versions always follow their revision, so only the last revision of
+    # this batch can be referred to by the next one.
+    if last_revision_id is not None:
+        revisions = {last_revision_id: revisions[last_revision_id]}
+    return revisions, imported_revisions, len(versions)
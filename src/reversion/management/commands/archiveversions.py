@@ -0,0 +1,35 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from reversion.archive import archive_versions
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--days",
+            action="store",
+            type="int",
+            dest="days",
+            default=365,
+            help="Archive versions in revisions older than the given number of days. Defaults to 365."),
+        make_option("--chunk-size",
+            action="store",
+            type="int",
+            dest="chunk_size",
+            default=1000,
+            help="The number of versions to archive in each transaction. Defaults to 1000."),
+        )
+    args = "[--days=365]"
+    help = "Moves the serialized data of old versions into the archive set by REVERSION_ARCHIVE_ROOT."
+
+    def handle(self, *args, **options):
+        before = datetime.datetime.now() - datetime.timedelta(days=options["days"])
+        verbosity = int(options.get("verbosity", 1))
+        def report_progress(count):
+            if verbosity >= 2:
+                print u"Archived %s versions." % count
+        count = archive_versions(before, chunk_size=options["chunk_size"], callback=report_progress)
+        if verbosity >= 1:
+            print u"Archived %s versions created before %s." % (count, before)
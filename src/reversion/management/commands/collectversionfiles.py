@@ -0,0 +1,39 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from reversion.storage import collect_files
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--min-age",
+            action="store",
+            type="float",
+            dest="min_age",
+            default=24,
+            help="Keep files modified within the given number of hours. Defaults to 24."),
+        make_option("--dry-run",
+            action="store_true",
+            dest="dry_run",
+            default=False,
+            help="List the unreferenced files without deleting them."),
+        )
+    args = "[--min-age=24] [--dry-run]"
+    help = "Deletes content addressed version files that are not referenced by any object or stored version."
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        dry_run = options["dry_run"]
+        def report_file(name):
+            if verbosity >= 2 or dry_run:
+                print name
+        count = collect_files(min_age=datetime.timedelta(hours=options["min_age"]),
+                              dry_run=dry_run,
+                              callback=report_file)
+        if verbosity >= 1:
+            if dry_run:
+                print u"Found %s unreferenced files." % count
+            else:
+                print u"Deleted %s unreferenced files." % count
@@ -1,6 +1,7 @@
 from optparse import make_option
 
 from django import VERSION
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ImproperlyConfigured
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
@@ -9,7 +10,8 @@ from django.utils.importlib import import_module
 from django.utils.datastructures import SortedDict
 
 from reversion import revision
-from reversion.models import Version
+from reversion.managers import get_key_column
+from reversion.models import VersionHead
 
 
 class Command(BaseCommand):
@@ -85,16 +87,19 @@ class Command(BaseCommand):
         # Check all models for empty revisions.
         if revision.is_registered(model_class):
             created_count = 0
-            # HACK: This join can't be done in the database, due to incompatibilities
-            # between unicode object_ids and integer pks on strict backends like postgres.
-            for obj in model_class._default_manager.iterator():
-                if Version.objects.get_for_object(obj).count() == 0:
-                    try:
-                        self.version_save(obj, comment)
-                    except:
-                        print "ERROR: Could not save initial version for %s %s." % (model_class.__name__, obj.pk)
-                        raise
-                    created_count += 1
+            # Find the objects without versions with a single query, joined
+            # against the version heads in the database.
+            content_type = ContentType.objects.get_for_model(model_class)
+            key_column = get_key_column(model_class)
+            versioned_ids = VersionHead.objects.filter(content_type=content_type,
+                                                       **{key_column + "__isnull": False}).values(key_column)
+            for obj in model_class._default_manager.exclude(pk__in=versioned_ids).iterator():
+                try:
+                    self.version_save(obj, comment)
+                except:
+                    print "ERROR: Could not save initial version for %s %s." % (model_class.__name__, obj.pk)
+                    raise
+                created_count += 1
             # Print out a message, if feeling verbose.
             if created_count > 0 and verbosity >= 2:
                 print u"Created %s initial revisions for model %s." % (created_count, model_class._meta.verbose_name)
@@ -0,0 +1,97 @@
+import datetime
+import gzip
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import models
+
+from reversion.export import export_versions
+
+
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d")
+
+
+def parse_date(value):
+    """Parses a date option."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise CommandError("Invalid date: %s" % value)
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--output",
+            action="store",
+            dest="output",
+            default=None,
+            help="Write to the given file instead of standard output. Files ending in .gz are compressed."),
+        make_option("--date-from",
+            action="store",
+            dest="date_from",
+            default=None,
+            help="Only export revisions created on or after the given date."),
+        make_option("--date-to",
+            action="store",
+            dest="date_to",
+            default=None,
+            help="Only export revisions created on or before the given date."),
+        make_option("--revision-from",
+            action="store",
+            type="int",
+            dest="revision_from",
+            default=None,
+            help="Only export revisions with an id greater than or equal to the given id."),
+        make_option("--revision-to",
+            action="store",
+            type="int",
+            dest="revision_to",
+            default=None,
+            help="Only export revisions with an id less than or equal to the given id."),
+        make_option("--chunk-size",
+            action="store",
+            type="int",
+            dest="chunk_size",
+            default=1000,
+            help="The number of revisions to read from the database at a time. Defaults to 1000."),
+        )
+    args = "[appname.ModelName, ...] [--output=versions.ndjson.gz]"
+    help = "Exports revisions and versions as newline-delimited JSON."
+
+    def handle(self, *labels, **options):
+        model_classes = []
+        for label in labels:
+            try:
+                app_label, model_label = label.split(".")
+            except ValueError:
+                raise CommandError("Specify models as appname.ModelName.")
+            model_class = models.get_model(app_label, model_label)
+            if model_class is None:
+                raise CommandError("Unknown model: %s.%s" % (app_label, model_label))
+            model_classes.append(model_class)
+        date_from = options["date_from"] and parse_date(options["date_from"])
+        date_to = options["date_to"] and parse_date(options["date_to"])
+        output = options["output"]
+        if output is None:
+            stream = sys.stdout
+        elif output.endswith(".gz"):
+            stream = gzip.open(output, "wb")
+        else:
+            stream = open(output, "wb")
+        try:
+            revision_count, version_count = export_versions(stream,
+                                                            model_classes=model_classes,
+                                                            date_from=date_from,
+                                                            date_to=date_to,
+                                                            revision_from=options["revision_from"],
+                                                            revision_to=options["revision_to"],
+                                                            chunk_size=options["chunk_size"])
+        finally:
+            if output is not None:
+                stream.close()
+        if output is not None and int(options.get("verbosity", 1)) >= 1:
+            print u"Exported %s revisions and %s versions." % (revision_count, version_count)
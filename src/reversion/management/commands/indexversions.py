@@ -0,0 +1,62 @@
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+from reversion import search
+from reversion.models import Version
+from reversion.stream import iter_versions
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size",
+            action="store",
+            type="int",
+            dest="chunk_size",
+            default=500,
+            help="The number of versions to index at a time. Defaults to 500."),
+        make_option("--processes",
+            action="store",
+            type="int",
+            dest="processes",
+            default=None,
+            help="The number of worker processes to deserialize versions with. Defaults to the REVERSION_DESERIALIZE_PROCESSES setting."),
+        )
+    args = "[appname.ModelName, ...] [--chunk-size=500] [--processes=N]"
+    help = "Adds the existing versions of all models, or of the given models, to the search index."
+
+    def handle(self, *model_labels, **options):
+        if not search.is_enabled():
+            raise CommandError("Search is not enabled.  Set REVERSION_SEARCH_INDEX or REVERSION_SEARCH_BACKEND.")
+        chunk_size = options["chunk_size"]
+        verbosity = int(options.get("verbosity", 1))
+        versions = Version.objects.all()
+        if model_labels:
+            content_types = []
+            for label in model_labels:
+                try:
+                    app_label, model_label = label.split(".")
+                except ValueError:
+                    raise CommandError("Models must be given as appname.ModelName: %s" % label)
+                model_class = models.get_model(app_label, model_label)
+                if model_class is None:
+                    raise CommandError("Unknown model: %s" % label)
+                content_types.append(ContentType.objects.get_for_model(model_class))
+            versions = versions.filter(content_type__in=content_types)
+        search.get_search_backend().install()
+        count = 0
+        chunk = []
+        for record in iter_versions(versions, chunk_size=chunk_size, processes=options["processes"]):
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                search.index_versions(chunk)
+                count += len(chunk)
+                chunk = []
+                if verbosity >= 2:
+                    print u"Indexed %s versions." % count
+        search.index_versions(chunk)
+        count += len(chunk)
+        if verbosity >= 1:
+            print u"Indexed %s versions." % count
@@ -0,0 +1,46 @@
+import gzip
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from reversion.export import import_versions, USERS_BY_USERNAME, USER_MAPPINGS
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size",
+            action="store",
+            type="int",
+            dest="chunk_size",
+            default=1000,
+            help="The number of records to insert in each transaction. Defaults to 1000."),
+        make_option("--users",
+            action="store",
+            type="choice",
+            choices=USER_MAPPINGS,
+            dest="users",
+            default=USERS_BY_USERNAME,
+            help="How to find the users of revisions: by username, by id, or none. Revisions whose user is not found are imported without one. Defaults to username."),
+        )
+    args = "<versions.ndjson[.gz] | -> [--users=username|id|none]"
+    help = "Imports revisions and versions exported by dumpversions."
+
+    def handle(self, *filenames, **options):
+        if len(filenames) != 1:
+            raise CommandError("Specify a single file to import, or - for standard input.")
+        filename = filenames[0]
+        if filename == "-":
+            stream = sys.stdin
+        elif filename.endswith(".gz"):
+            stream = gzip.open(filename, "rb")
+        else:
+            stream = open(filename, "rb")
+        try:
+            revision_count, version_count = import_versions(stream, chunk_size=options["chunk_size"], users=options["users"])
+        finally:
+            if filename != "-":
+                stream.close()
+        if int(options.get("verbosity", 1)) >= 1:
+            print u"Imported %s revisions and %s versions." % (revision_count, version_count)
@@ -0,0 +1,39 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reversion.models import ActivityRollup
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--since",
+            action="store",
+            dest="since",
+            default=None,
+            help="Only rebuild the activity of days on or after the given YYYY-MM-DD date. Defaults to all days."),
+        make_option("--chunk-days",
+            action="store",
+            type="int",
+            dest="chunk_days",
+            default=30,
+            help="The number of days to rebuild in each transaction. Defaults to 30."),
+        )
+    args = "[--since=YYYY-MM-DD]"
+    help = "Rebuilds the per user, model and day activity rollups from the existing revisions."
+
+    def handle(self, *args, **options):
+        since = options["since"]
+        if since is not None:
+            try:
+                since = datetime.datetime.strptime(since, "%Y-%m-%d").date()
+            except ValueError:
+                raise CommandError("--since must be a date in the format YYYY-MM-DD.")
+        verbosity = int(options.get("verbosity", 1))
+        def report_progress(day):
+            if verbosity >= 2:
+                print u"Rebuilt activity up to %s." % day
+        count = ActivityRollup.objects.rebuild(since=since, chunk_days=options["chunk_days"], callback=report_progress)
+        if verbosity >= 1:
+            print u"Created %s activity rollups." % count
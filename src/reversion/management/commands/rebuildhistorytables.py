@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+from reversion import shadow
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size",
+            action="store",
+            type="int",
+            dest="chunk_size",
+            default=500,
+            help="The number of versions to write at a time. Defaults to 500."),
+        )
+    args = "appname.ModelName [appname.ModelName, ...] [--chunk-size=500]"
+    help = "Rewrites the shadow history tables of the given models from their stored versions."
+
+    def handle(self, *model_labels, **options):
+        if not model_labels:
+            raise CommandError("Enter at least one appname.ModelName.")
+        verbosity = int(options.get("verbosity", 1))
+        model_classes = []
+        for label in model_labels:
+            try:
+                app_label, model_label = label.split(".")
+            except ValueError:
+                raise CommandError("Models must be given as appname.ModelName: %s" % label)
+            model_class = models.get_model(app_label, model_label)
+            if model_class is None:
+                raise CommandError("Unknown model: %s" % label)
+            if not shadow.is_shadowed(model_class):
+                raise CommandError("%s is not registered with a shadow table." % label)
+            model_classes.append(model_class)
+        for model_class in model_classes:
+            count = shadow.rebuild(model_class, chunk_size=options["chunk_size"])
+            if verbosity >= 1:
+                print u"Wrote %s rows to %s." % (count, shadow.get_history_model(model_class)._meta.db_table)
@@ -0,0 +1,44 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+
+from reversion.archive import rehydrate_versions
+from reversion.models import Version
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size",
+            action="store",
+            type="int",
+            dest="chunk_size",
+            default=1000,
+            help="The number of versions to rehydrate in each transaction. Defaults to 1000."),
+        )
+    args = "[appname.ModelName, ...]"
+    help = "Moves the serialized data of archived versions back into the database."
+
+    def handle(self, *labels, **options):
+        versions = Version.objects.all()
+        if labels:
+            content_types = []
+            for label in labels:
+                try:
+                    app_label, model_label = label.split(".")
+                except ValueError:
+                    raise CommandError("Specify models as appname.ModelName.")
+                model_class = models.get_model(app_label, model_label)
+                if model_class is None:
+                    raise CommandError("Unknown model: %s.%s" % (app_label, model_label))
+                content_types.append(ContentType.objects.get_for_model(model_class))
+            versions = versions.filter(content_type__in=content_types)
+        verbosity = int(options.get("verbosity", 1))
+        def report_progress(count):
+            if verbosity >= 2:
+                print u"Rehydrated %s versions." % count
+        count = rehydrate_versions(versions, chunk_size=options["chunk_size"], callback=report_progress)
+        if verbosity >= 1:
+            print u"Rehydrated %s versions." % count
@@ -0,0 +1,108 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import models
+
+from reversion.restore import restore
+
+
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d")
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--date",
+            action="store",
+            dest="date",
+            help='The date to restore the objects to, as "YYYY-MM-DD [HH:MM[:SS]]".'),
+        make_option("--filter",
+            action="append",
+            dest="filters",
+            default=[],
+            help='Only restore objects matching the given "lookup=value" filter. Can be given several times. '
+                 'Objects deleted since the date are not recovered when filtering.'),
+        make_option("--dry-run",
+            action="store_true",
+            dest="dry_run",
+            default=False,
+            help="Report the changes that would be made, without making them."),
+        make_option("--delete",
+            action="store_true",
+            dest="delete",
+            default=False,
+            help="Delete objects that had been deleted at the given date, or were created after it. "
+                 "Objects without any versions are kept."),
+        make_option("--chunk-size",
+            action="store",
+            type="int",
+            dest="chunk_size",
+            default=100,
+            help="The number of objects to restore in each transaction. Defaults to 100."),
+        make_option("--resume-after",
+            action="store",
+            dest="resume_after",
+            default=None,
+            help="Skip objects up to and including the given object primary key, to resume an interrupted restore."),
+        make_option("--comment",
+            action="store",
+            dest="comment",
+            default=None,
+            help="Specify the comment to add to the revisions."),
+        )
+    args = 'appname.ModelName --date="YYYY-MM-DD HH:MM" [--filter="lookup=value" ...]'
+    help = "Restores the objects of a model to their state at the given date."
+
+    def handle(self, *labels, **options):
+        if len(labels) != 1:
+            raise CommandError("Specify a single model to restore, as appname.ModelName.")
+        try:
+            app_label, model_label = labels[0].split(".")
+        except ValueError:
+            raise CommandError("Specify a single model to restore, as appname.ModelName.")
+        model_class = models.get_model(app_label, model_label)
+        if model_class is None:
+            raise CommandError("Unknown model: %s.%s" % (app_label, model_label))
+        date = self.parse_date(options["date"])
+        # Without filters, restore the whole model so deleted objects can be recovered.
+        target = model_class
+        if options["filters"]:
+            target = model_class._default_manager.all()
+            for lookup in options["filters"]:
+                try:
+                    key, value = lookup.split("=", 1)
+                except ValueError:
+                    raise CommandError("Invalid filter: %s" % lookup)
+                target = target.filter(**{str(key): value})
+        dry_run = options["dry_run"]
+        verbosity = int(options.get("verbosity", 1))
+        comment = options["comment"] or u"Restored to %s." % date
+        def report_progress(done, total, last_object_id):
+            if verbosity >= 1:
+                print u"Processed %s of %s objects (last object id %s)." % (done, total, last_object_id)
+        changes = restore(target, date,
+                          dry_run=dry_run,
+                          delete=options["delete"],
+                          chunk_size=options["chunk_size"],
+                          resume_after=options["resume_after"],
+                          comment=comment,
+                          callback=report_progress)
+        if verbosity >= 2 or dry_run:
+            for action, version in changes:
+                print u"%s %s %s" % (action, version.object_pk, version.object_repr)
+        if dry_run:
+            print u"%s objects would be restored." % len(changes)
+        else:
+            print u"Restored %s objects." % len(changes)
+
+    def parse_date(self, value):
+        """Parses the --date option."""
+        if not value:
+            raise CommandError("Specify the date to restore to with --date.")
+        for date_format in DATE_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+        raise CommandError("Invalid date: %s" % value)
@@ -1,10 +1,69 @@
 """Model managers for Reversion."""
+import operator
+
+from django.contrib.admin.models import ADDITION, CHANGE, DELETION
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, connections, transaction, IntegrityError
+from django.db.backends.util import typecast_timestamp
 from django.contrib.auth.models import User
 from django.db.models.query import QuerySet
+from django.db.models.fields.files import FieldFile
 from django.core.exceptions import ObjectDoesNotExist
-from datetime import datetime
+from datetime import datetime, time, timedelta
+
+
+# The primary key types that are stored in the integer object_id column of
+# versions.  Other primary keys are stored in the string object_key column.
+INTEGER_KEY_TYPES = ("AutoField", "IntegerField", "BigIntegerField", "SmallIntegerField",
+                     "PositiveIntegerField", "PositiveSmallIntegerField")
+
+def get_key_field(model_class):
+    """
+    Returns the field that holds the primary key of the given model, following
+    the parent links of inherited models.
+    """
+    field = model_class._meta.pk
+    while field.rel:
+        field = field.rel.get_related_field()
+    return field
+
+def get_key_column(model_class):
+    """Returns the name of the version field that stores keys of the given model."""
+    if get_key_field(model_class).get_internal_type() in INTEGER_KEY_TYPES:
+        return "object_id"
+    return "object_key"
+
+def get_key_values(model_class, object_id):
+    """
+    Returns a dictionary of the version field values that refer to the object
+    of the given model with the given primary key.
+    
+    Integer keys are converted to integers, so that lookups bind a parameter
+    that can use the index of the object_id column.
+    """
+    field = get_key_field(model_class)
+    object_id = field.to_python(object_id)
+    if field.get_internal_type() in INTEGER_KEY_TYPES:
+        return {"object_id": object_id}
+    return {"object_key": unicode(object_id)}
+
+def supports_window_functions(connection):
+    """Checks whether the given database connection supports window functions."""
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 25, 0)
+    return False
+
+def _to_datetime(value):
+    """
+    Converts a date read by a raw query to a datetime, since some backends
+    return dates selected by expressions as strings.
+    """
+    if isinstance(value, basestring):
+        return typecast_timestamp(value)
+    return value
 
 def diff_vers(v1, v2=None):
     from reversion.revisions import revision
@@ -113,15 +172,145 @@ def diff_as_text(diff):
                     output.append("%s%s: '%s'" % (' ' * 8, f[0], f[1]))
     return '\n'.join(output)
 
-class VersionManager(models.Manager):
+class BulkInsertManager(models.Manager):
+    
+    """A manager that can insert many unsaved models with a single statement."""
+    
+    def insert_many(self, objs, raw=False):
+        """
+        Inserts the given unsaved models with a single statement.
+        
+        If `raw` is true, field values are inserted as they are, as by a raw
+        save, so that automatic dates are kept.  The primary keys of the
+        inserted models are not set.
+        """
+        if not objs:
+            return
+        if hasattr(self, "bulk_create") and not raw:
+            self.bulk_create(objs)
+            return
+        # Fall back to executemany() on versions of Django without bulk_create().
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        fields = [field for field in opts.local_fields if not isinstance(field, models.AutoField)]
+        sql = "INSERT INTO %s (%s) VALUES (%s)" % (qn(opts.db_table),
+                                                   ", ".join([qn(field.column) for field in fields]),
+                                                   ", ".join(["%s"] * len(fields)))
+        params = [[field.get_db_prep_save(raw and getattr(obj, field.attname) or field.pre_save(obj, True),
+                                          connection=connection)
+                   for field in fields]
+                  for obj in objs]
+        connection.cursor().executemany(sql, params)
+        transaction.commit_unless_managed(using=self.db)
+    
+    def insert_rows(self, objs):
+        """
+        Inserts the given unsaved models with a single multi-row statement, so
+        that either all or none of them are inserted.
+        
+        The primary keys of the inserted models are not set.
+        """
+        if not objs:
+            return
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        fields = [field for field in opts.local_fields if not isinstance(field, models.AutoField)]
+        row = "(%s)" % ", ".join(["%s"] * len(fields))
+        sql = "INSERT INTO %s (%s) VALUES %s" % (qn(opts.db_table),
+                                                 ", ".join([qn(field.column) for field in fields]),
+                                                 ", ".join([row] * len(objs)))
+        params = []
+        for obj in objs:
+            params.extend([field.get_db_prep_save(field.pre_save(obj, True), connection=connection)
+                           for field in fields])
+        connection.cursor().execute(sql, params)
+        transaction.commit_unless_managed(using=self.db)
+
+
+class VersionManager(BulkInsertManager):
     
     """Manager for Version models."""
     
+    # The number of deleted versions loaded by each query of get_deleted().
+    DELETED_CHUNK_SIZE = 500
+    
+    # The number of versions annotated by each query of annotate_neighbours().
+    NEIGHBOUR_CHUNK_SIZE = 400
+    
+    def _get_head_lookup(self, model_class, object_id):
+        """
+        Returns the field lookups that match the latest version of the given
+        object, through its head.
+        """
+        content_type = ContentType.objects.get_for_model(model_class)
+        lookup = dict([("heads__" + name, value) for name, value
+                       in get_key_values(model_class, object_id).items()])
+        lookup["heads__content_type"] = content_type
+        return lookup
+    
+    def assign_pks(self, versions):
+        """
+        Sets the primary keys of the given versions, which have just been
+        inserted by insert_many(), with a single query.
+        
+        Each version is matched by its revision and object, so the versions
+        must have their revision set.
+        """
+        unsaved = {}
+        for version in versions:
+            if version.pk is None:
+                unsaved[(version.revision_id, version.content_type_id, version.object_id, version.object_key)] = version
+        if not unsaved:
+            return
+        rows = self.filter(revision__in=set([key[0] for key in unsaved])).values_list(
+            "pk", "revision", "content_type", "object_id", "object_key")
+        for row in rows:
+            version = unsaved.get(row[1:])
+            if version is not None:
+                version.id = row[0]
+    
+    def replace_latest(self, latest, serialized_data, object_repr):
+        """
+        Replaces the serialized data and representation of the given version,
+        provided that it is still the latest version of its object and its
+        serialized data has not been changed since it was read.
+
+        This runs a single conditional statement, so a concurrent writer that
+        adds a newer version of the object prevents the replacement.  Returns
+        whether the version was replaced.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        key_name, key_value = latest.get_key_lookup().items()[0]
+        data_field = opts.get_field("serialized_data")
+        names = {"version": qn(opts.db_table),
+                 "id": qn(opts.pk.column),
+                 "serialized_data": qn(data_field.column),
+                 "object_repr": qn(opts.get_field("object_repr").column),
+                 "content_type_id": qn(opts.get_field("content_type").column),
+                 "key": qn(opts.get_field(key_name).column)}
+        # The newer versions are selected through a derived table, since MySQL
+        # cannot select from the table being updated in a subquery.
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %(version)s SET %(serialized_data)s = %%s, %(object_repr)s = %%s "
+                       "WHERE %(id)s = %%s AND %(serialized_data)s = %%s AND NOT EXISTS ("
+                       "SELECT 1 FROM (SELECT %(id)s FROM %(version)s "
+                       "WHERE %(content_type_id)s = %%s AND %(key)s = %%s AND %(id)s > %%s) newer)" % names,
+                       [data_field.get_db_prep_save(serialized_data, connection=connection),
+                        opts.get_field("object_repr").get_db_prep_save(object_repr, connection=connection),
+                        latest.pk,
+                        data_field.get_db_prep_save(latest.serialized_data, connection=connection),
+                        latest.content_type_id, key_value, latest.pk])
+        transaction.commit_unless_managed(using=self.db)
+        return cursor.rowcount == 1
+
     def get_for_object_reference(self, model, object_id):
         """Returns all versions for the given object reference."""
         content_type = ContentType.objects.get_for_model(model)
-        object_id = unicode(object_id)
-        versions = self.filter(content_type=content_type, object_id=object_id)
+        versions = self.filter(content_type=content_type, **get_key_values(model, object_id))
         versions = versions.order_by("pk")
         return versions
     
@@ -129,7 +318,7 @@ class VersionManager(models.Manager):
         """
         Returns all the versions of the given object, ordered by date created.
         """
-        return self.get_for_object_reference(object.__class__, obj.pk)
+        return self.get_for_object_reference(obj.__class__, obj.pk)
     
     def get_unique_for_object(self, obj):
         """Returns unique versions associated with the object."""
@@ -142,8 +331,39 @@ class VersionManager(models.Manager):
             last_serialized_data = version.serialized_data
         return changed_versions
     
+    def get_latest_for_object(self, obj):
+        """
+        Returns the latest version of the given object, read through its head.
+        """
+        return self.get(**self._get_head_lookup(obj.__class__, obj.pk))
+    
+    def get_count_for_object(self, obj):
+        """
+        Returns the number of versions of the given object, read from its head.
+        """
+        from reversion.models import VersionHead
+        content_type = ContentType.objects.get_for_model(obj)
+        counts = VersionHead.objects.filter(content_type=content_type,
+                                            **get_key_values(obj.__class__, obj.pk)).values_list("version_count", flat=True)
+        if counts:
+            return counts[0]
+        return 0
+    
     def get_for_date(self, obj, date):
-        """Returns the latest version of an object for the given date."""
+        """
+        Returns the latest version of an object for the given date.
+        
+        For dates at or after the latest revision of the object, the version
+        is read through its head.  For earlier dates, the versions of the
+        object are read newest first from the object index, stopping at the
+        first version saved at or before the date.
+        """
+        versions = self.filter(heads__revision_date__lte=date,
+                               **self._get_head_lookup(obj.__class__, obj.pk))
+        try:
+            return versions[0]
+        except IndexError:
+            pass
         versions = self.get_for_object(obj)
         versions = versions.filter(revision__date_created__lte=date)
         versions = versions.order_by("-pk")
@@ -154,11 +374,80 @@ class VersionManager(models.Manager):
         else:
             return version
 
+    def get_latest_ids_for_date(self, model_or_queryset, date):
+        """
+        Returns a list of (object_id, version_id) pairs, ordered by object id,
+        giving the latest version at or before the given date of every object
+        of the given model (or in the given queryset).  If `date` is None, the
+        latest version of every object is given.
+        
+        This runs a single grouped query.
+        """
+        if isinstance(model_or_queryset, QuerySet):
+            model_class = model_or_queryset.model
+            key_column = get_key_column(model_class)
+            versions = self.filter(**{key_column + "__in": model_or_queryset.values("pk")})
+        else:
+            model_class = model_or_queryset
+            key_column = get_key_column(model_class)
+            versions = self.all()
+        content_type = ContentType.objects.get_for_model(model_class)
+        versions = versions.filter(content_type=content_type)
+        if date is not None:
+            versions = versions.filter(revision__date_created__lte=date)
+        latest_ids = versions.values(key_column).annotate(latest_id=models.Max("pk")).order_by()
+        return sorted([(row[key_column], row["latest_id"]) for row in latest_ids])
+
+    def as_of(self, model_or_queryset, date, chunk_size=100, processes=None):
+        """
+        Yields unsaved instances of every object of the given model (or in the
+        given queryset) as they were at the given date.
+
+        The latest version of each object is selected with a single grouped
+        query, and the versions are then loaded in chunks of `chunk_size`, with
+        the serialized data of each chunk deserialized in a single pass.
+        Objects whose latest version is a deletion are skipped.
+
+        If `processes`, or the REVERSION_DESERIALIZE_PROCESSES setting, is more
+        than one, chunks are deserialized in a pool of that many worker
+        processes while the next chunks are fetched.
+        """
+        from reversion.stream import DeserializerPool, build_instance, deserialize_chunk, get_process_count
+        if isinstance(model_or_queryset, QuerySet):
+            model_class = model_or_queryset.model
+        else:
+            model_class = model_or_queryset
+        key_column = get_key_column(model_class)
+        latest_ids = [version_id for object_id, version_id
+                      in self.get_latest_ids_for_date(model_or_queryset, date)]
+        def iter_chunks():
+            for start in xrange(0, len(latest_ids), chunk_size):
+                chunk = self.filter(pk__in=latest_ids[start:start+chunk_size]).exclude(action_flag=DELETION)
+                yield list(chunk.order_by(key_column).values_list("format", "serialized_data"))
+        processes = get_process_count(processes)
+        if processes <= 1:
+            for rows in iter_chunks():
+                for field_dict in deserialize_chunk(rows):
+                    yield build_instance(model_class, field_dict)
+            return
+        pool = DeserializerPool(processes)
+        try:
+            for rows in iter_chunks():
+                pool.submit(None, rows)
+                if pool.is_full():
+                    for field_dict in pool.get()[1]:
+                        yield build_instance(model_class, field_dict)
+            while pool.has_pending():
+                for field_dict in pool.get()[1]:
+                    yield build_instance(model_class, field_dict)
+        finally:
+            pool.close()
+
     def get_previous(self, version):
         """Get the previous version of a given version."""
-        versions = self.filter(content_type=version.content_type,
-                               object_id=version.object_id,
-                               pk__lt=version.pk)
+        versions = self.filter(content_type=version.content_type_id,
+                               pk__lt=version.pk,
+                               **version.get_key_lookup())
         versions = versions.order_by("-pk")
         try:
             version = versions[0]
@@ -169,10 +458,10 @@ class VersionManager(models.Manager):
     
     def get_next(self, version):
         """Get the next version of a given version."""
-        versions = self.filter(content_type=version.content_type,
-                               object_id=version.object_id,
-                               pk__gt=version.pk)
-        versions = versions.order_by("-pk")
+        versions = self.filter(content_type=version.content_type_id,
+                               pk__gt=version.pk,
+                               **version.get_key_lookup())
+        versions = versions.order_by("pk")
         try:
             version = versions[0]
         except IndexError:
@@ -180,6 +469,94 @@ class VersionManager(models.Manager):
         else:
             return version
 
+    def _get_neighbour_rows(self, versions, use_window):
+        """
+        Returns (version_id, previous_id, previous_date, next_id, next_date)
+        rows for the given versions, which all store their keys in the same
+        column.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        revision_opts = opts.get_field("revision").rel.to._meta
+        key_column = versions[0].object_id is None and "object_key" or "object_id"
+        version_ids = [version.pk for version in versions]
+        # Select every version of the objects, so that the neighbours of the
+        # given versions are found.
+        lookups = {}
+        for version in versions:
+            lookups.setdefault(version.content_type_id, set()).add(getattr(version, key_column))
+        objects = reduce(operator.or_, [models.Q(content_type=content_type_id, **{key_column + "__in": list(object_ids)})
+                                        for content_type_id, object_ids in lookups.items()])
+        object_sql, object_params = self.filter(objects).values_list("pk").query.get_compiler(self.db).as_sql()
+        names = {"version": qn(opts.db_table),
+                 "revision": qn(revision_opts.db_table),
+                 "id": qn(opts.pk.column),
+                 "revision_id": qn(opts.get_field("revision").column),
+                 "revision_pk": qn(revision_opts.pk.column),
+                 "content_type_id": qn(opts.get_field("content_type").column),
+                 "key": qn(key_column),
+                 "date_created": qn(revision_opts.get_field("date_created").column),
+                 "objects": object_sql,
+                 "version_ids": ", ".join(["%s"] * len(version_ids))}
+        cursor = connection.cursor()
+        if use_window:
+            names["window"] = "OVER (PARTITION BY v.%(content_type_id)s, v.%(key)s ORDER BY v.%(id)s)" % names
+            cursor.execute("SELECT n.id, n.previous_id, n.previous_date, n.next_id, n.next_date FROM ("
+                           "SELECT v.%(id)s AS id, "
+                           "LAG(v.%(id)s) %(window)s AS previous_id, "
+                           "LAG(r.%(date_created)s) %(window)s AS previous_date, "
+                           "LEAD(v.%(id)s) %(window)s AS next_id, "
+                           "LEAD(r.%(date_created)s) %(window)s AS next_date "
+                           "FROM %(version)s v INNER JOIN %(revision)s r ON r.%(revision_pk)s = v.%(revision_id)s "
+                           "WHERE v.%(id)s IN (%(objects)s)"
+                           ") n WHERE n.id IN (%(version_ids)s)" % names,
+                           list(object_params) + version_ids)
+            return cursor.fetchall()
+        # Without window functions, find the neighbouring version ids with a
+        # grouped self-join in each direction, and then their dates.
+        neighbour_ids = {}
+        for aggregate, comparison in (("MAX", "<"), ("MIN", ">")):
+            cursor.execute("SELECT v.%%(id)s, %s(o.%%(id)s) FROM %%(version)s v "
+                           "LEFT OUTER JOIN %%(version)s o ON o.%%(content_type_id)s = v.%%(content_type_id)s "
+                           "AND o.%%(key)s = v.%%(key)s AND o.%%(id)s %s v.%%(id)s "
+                           "WHERE v.%%(id)s IN (%%(version_ids)s) GROUP BY v.%%(id)s" % (aggregate, comparison) % names,
+                           version_ids)
+            for version_id, neighbour_id in cursor.fetchall():
+                neighbour_ids.setdefault(version_id, []).append(neighbour_id)
+        dates = dict(self.filter(pk__in=[neighbour_id for ids in neighbour_ids.values() for neighbour_id in ids
+                                         if neighbour_id is not None]).values_list("pk", "revision__date_created"))
+        return [(version_id, previous_id, dates.get(previous_id), next_id, dates.get(next_id))
+                for version_id, (previous_id, next_id) in neighbour_ids.items()]
+
+    def annotate_neighbours(self, versions, use_window=None):
+        """
+        Sets the previous_version_id, previous_revision_date, next_version_id
+        and next_revision_date attributes of the given list or queryset of
+        versions, and returns them as a list.
+
+        The neighbours are found with a single query using window functions,
+        where the database supports them, and with a constant number of
+        grouped queries elsewhere.
+        """
+        versions = list(versions)
+        if use_window is None:
+            use_window = supports_window_functions(connections[self.db])
+        by_column = {}
+        for version in versions:
+            by_column.setdefault(version.object_id is None, []).append(version)
+        neighbours = {}
+        for column_versions in by_column.values():
+            for start in xrange(0, len(column_versions), self.NEIGHBOUR_CHUNK_SIZE):
+                for version_id, previous_id, previous_date, next_id, next_date in self._get_neighbour_rows(
+                        column_versions[start:start+self.NEIGHBOUR_CHUNK_SIZE], use_window):
+                    neighbours[version_id] = (previous_id, _to_datetime(previous_date),
+                                              next_id, _to_datetime(next_date))
+        for version in versions:
+            (version.previous_version_id, version.previous_revision_date,
+             version.next_version_id, version.next_revision_date) = neighbours.get(version.pk, (None, None, None, None))
+        return versions
+
     def get_deleted_object(self, model_class, object_id, select_related=None):
         """
         Returns the version corresponding to the deletion of the object with
@@ -192,11 +569,8 @@ class VersionManager(models.Manager):
         select_related = select_related or ()
         if not "revision" in select_related:
             select_related = tuple(select_related) + ("revision",)
-        # Fetch the version.
-        content_type = ContentType.objects.get_for_model(model_class)
-        object_id = unicode(object_id)
-        versions = self.filter(content_type=content_type, object_id=object_id)
-        versions = versions.order_by("-pk")
+        # Fetch the latest version through the head of the object.
+        versions = self.filter(**self._get_head_lookup(model_class, object_id))
         if select_related:
             versions = versions.select_related(*select_related)
         try:
@@ -213,16 +587,48 @@ class VersionManager(models.Manager):
         You can specify a tuple of related fields to fetch using the
         `select_related` argument.
         """
+        # Ensure that the revision is in the select_related tuple.
+        select_related = select_related or ()
+        if not "revision" in select_related:
+            select_related = tuple(select_related) + ("revision",)
+        from reversion.models import VersionHead
         content_type = ContentType.objects.get_for_model(model_class)
+        key_column = get_key_column(model_class)
+        # Find the latest version of each object that no longer exists from
+        # the version heads, joined against the model table in the database.
+        # The is_deleted flag of the heads is not enough on its own: objects
+        # deleted outside of a revision have no deletion version to set it,
+        # and objects recovered by reverting a version keep it set until their
+        # next revision.
+        heads = VersionHead.objects.filter(content_type=content_type)
+        heads = heads.exclude(**{key_column + "__in": model_class._default_manager.values("pk")})
+        deleted_ids = list(heads.values_list("version", flat=True))
+        # Load the deleted versions in chunks, to stay within the query parameter limits.
         deleted = []
-        # HACK: This join can't be done in the database, due to incompatibilities
-        # between unicode object_ids and integer pks on strict backends like postgres.
-        for object_id in self.filter(content_type=content_type).values_list("object_id", flat=True).distinct().iterator():
-            if model_class._default_manager.filter(pk=object_id).count() == 0:
-                deleted.append(self.get_deleted_object(model_class, object_id, select_related))
+        for start in xrange(0, len(deleted_ids), self.DELETED_CHUNK_SIZE):
+            deleted.extend(self.filter(pk__in=deleted_ids[start:start+self.DELETED_CHUNK_SIZE]).select_related(*select_related))
         deleted.sort(lambda a, b: cmp(a.revision.date_created, b.revision.date_created))
         return deleted
         
+    def search(self, query, model=None, limit=50):
+        """
+        Returns the versions matching all the words of the given query in the
+        search index, most relevant first.
+        
+        If a model class, or a list of model classes, is given, only versions
+        of those models are returned.
+        """
+        from reversion import search
+        content_type_ids = None
+        if model is not None:
+            if isinstance(model, type):
+                model = (model,)
+            content_type_ids = [ContentType.objects.get_for_model(model_class).pk for model_class in model]
+        version_ids = search.get_search_backend().search(query, content_type_ids, limit)
+        # Versions removed since they were indexed are left out.
+        versions = self.select_related("revision").in_bulk(version_ids)
+        return [versions[version_id] for version_id in version_ids if version_id in versions]
+
     def diff_ver(self, version):
         #diff = self.diff(obj=version.get_object_version().object, limit=2, 
         #                 topver=version)
@@ -243,7 +649,7 @@ class VersionManager(models.Manager):
             cts.append(ContentType.objects.get_for_model(obj))
             for parent_class in obj._meta.get_parent_list():
                 cts.append(ContentType.objects.get_for_model(parent_class))
-            q = q.filter(object_id=obj.id, content_type__in=cts).values('revision_id')
+            q = q.filter(content_type__in=cts, **get_key_values(obj.__class__, obj.pk)).values('revision_id')
         else:
             q = q.values('revision_id')
             q.query.group_by = ['revision_id']
@@ -255,8 +661,8 @@ class VersionManager(models.Manager):
         subq = s[0] % s[1]
         # Generate the master query joined to the subquery.
         # XXX: Needs the extra-join Django patch.
-        q = self.select_related().order_by('object_id', 'content_type__id', 
-                                           '-pk')
+        q = self.select_related().order_by('object_id', 'object_key',
+                                           'content_type__id', '-pk')
         versions = q.select_related().extra(
             join=['INNER JOIN (%s) AS dt on dt.`revision_id` = '
                   '`reversion_version`.`revision_id`' % subq]
@@ -292,7 +698,7 @@ class VersionManager(models.Manager):
             if v.is_change():
                 try:
                     prev_ver = versions_list[i + 1]
-                    if v.object_id != prev_ver.object_id or \
+                    if v.object_pk != prev_ver.object_pk or \
                        v.content_type_id != prev_ver.content_type_id:
                         prev_ver = None
                         vdiff['_type'] = 'Add or Change'
@@ -306,13 +712,493 @@ class VersionManager(models.Manager):
 
         return revisions
 
-class RevisionManager(models.Manager):
+class VersionHeadManager(BulkInsertManager):
+    
+    """Manager for VersionHead models."""
+    
+    # The number of heads looked up by each query of record_revisions().
+    HEAD_CHUNK_SIZE = 500
+    
+    def _get_existing_heads(self, keys):
+        """
+        Returns a dictionary mapping the given (content_type_id, object_id,
+        object_key) tuples to the (head_id, version_id) of their existing
+        heads.
+        """
+        existing = {}
+        for start in xrange(0, len(keys), self.HEAD_CHUNK_SIZE):
+            # Look up each chunk with one query, whatever the models involved.
+            lookups = {}
+            for content_type_id, object_id, object_key in keys[start:start+self.HEAD_CHUNK_SIZE]:
+                if object_id is None:
+                    lookups.setdefault((content_type_id, "object_key"), []).append(object_key)
+                else:
+                    lookups.setdefault((content_type_id, "object_id"), []).append(object_id)
+            query = reduce(operator.or_, [models.Q(content_type=content_type_id, **{column + "__in": object_ids})
+                                          for (content_type_id, column), object_ids in lookups.items()])
+            for head_id, version_id, content_type_id, object_id, object_key in self.filter(query).values_list(
+                    "pk", "version", "content_type", "object_id", "object_key"):
+                existing[(content_type_id, object_id, object_key)] = (head_id, version_id)
+        return existing
+    
+    def _update_many(self, updates):
+        """
+        Updates existing heads with a single statement, given a list of
+        (head_id, version_id, added_count, revision_date, is_deleted) tuples.
+        
+        The versions are always counted, but a head is only moved to a version
+        that is newer than its current version, so that a writer that commits
+        after a writer of newer versions cannot move the head back.
+        """
+        if not updates:
+            return
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        version_column = qn(opts.get_field("version").column)
+        count_column = qn(opts.get_field("version_count").column)
+        date_column = qn(opts.get_field("revision_date").column)
+        deleted_column = qn(opts.get_field("is_deleted").column)
+        # The version column is set last, since MySQL evaluates assignments
+        # from left to right.
+        sql = ("UPDATE %(table)s SET %(count)s = %(count)s + %%s, "
+               "%(date)s = CASE WHEN %(version)s < %%s THEN %%s ELSE %(date)s END, "
+               "%(deleted)s = CASE WHEN %(version)s < %%s THEN %%s ELSE %(deleted)s END, "
+               "%(version)s = CASE WHEN %(version)s < %%s THEN %%s ELSE %(version)s END "
+               "WHERE %(id)s = %%s") % {"table": qn(opts.db_table),
+                                        "version": version_column,
+                                        "count": count_column,
+                                        "date": date_column,
+                                        "deleted": deleted_column,
+                                        "id": qn(opts.pk.column)}
+        date_field = opts.get_field("revision_date")
+        deleted_field = opts.get_field("is_deleted")
+        params = [(added_count,
+                   version_id, date_field.get_db_prep_save(revision_date, connection=connection),
+                   version_id, deleted_field.get_db_prep_save(is_deleted, connection=connection),
+                   version_id, version_id,
+                   head_id)
+                  for head_id, version_id, added_count, revision_date, is_deleted in updates]
+        connection.cursor().executemany(sql, params)
+        transaction.commit_unless_managed(using=self.db)
+    
+    def _insert_many_heads(self, heads):
+        """
+        Inserts the given new heads.  Heads of the same objects that have been
+        created by concurrent writers since they were looked up are updated
+        instead.
+        """
+        if not heads:
+            return
+        sid = transaction.savepoint(using=self.db)
+        try:
+            self.insert_many(heads)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=self.db)
+        else:
+            transaction.savepoint_commit(sid, using=self.db)
+            return
+        # Databases without savepoints may have inserted some of the heads
+        # before the error, which are recognised by their version.
+        keys = [(head.content_type_id, head.object_id, head.object_key) for head in heads]
+        existing = self._get_existing_heads(keys)
+        updates = []
+        remaining = []
+        for key, head in zip(keys, heads):
+            if key not in existing:
+                remaining.append(head)
+            elif existing[key][1] != head.version_id:
+                updates.append((existing[key][0], head.version_id, head.version_count, head.revision_date, head.is_deleted))
+        self._update_many(updates)
+        self._insert_many_heads(remaining)
+    
+    def record_versions(self, versions):
+        """
+        Updates the heads of the objects of the given newly saved versions.
+        
+        The versions are either a queryset, or a list of versions whose
+        primary key and revision have been set.  This runs a constant number
+        of queries for any number of versions.
+        """
+        if isinstance(versions, QuerySet):
+            rows = versions.order_by("pk").values_list(
+                "pk", "revision__date_created", "content_type", "object_id", "object_key", "action_flag")
+        else:
+            rows = sorted([(version.pk, version.revision.date_created, version.content_type_id,
+                            version.object_id, version.object_key, version.action_flag)
+                           for version in versions])
+        # Find the latest version of each object, and count its new versions.
+        changes = {}
+        for version_id, revision_date, content_type_id, object_id, object_key, action_flag in rows:
+            if object_id is not None:
+                object_key = None
+            key = (content_type_id, object_id, object_key)
+            added_count = key in changes and changes[key][1] or 0
+            changes[key] = (version_id, added_count + 1, revision_date, action_flag == DELETION)
+        if not changes:
+            return
+        existing = self._get_existing_heads(changes.keys())
+        updates = []
+        heads = []
+        for key, (version_id, added_count, revision_date, is_deleted) in changes.iteritems():
+            if key in existing:
+                updates.append((existing[key][0], version_id, added_count, revision_date, is_deleted))
+            else:
+                content_type_id, object_id, object_key = key
+                heads.append(self.model(content_type_id=content_type_id,
+                                        object_id=object_id,
+                                        object_key=object_key,
+                                        version_id=version_id,
+                                        version_count=added_count,
+                                        revision_date=revision_date,
+                                        is_deleted=is_deleted))
+        self._update_many(updates)
+        self._insert_many_heads(heads)
+    
+    def rebuild(self, chunk_size=500):
+        """
+        Rebuilds the heads of all objects from the versions table.
+        
+        This is only needed to create heads for existing versions, or after
+        versions have been deleted.
+        """
+        from reversion.models import Version
+        self.all().delete()
+        self._create_heads(Version.objects.all(), chunk_size)
+    
+    def rebuild_objects(self, keys, chunk_size=500):
+        """
+        Rebuilds the heads of the objects with the given (content_type_id,
+        object_id, object_key) keys, after some of their versions have been
+        deleted.
+        """
+        from reversion.models import Version
+        keys = list(keys)
+        for start in xrange(0, len(keys), self.HEAD_CHUNK_SIZE):
+            chunk = [(content_type_id, object_id, object_id is None and object_key or None)
+                     for content_type_id, object_id, object_key in keys[start:start+self.HEAD_CHUNK_SIZE]]
+            self.filter(pk__in=[head_id for head_id, version_id in self._get_existing_heads(chunk).values()]).delete()
+            query = reduce(operator.or_, [models.Q(content_type=content_type_id, object_id=object_id)
+                                          if object_id is not None else
+                                          models.Q(content_type=content_type_id, object_key=object_key)
+                                          for content_type_id, object_id, object_key in chunk])
+            self._create_heads(Version.objects.filter(query), chunk_size)
+    
+    def _create_heads(self, versions, chunk_size):
+        """Creates the heads of the objects of the given queryset of versions."""
+        from reversion.models import Version
+        latest = versions.values_list("content_type", "object_id", "object_key")
+        latest = list(latest.annotate(latest_id=models.Max("pk")).annotate(version_count=models.Count("pk")).order_by())
+        for start in xrange(0, len(latest), chunk_size):
+            chunk = latest[start:start+chunk_size]
+            latest_versions = dict([(version_id, (revision_date, action_flag)) for version_id, revision_date, action_flag
+                             in Version.objects.filter(pk__in=[row[3] for row in chunk]).values_list(
+                                 "pk", "revision__date_created", "action_flag")])
+            heads = []
+            for content_type_id, object_id, object_key, version_id, version_count in chunk:
+                revision_date, action_flag = latest_versions[version_id]
+                heads.append(self.model(content_type_id=content_type_id,
+                                        object_id=object_id,
+                                        object_key=object_id is None and object_key or None,
+                                        version_id=version_id,
+                                        version_count=version_count,
+                                        revision_date=revision_date,
+                                        is_deleted=action_flag == DELETION))
+            self.insert_many(heads)
+
+
+class ActivityRollupManager(BulkInsertManager):
+    
+    """Manager for ActivityRollup models."""
+    
+    # The number of rollups looked up by each query of _add_counts().
+    ROLLUP_CHUNK_SIZE = 300
+    
+    # The number of rollups inserted by each statement of _insert_many_rollups().
+    INSERT_CHUNK_SIZE = 100
+    
+    # The position of each kind of version in a tuple of counts.
+    COUNT_POSITIONS = {ADDITION: 0, CHANGE: 1, DELETION: 2}
+    
+    def _add_counts(self, counts):
+        """
+        Adds the given dictionary, mapping (day, user_id, content_type_id)
+        tuples to lists of [additions, changes, deletions], to the rollups.
+        """
+        keys = counts.keys()
+        existing = {}
+        for start in xrange(0, len(keys), self.ROLLUP_CHUNK_SIZE):
+            lookups = {}
+            for day, user_id, content_type_id in keys[start:start+self.ROLLUP_CHUNK_SIZE]:
+                lookups.setdefault((day, user_id), []).append(content_type_id)
+            query = reduce(operator.or_, [models.Q(day=day, user=user_id, content_type__in=content_type_ids)
+                                          for (day, user_id), content_type_ids in lookups.items()])
+            for rollup_id, day, user_id, content_type_id in self.filter(query).values_list(
+                    "pk", "day", "user", "content_type"):
+                existing[(day, user_id, content_type_id)] = rollup_id
+        updates = []
+        rollups = []
+        for key, (additions, changes, deletions) in counts.iteritems():
+            if key in existing:
+                updates.append((additions, changes, deletions, existing[key]))
+            else:
+                day, user_id, content_type_id = key
+                rollups.append(self.model(day=day,
+                                          user_id=user_id,
+                                          content_type_id=content_type_id,
+                                          addition_count=additions,
+                                          change_count=changes,
+                                          deletion_count=deletions))
+        if updates:
+            connection = connections[self.db]
+            qn = connection.ops.quote_name
+            opts = self.model._meta
+            columns = [qn(opts.get_field(name).column) for name in ("addition_count", "change_count", "deletion_count")]
+            sql = "UPDATE %s SET %s WHERE %s = %%s" % (qn(opts.db_table),
+                                                       ", ".join(["%s = %s + %%s" % (column, column) for column in columns]),
+                                                       qn(opts.pk.column))
+            connection.cursor().executemany(sql, updates)
+            transaction.commit_unless_managed(using=self.db)
+        self._insert_many_rollups(rollups)
+    
+    def _insert_many_rollups(self, rollups):
+        """
+        Inserts the given new rollups.  The counts of rollups that have been
+        created by concurrent writers since they were looked up are added to
+        their rollups instead.
+        """
+        for start in xrange(0, len(rollups), self.INSERT_CHUNK_SIZE):
+            chunk = rollups[start:start+self.INSERT_CHUNK_SIZE]
+            # Each chunk is inserted by a single statement, so none of it is
+            # inserted if any of its rollups already exists.
+            sid = transaction.savepoint(using=self.db)
+            try:
+                self.insert_rows(chunk)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=self.db)
+                self._add_counts(dict([((rollup.day, rollup.user_id, rollup.content_type_id),
+                                        [rollup.addition_count, rollup.change_count, rollup.deletion_count])
+                                       for rollup in chunk]))
+            else:
+                transaction.savepoint_commit(sid, using=self.db)
+    
+    def record_versions(self, versions):
+        """
+        Adds the given newly saved versions to the rollups.
+        
+        The versions are either a queryset, or a list of versions whose
+        revision has been set.  This runs a constant number of queries for any
+        number of versions.
+        """
+        if isinstance(versions, QuerySet):
+            rows = versions.values_list("revision__date_created", "revision__user", "content_type", "action_flag").order_by()
+        else:
+            rows = [(version.revision.date_created, version.revision.user_id, version.content_type_id, version.action_flag)
+                    for version in versions]
+        counts = {}
+        for date_created, user_id, content_type_id, action_flag in rows:
+            key = (date_created.date(), user_id, content_type_id)
+            counts.setdefault(key, [0, 0, 0])[self.COUNT_POSITIONS[action_flag]] += 1
+        if counts:
+            self._add_counts(counts)
+    
+    @transaction.commit_on_success
+    def _rebuild_range(self, start, end):
+        """Rebuilds the rollups of the days from start up to, but not including, end."""
+        from reversion.models import Version
+        self.filter(day__gte=start, day__lt=end).delete()
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        revision_opts = Version._meta.get_field("revision").rel.to._meta
+        date_column = "%s.%s" % (qn(revision_opts.db_table), qn(revision_opts.get_field("date_created").column))
+        versions = Version.objects.filter(revision__date_created__gte=datetime.combine(start, time()),
+                                          revision__date_created__lt=datetime.combine(end, time()))
+        versions = versions.extra(select={"day": connection.ops.date_trunc_sql("day", date_column)})
+        versions = versions.values("day", "revision__user", "content_type", "action_flag").annotate(
+            version_count=models.Count("pk")).order_by()
+        counts = {}
+        for row in versions:
+            day = _to_datetime(row["day"]).date()
+            key = (day, row["revision__user"], row["content_type"])
+            counts.setdefault(key, [0, 0, 0])[self.COUNT_POSITIONS[row["action_flag"]]] += row["version_count"]
+        rollups = [self.model(day=day,
+                              user_id=user_id,
+                              content_type_id=content_type_id,
+                              addition_count=additions,
+                              change_count=changes,
+                              deletion_count=deletions)
+                   for (day, user_id, content_type_id), (additions, changes, deletions) in counts.iteritems()]
+        for offset in xrange(0, len(rollups), self.ROLLUP_CHUNK_SIZE):
+            self.insert_many(rollups[offset:offset+self.ROLLUP_CHUNK_SIZE])
+        return len(rollups)
+    
+    def rebuild(self, since=None, chunk_days=30, callback=None):
+        """
+        Rebuilds the rollups of the days from the given date onwards, or of
+        all days, from the existing revisions.
+        
+        Each range of `chunk_days` days is rebuilt in its own transaction, and
+        `callback` is then called with the last day rebuilt.  Returns the
+        number of rollups created.
+        """
+        from reversion.models import Revision
+        revisions = Revision.objects.all()
+        if since is not None:
+            revisions = revisions.filter(date_created__gte=datetime.combine(since, time()))
+        dates = revisions.aggregate(first=models.Min("date_created"), last=models.Max("date_created"))
+        if dates["first"] is None:
+            # There are no revisions to count.
+            if since is None:
+                self.all().delete()
+            else:
+                self.filter(day__gte=since).delete()
+            return 0
+        start = since or dates["first"].date()
+        if since is None:
+            self.filter(day__lt=start).delete()
+        count = 0
+        while start <= dates["last"].date():
+            end = start + timedelta(days=chunk_days)
+            count += self._rebuild_range(start, end)
+            if callback is not None:
+                callback(min(end - timedelta(days=1), dates["last"].date()))
+            start = end
+        # Remove any rollups of days after the last revision.
+        self.filter(day__gte=start).delete()
+        return count
+
+
+class VersionFileManager(BulkInsertManager):
+    
+    """Manager for VersionFile models."""
+    
+    def _get_file_fields(self, content_type_id):
+        """
+        Returns the names of the content addressed file fields of the model
+        with the given content type.
+        """
+        from reversion.revisions import revision
+        from reversion.storage import ContentAddressedStorageWrapper
+        model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model_class is None or not revision.is_registered(model_class):
+            return ()
+        return [field.name for field in revision.get_registration_info(model_class).file_fields
+                if isinstance(field.storage, ContentAddressedStorageWrapper)]
+    
+    def record_versions(self, versions, replace=False):
+        """
+        Records the content addressed files referenced by the given saved
+        versions, of any model.  If `replace` is true, the existing references
+        of the versions are replaced.
+        
+        Only versions of models with content addressed file fields are
+        deserialized.
+        """
+        from reversion.stream import deserialize_chunk
+        fields_by_content_type = {}
+        versions_with_files = []
+        for version in versions:
+            if version.content_type_id not in fields_by_content_type:
+                fields_by_content_type[version.content_type_id] = self._get_file_fields(version.content_type_id)
+            if fields_by_content_type[version.content_type_id]:
+                versions_with_files.append(version)
+        if not versions_with_files:
+            return
+        if replace:
+            self.filter(version__in=[version.pk for version in versions_with_files]).delete()
+        field_dicts = deserialize_chunk([(version.format, version.serialized_data)
+                                         for version in versions_with_files])
+        references = []
+        for version, field_dict in zip(versions_with_files, field_dicts):
+            names = set()
+            for field_name in fields_by_content_type[version.content_type_id]:
+                value = field_dict.get(field_name)
+                if isinstance(value, FieldFile):
+                    value = value.name
+                if value:
+                    names.add(value)
+            references.extend([self.model(version_id=version.pk, name=name) for name in names])
+        self.insert_many(references)
+
+
+class VersionedQuerySet(QuerySet):
+    
+    """A QuerySet whose updates and deletions are added to the current revision."""
+    
+    def update(self, **kwargs):
+        """Updates the objects, adding them to the current revision, if any."""
+        from reversion.revisions import revision
+        return revision.bulk_update(self, **kwargs)
+    update.alters_data = True
+    
+    def delete(self):
+        """Deletes the objects, adding them to the current revision, if any."""
+        from reversion.revisions import revision
+        revision.bulk_delete(self)
+        # Clear the result cache, in case this QuerySet gets reused.
+        self._result_cache = None
+    delete.alters_data = True
+
+
+class VersionedManager(models.Manager):
+    
+    """A manager for registered models whose queryset updates and deletions are versioned."""
+    
+    def get_query_set(self):
+        """Returns a VersionedQuerySet."""
+        return VersionedQuerySet(self.model, using=self._db)
+
+
+class RevisionManager(BulkInsertManager):
+    
+    """Manager for Revision models."""
+    
+    # The number of source keys looked up by each query of assign_pks().
+    SOURCE_KEY_CHUNK_SIZE = 500
+    
+    def assign_pks(self, revisions):
+        """
+        Sets the primary keys of the given revisions, which have just been
+        inserted by insert_many(), matching each revision by its source key.
+        """
+        unsaved = dict([(revision.source_key, revision) for revision in revisions if revision.pk is None])
+        source_keys = unsaved.keys()
+        for start in xrange(0, len(source_keys), self.SOURCE_KEY_CHUNK_SIZE):
+            rows = self.filter(source_key__in=source_keys[start:start+self.SOURCE_KEY_CHUNK_SIZE]).values_list("pk", "source_key")
+            for pk, source_key in rows:
+                unsaved[source_key].id = pk
+    
+    def get_activity(self, start=None, end=None, user=None, model=None,
+                     group_by=("day", "user", "content_type")):
+        """
+        Returns the number of additions, changes and deletions made between
+        the given days, read from the activity rollups.
+        
+        The result is a values queryset of dictionaries holding the given
+        `group_by` fields of the rollups, and the summed "additions",
+        "changes" and "deletions".  It can be filtered by user and model.
+        """
+        from reversion.models import ActivityRollup
+        rollups = ActivityRollup.objects.all()
+        if start is not None:
+            rollups = rollups.filter(day__gte=start)
+        if end is not None:
+            rollups = rollups.filter(day__lte=end)
+        if user is not None:
+            rollups = rollups.filter(user=user)
+        if model is not None:
+            rollups = rollups.filter(content_type=ContentType.objects.get_for_model(model))
+        rollups = rollups.values(*group_by).annotate(additions=models.Sum("addition_count"),
+                                                     changes=models.Sum("change_count"),
+                                                     deletions=models.Sum("deletion_count"))
+        return rollups.order_by(*group_by)
     
     def get_for_object(self, obj):
         content_type = ContentType.objects.get_for_model(obj)
-        object_id = unicode(obj.id)
+        key_values = get_key_values(obj.__class__, obj.pk)
 
         revisions = self.filter(version__content_type=content_type, 
-                                version__object_id=object_id)
+                                **dict([("version__" + name, value)
+                                        for name, value in key_values.items()]))
         revisions = revisions.order_by("-pk")
         return revisions
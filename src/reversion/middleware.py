@@ -23,5 +23,28 @@ class RevisionMiddleware(object):
     def process_exception(self, request, exception):
         """Closes the revision."""
         reversion.revision.invalidate()
-        
-        
\ No newline at end of file
+
+
+class LazyRevisionMiddleware(object):
+    
+    """
+    Wraps the request in a revision that is only started when a registered
+    model is saved or deleted.
+    
+    Requests that do not change any registered models never start a revision
+    or look up the request user.
+    """
+    
+    def process_request(self, request):
+        """Defers a revision for the request."""
+        reversion.revision.defer(request)
+    
+    def process_response(self, request, response):
+        """Closes the revision, if it was started."""
+        reversion.revision.end_deferred()
+        return response
+    
+    def process_exception(self, request, exception):
+        """Invalidates the revision, if it was started."""
+        if reversion.revision.is_active():
+            reversion.revision.invalidate()
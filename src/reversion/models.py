@@ -5,12 +5,12 @@ from django.contrib.admin.models import ADDITION, CHANGE, DELETION
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.core import serializers
-from django.db import models, IntegrityError
+from django.db import models, transaction, IntegrityError
 from django.db.models import Count
 
 
 import reversion
-from reversion.managers import VersionManager, RevisionManager
+from reversion.managers import VersionManager, VersionHeadManager, RevisionManager, ActivityRollupManager, VersionFileManager, get_key_values
 from reversion.errors import RevertError
 
 ACTIONS = (
@@ -19,6 +19,38 @@ ACTIONS = (
     (DELETION, 'Delete'),
 )
 
+def _sort_by_dependencies(object_versions):
+    """
+    Sorts the given deserialized objects so that the models they depend on via
+    foreign keys and many-to-many relations come first.
+    
+    Models involved in a dependency cycle keep their original relative order.
+    """
+    model_classes = []
+    for object_version in object_versions:
+        model_class = object_version.object.__class__
+        if not model_class in model_classes:
+            model_classes.append(model_class)
+    dependencies = {}
+    for model_class in model_classes:
+        opts = model_class._meta
+        dependencies[model_class] = set([field.rel.to for field in opts.fields + opts.many_to_many
+                                         if field.rel and field.rel.to in model_classes
+                                         and field.rel.to is not model_class])
+    ordered_models = []
+    while model_classes:
+        ready = [model_class for model_class in model_classes
+                 if not dependencies[model_class].difference(ordered_models)]
+        if not ready:
+            # Dependency cycle, so fall back to the original order.
+            ready = model_classes[:1]
+        for model_class in ready:
+            model_classes.remove(model_class)
+            ordered_models.append(model_class)
+    positions = dict([(model_class, position) for position, model_class in enumerate(ordered_models)])
+    return sorted(object_versions, key=lambda object_version: positions[object_version.object.__class__])
+
+
 class Revision(models.Model):
     
     """A group of related object versions."""
@@ -26,6 +58,7 @@ class Revision(models.Model):
     objects = RevisionManager()
     
     date_created = models.DateTimeField(auto_now_add=True,
+                                        db_index=True,
                                         help_text="The date and time this revision was created.")
 
     user = models.ForeignKey(User,
@@ -36,31 +69,62 @@ class Revision(models.Model):
     comment = models.TextField(blank=True,
                                help_text="A text comment on this revision.")
     
+    source_key = models.CharField(max_length=255,
+                                  blank=True,
+                                  null=True,
+                                  unique=True,
+                                  help_text="A key of the record this revision was copied from, such as an imported revision, so that it is only copied once.")
+    
     def revert(self, delete=False):
-        """Reverts all objects in this revision."""
-        # Attempt to revert all revisions.
-        def do_revert(versions):
-            unreverted_versions = []
-            for version in versions:
-                try:
-                    version.revert()
-                except IntegrityError:
-                    unreverted_versions.append(version)
-            if len(unreverted_versions) == len(versions):
-                raise RevertError("Could not revert revision, due to database integrity errors.")
-            if unreverted_versions:
-                   do_revert(unreverted_versions)
-        do_revert(self.version_set.all())
+        """
+        Reverts all objects in this revision.
+        
+        Objects are saved in the dependency order of their models, so that
+        related objects exist before the objects that refer to them.
+        
+        Outside a managed transaction, the revert runs in a transaction of its
+        own, and nothing is reverted if any object cannot be saved.  Inside a
+        managed transaction, the caller must roll back its transaction if the
+        revert fails, since savepoints are not supported by every database.
+        """
+        if transaction.is_managed():
+            self._revert(delete)
+        else:
+            transaction.commit_on_success(self._revert)(delete)
+    
+    def _revert(self, delete):
+        """Reverts all objects in this revision, within a managed transaction."""
+        versions = list(self.version_set.all())
+        object_versions = [version.object_version for version in versions]
+        object_versions = _sort_by_dependencies(object_versions)
+        # The savepoint lets the caller continue its transaction after an
+        # integrity error, on databases that support savepoints.
+        sid = transaction.savepoint()
+        try:
+            for object_version in object_versions:
+                object_version.save()
+        except IntegrityError, e:
+            transaction.savepoint_rollback(sid)
+            raise RevertError("Could not revert revision, due to database integrity errors: %s" % e)
+        transaction.savepoint_commit(sid)
         # Optionally delete objects no longer in the current revision.
         if delete:
-            # Get a set of all objects in this revision.
-            old_revision_set = [ContentType.objects.get_for_id(version.content_type_id).get_object_for_this_type(pk=version.object_id)
-                                    for version in versions]
+            # Get a set of all objects in this revision, with one query per model.
+            old_object_ids = {}
+            for version in versions:
+                old_object_ids.setdefault(version.content_type_id, []).append(version.object_pk)
+            old_revision_set = []
+            old_revision_keys = set()
+            for content_type_id, object_ids in old_object_ids.iteritems():
+                model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+                for obj in model_class._default_manager.filter(pk__in=object_ids):
+                    old_revision_set.append(obj)
+                    old_revision_keys.add((model_class, unicode(obj.pk)))
             # Calculate the set of all objects that are in the revision now.
             current_revision_set = reversion.revision.follow_relationships(old_revision_set)
             # Delete objects that are no longer in the current revision.
             for current_object in current_revision_set:
-                if not current_object in old_revision_set:
+                if not (current_object.__class__, unicode(current_object.pk)) in old_revision_keys:
                     current_object.delete()
             
     def __unicode__(self):
@@ -90,8 +154,14 @@ class Version(models.Model):
     revision = models.ForeignKey(Revision,
                                  help_text="The revision that contains this version.")
     
-    object_id = models.IntegerField(help_text="Primary key of the model under version control.",
-                                    db_index=True)
+    object_id = models.BigIntegerField(blank=True,
+                                       null=True,
+                                       db_index=True,
+                                       help_text="Primary key of the model under version control, if it is an integer.")
+    
+    object_key = models.CharField(max_length=255,
+                                  blank=True,
+                                  help_text="Primary key of the model under version control, if it is not an integer.")
     
     content_type = models.ForeignKey(ContentType,
                                      help_text="Content type of the model under version control.")
@@ -106,6 +176,21 @@ class Version(models.Model):
     action_flag = models.PositiveSmallIntegerField(choices=ACTIONS, help_text="The action that describes this version.")
     
     
+    def get_object_pk(self):
+        """Returns the primary key of the model under version control."""
+        if self.object_id is None:
+            return self.object_key
+        return self.object_id
+    
+    object_pk = property(get_object_pk,
+                         doc="The primary key of the model under version control.")
+    
+    def get_key_lookup(self):
+        """Returns the field lookups that match the versions of the same object."""
+        if self.object_id is None:
+            return {"object_key": self.object_key}
+        return {"object_id": self.object_id}
+    
     def is_addition(self):
         return self.action_flag == ADDITION
 
@@ -117,7 +202,8 @@ class Version(models.Model):
  
     def get_object_version(self):
         """Returns the stored version of the model."""
-        data = self.serialized_data
+        from reversion.stores import get_version_store
+        data = get_version_store().decode(self.serialized_data)
 
         if isinstance(data, unicode):
             data = data.encode("utf8")
@@ -166,7 +252,7 @@ class Version(models.Model):
                 try:
                     parent_version = Version.objects.get(revision__id=self.revision_id,
                                                          content_type=content_type,
-                                                         object_id=parent_id)
+                                                         **get_key_values(parent_class, parent_id))
                 except parent_class.DoesNotExist:
                     pass
                 else:
@@ -188,3 +274,104 @@ class Version(models.Model):
     def __unicode__(self):
         """Returns a unicode representation."""
         return self.object_repr
+
+
+class VersionHead(models.Model):
+    
+    """
+    The latest version of an object under version control.
+    
+    Heads are maintained when revisions are saved, so that the latest version
+    of an object, and its number of versions, can be read without scanning
+    its versions.
+    """
+    
+    objects = VersionHeadManager()
+    
+    content_type = models.ForeignKey(ContentType,
+                                     help_text="Content type of the model under version control.")
+    
+    object_id = models.BigIntegerField(blank=True,
+                                       null=True,
+                                       help_text="Primary key of the model under version control, if it is an integer.")
+    
+    object_key = models.CharField(max_length=255,
+                                  blank=True,
+                                  null=True,
+                                  help_text="Primary key of the model under version control, if it is not an integer.")
+    
+    version = models.ForeignKey(Version,
+                                related_name="heads",
+                                help_text="The latest version of the object.")
+    
+    version_count = models.PositiveIntegerField(help_text="The number of versions of the object.")
+    
+    revision_date = models.DateTimeField(help_text="The date and time of the latest revision of the object.")
+    
+    is_deleted = models.BooleanField(default=False,
+                                     help_text="Whether the latest version of the object is a deletion.")
+    
+    class Meta:
+        unique_together = (("content_type", "object_id"), ("content_type", "object_key"),)
+    
+    def __unicode__(self):
+        """Returns a unicode representation."""
+        return unicode(self.version)
+
+
+class ActivityRollup(models.Model):
+    
+    """
+    The number of versions of a model saved by a user on a day.
+    
+    Rollups are maintained when revisions are saved, so that activity can be
+    reported without scanning revisions and versions.
+    """
+    
+    objects = ActivityRollupManager()
+    
+    day = models.DateField(help_text="The day the versions were saved.")
+    
+    user = models.ForeignKey(User,
+                             blank=True,
+                             null=True,
+                             help_text="The user who saved the versions.")
+    
+    content_type = models.ForeignKey(ContentType,
+                                     help_text="Content type of the model under version control.")
+    
+    addition_count = models.PositiveIntegerField(default=0,
+                                                 help_text="The number of additions.")
+    
+    change_count = models.PositiveIntegerField(default=0,
+                                               help_text="The number of changes.")
+    
+    deletion_count = models.PositiveIntegerField(default=0,
+                                                 help_text="The number of deletions.")
+    
+    class Meta:
+        unique_together = (("day", "user", "content_type"),)
+
+
+class VersionFile(models.Model):
+    
+    """
+    A content addressed file referenced by a version.
+    
+    References are written with their versions, so that unreferenced files
+    can be found without scanning the stored history.
+    """
+    
+    objects = VersionFileManager()
+    
+    version = models.ForeignKey(Version,
+                                related_name="files",
+                                help_text="The version that references the file.")
+    
+    name = models.CharField(max_length=255,
+                            db_index=True,
+                            help_text="The name of the file in its storage.")
+    
+    def __unicode__(self):
+        """Returns a unicode representation."""
+        return self.name
@@ -0,0 +1,149 @@
+"""Point-in-time restoration of many objects at once."""
+
+
+from django.db import transaction
+from django.db.models.query import QuerySet
+from django.utils.encoding import smart_unicode
+
+from reversion.managers import get_key_column, get_key_field
+from reversion.models import Version
+from reversion.revisions import revision
+
+
+# Restore actions.
+
+RESTORE_CHANGE = "change"
+RESTORE_RECOVER = "recover"
+RESTORE_DELETE = "delete"
+
+
+def _field_values(obj, field_names):
+    """Returns the values of the named concrete fields of the given object."""
+    return [field.value_from_object(obj) for field in obj._meta.fields
+            if field.name in field_names]
+
+
+def _get_m2m_values(model_class, field_names, object_ids):
+    """
+    Returns a dictionary mapping each of the given object ids to a dictionary
+    of the sorted related primary keys of its named many-to-many fields, as
+    unicode, as they are deserialized.
+
+    This runs one query per many-to-many field.
+    """
+    result = dict([(object_id, {}) for object_id in object_ids])
+    for field in model_class._meta.many_to_many:
+        if field.name not in field_names:
+            continue
+        for values in result.itervalues():
+            values[field.name] = []
+        source_name = field.m2m_field_name()
+        target_name = field.m2m_reverse_field_name()
+        rows = field.rel.through._default_manager.filter(**{source_name + "__in": object_ids})
+        for source_id, target_id in rows.values_list(source_name, target_name):
+            result[source_id][field.name].append(smart_unicode(target_id))
+    for values in result.itervalues():
+        for related_ids in values.itervalues():
+            related_ids.sort()
+    return result
+
+
+def _has_changed(object_version, current_obj, field_names, m2m_values):
+    """
+    Checks whether the given deserialized object differs from the current
+    object, in its named fields or many-to-many relations.
+    """
+    if _field_values(object_version.object, field_names) != _field_values(current_obj, field_names):
+        return True
+    for name, related_ids in m2m_values.iteritems():
+        if name in object_version.m2m_data and sorted(map(smart_unicode, object_version.m2m_data[name])) != related_ids:
+            return True
+    return False
+
+
+def restore(model_or_queryset, date, dry_run=False, delete=False,
+            chunk_size=100, resume_after=None, comment=u"", callback=None):
+    """
+    Restores every object of the given model (or in the given queryset) to
+    its state at the given date.
+
+    The versions to restore are found with a single grouped query, and the
+    current objects are loaded with one query per chunk.  Each chunk of
+    `chunk_size` objects is restored in its own transaction and revision.
+
+    Objects are compared on their registered fields and many-to-many
+    relations.  Objects that were deleted at the given date, or that were
+    created after it, are only deleted if `delete` is True.  Objects without
+    any versions are never deleted, since when they were created is not known.
+    If `dry_run` is True, nothing is written to the database.
+
+    If a queryset is given, only objects that currently exist in it are
+    restored, so objects deleted since the given date are not recovered.
+    Pass the model to recover them.
+
+    Objects are processed in order of primary key, so an interrupted restore
+    can be resumed by passing the last reported object id as `resume_after`.
+    After each chunk, `callback` is called with the number of objects
+    processed, the total number of objects and the last object id.
+
+    Returns a list of (action, version) pairs describing the changes that were
+    (or, for a dry run, would be) made.
+    """
+    if isinstance(model_or_queryset, QuerySet):
+        model_class = model_or_queryset.model
+    else:
+        model_class = model_or_queryset
+    field_names = revision.get_registration_info(model_class).fields
+    key_column = get_key_column(model_class)
+    latest_ids = Version.objects.get_latest_ids_for_date(model_or_queryset, date)
+    created_version_ids = set()
+    if delete:
+        # Objects without a version at the date were created after it, and
+        # are paired with their latest version.
+        existing_ids = set([object_id for object_id, version_id in latest_ids])
+        created_ids = [(object_id, version_id) for object_id, version_id
+                       in Version.objects.get_latest_ids_for_date(model_or_queryset, None)
+                       if object_id not in existing_ids]
+        created_version_ids.update([version_id for object_id, version_id in created_ids])
+        latest_ids = sorted(latest_ids + created_ids)
+    if resume_after is not None:
+        resume_after = get_key_field(model_class).to_python(resume_after)
+        latest_ids = [(object_id, version_id) for object_id, version_id in latest_ids
+                      if object_id > resume_after]
+    total = len(latest_ids)
+    result = []
+    for start in xrange(0, total, chunk_size):
+        chunk = latest_ids[start:start+chunk_size]
+        versions = Version.objects.filter(pk__in=[version_id for object_id, version_id in chunk])
+        current_objects = model_class._default_manager.in_bulk([object_id for object_id, version_id in chunk])
+        m2m_values = _get_m2m_values(model_class, field_names, current_objects.keys())
+        changes = []
+        for version in versions.order_by(key_column):
+            current_obj = current_objects.get(version.object_pk)
+            if version.is_deletion() or version.pk in created_version_ids:
+                if delete and current_obj is not None:
+                    changes.append((RESTORE_DELETE, version, current_obj))
+            elif current_obj is None:
+                changes.append((RESTORE_RECOVER, version, version.object_version))
+            else:
+                object_version = version.object_version
+                if _has_changed(object_version, current_obj, field_names, m2m_values[current_obj.pk]):
+                    changes.append((RESTORE_CHANGE, version, object_version))
+        if not dry_run and changes:
+            _apply_changes(changes, comment)
+        result.extend([(action, version) for action, version, target in changes])
+        if callback is not None:
+            callback(start + len(chunk), total, chunk[-1][0])
+    return result
+
+
+@transaction.commit_on_success
+@revision.create_on_success
+def _apply_changes(changes, comment):
+    """Applies a chunk of restore changes in a single transaction."""
+    revision.comment = comment
+    for action, version, target in changes:
+        if action == RESTORE_DELETE:
+            target.delete()
+        else:
+            target.save()
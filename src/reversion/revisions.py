@@ -4,31 +4,41 @@ try:
 except ImportError:
     from django.utils.functional import wraps  # Python 2.4 fallback.
 
+import datetime
+import logging
 import operator
 from threading import local
 import copy
+import time
 
+from django.conf import settings
 from django.contrib.admin.models import ADDITION, CHANGE, DELETION
 from django.contrib.contenttypes.models import ContentType
 from django.core import serializers
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models
+from django.db import models, connection
 from django.db.models import Q, Max
+from django.db.models.deletion import Collector
 from django.db.models.query import QuerySet
 from django.db.models.signals import post_save, pre_delete, pre_save, post_init
+from django.dispatch import Signal
 
+from reversion import search, shadow
 from reversion.errors import RevisionManagementError, RegistrationError
-from reversion.models import Revision, Version, VERSION_ADD, VERSION_CHANGE, VERSION_DELETE
-from reversion.storage import VersionFileStorageWrapper
+from reversion.managers import get_key_values
+from reversion.models import Revision, Version, VersionFile, VERSION_ADD, VERSION_CHANGE, VERSION_DELETE
+from reversion.storage import VersionFileStorageWrapper, ContentAddressedStorageWrapper
+from reversion.stores import get_version_store
 
 
 class RegistrationInfo(object):
     
     """Stored registration information about a model."""
     
-    __slots__ = "fields", "file_fields", "follow", "format",
+    __slots__ = "fields", "file_fields", "follow", "format", "coalesce_window", "search_fields", "shadow_table",
     
-    def __init__(self, fields, file_fields, follow, format):
+    def __init__(self, fields, file_fields, follow, format, coalesce_window=None, search_fields=(),
+                 shadow_table=False):
         """Initializes the registration info."""
         self.fields = fields
         self.file_fields = file_fields
@@ -41,6 +51,9 @@ class RegistrationInfo(object):
         else:
             raise ValueError, follow
         self.format = format
+        self.coalesce_window = coalesce_window
+        self.search_fields = search_fields
+        self.shadow_table = shadow_table
 
           
 class RevisionState(local):
@@ -49,6 +62,10 @@ class RevisionState(local):
     
     def __init__(self):
         """Initializes the revision state."""
+        # The request whose revision is deferred, which outlives each revision.
+        self.request = None
+        # Whether a bulk operation is adding its own objects to the revision.
+        self.is_bulk = False
         self.clear()
     
     def clear(self):
@@ -76,19 +93,117 @@ class ReversionMeta(object):
         self.serialized_data = ''
 
 
+class RevisionStats(object):
+    
+    """Statistics about the work done to commit a single revision."""
+    
+    __slots__ = "object_count", "dead_object_count", "follow_query_count", \
+                "follow_time", "serialization_time", "serialized_bytes", \
+                "insert_time", "_was_debugging", "_query_log_start",
+    
+    def __init__(self):
+        """Initializes the revision stats."""
+        self.object_count = 0
+        self.dead_object_count = 0
+        self.follow_query_count = 0
+        self.follow_time = 0.0
+        self.serialization_time = 0.0
+        self.serialized_bytes = 0
+        self.insert_time = 0.0
+    
+    def begin(self):
+        """Starts logging queries, so that they can be counted."""
+        self._was_debugging = connection.use_debug_cursor
+        self._query_log_start = len(connection.queries)
+        connection.use_debug_cursor = True
+        
+    def finish(self):
+        """Stops logging queries, discarding the log if it was not enabled."""
+        connection.use_debug_cursor = self._was_debugging
+        if not (self._was_debugging or (self._was_debugging is None and settings.DEBUG)):
+            del connection.queries[self._query_log_start:]
+    
+    def mark(self):
+        """Returns the current time and query count, to measure a step."""
+        return time.time(), len(connection.queries)
+    
+    def add_follow(self, mark):
+        """Records a relationship following step started at the given mark."""
+        start_time, start_queries = mark
+        self.follow_time += time.time() - start_time
+        self.follow_query_count += len(connection.queries) - start_queries
+        
+    def add_serialization(self, mark, serialized_data):
+        """Records the serialization of the given data, started at the given mark."""
+        self.serialization_time += time.time() - mark[0]
+        self.add_bytes(serialized_data)
+        
+    def add_bytes(self, serialized_data):
+        """Records the size of the given serialized data."""
+        # The python serializer returns a list, which is stored as its repr.
+        if not isinstance(serialized_data, basestring):
+            serialized_data = unicode(serialized_data)
+        self.serialized_bytes += len(serialized_data)
+    
+    def add_insert(self, mark):
+        """Records a database insert step started at the given mark."""
+        self.insert_time += time.time() - mark[0]
+    
+    def as_dict(self):
+        """Returns the statistics as a dictionary."""
+        return {"object_count": self.object_count,
+                "dead_object_count": self.dead_object_count,
+                "follow_query_count": self.follow_query_count,
+                "follow_time": self.follow_time,
+                "serialization_time": self.serialization_time,
+                "serialized_bytes": self.serialized_bytes,
+                "insert_time": self.insert_time}
+
+
+# Sent with the revision and its RevisionStats by the signal_stats_sink.
+revision_stats_recorded = Signal(providing_args=["revision", "stats"])
+
+
+def signal_stats_sink(revision, stats):
+    """Sends the revision_stats_recorded signal for each committed revision."""
+    revision_stats_recorded.send(sender=Revision, revision=revision, stats=stats)
+    
+
+def logging_stats_sink(revision, stats):
+    """Logs the stats of each committed revision to the reversion logger."""
+    logging.getLogger("reversion").info("Revision %s committed: %s", revision.pk, stats.as_dict())
+
+
 DEFAULT_SERIALIZATION_FORMAT = "python"
+
+
+# The number of objects loaded by each query of a bulk operation.
+BULK_CHUNK_SIZE = 500
+
+
+# The name of the RevisionManager receiver for each model signal.
+SIGNAL_RECEIVERS = {post_init: "post_init_receiver",
+                    pre_save: "pre_save_receiver",
+                    post_save: "post_save_receiver",
+                    pre_delete: "pre_delete_receiver"}
    
    
 class RevisionManager(object):
     
     """Manages the configuration and creation of revisions."""
     
-    __slots__ = "__weakref__", "_registry", "_state",
+    __slots__ = "__weakref__", "_registry", "_state", "stats_sink", "spool",
     
     def __init__(self):
         """Initializes the revision manager."""
         self._registry = {}
         self._state = RevisionState()
+        # A callable taking a revision and its RevisionStats, called for each
+        # committed revision.  Stats are only collected if this is set.
+        self.stats_sink = None
+        # A RevisionSpool to commit revisions to, instead of writing them to
+        # the history tables.
+        self.spool = None
 
     # Registration methods.
 
@@ -100,8 +215,25 @@ class RevisionManager(object):
         return model_class in self._registry
         
     def register(self, model_class, fields=None, follow=(), 
-                 format=DEFAULT_SERIALIZATION_FORMAT, exclude_fields=()):
-        """Registers a model with this revision manager."""
+                 format=DEFAULT_SERIALIZATION_FORMAT, exclude_fields=(),
+                 coalesce_window=None, search_fields=(), shadow_table=False,
+                 content_addressed_files=False):
+        """
+        Registers a model with this revision manager.
+        
+        If a `coalesce_window` is given, as a timedelta or a number of seconds,
+        a new version of an object replaces its latest version if both were
+        saved by the same user within the window.
+        
+        The `search_fields` of each version are added to the search index,
+        along with its object representation, if search is enabled.
+        
+        If `shadow_table` is true, each version is also written to a history
+        table with a column for each registered field.
+        
+        If `content_addressed_files` is true, the files of registered file
+        fields are stored once for each distinct content, named by its hash.
+        """
         # Prevent multiple registration.
         if self.is_registered(model_class):
             raise RegistrationError, "%r has already been registered with Reversion." % model_class
@@ -126,7 +258,10 @@ class RevisionManager(object):
         file_fields = []
         for field in local_fields:
             if isinstance(field, models.FileField) and field.name in fields:
-                field.storage = VersionFileStorageWrapper(field.storage)
+                if content_addressed_files:
+                    field.storage = ContentAddressedStorageWrapper(field.storage)
+                else:
+                    field.storage = VersionFileStorageWrapper(field.storage)
                 file_fields.append(field)
         file_fields = tuple(file_fields)
         # Register the generated registration information.
@@ -136,14 +271,22 @@ class RevisionManager(object):
             follow = tuple(follow)
         tmp_fields = [f for f in fields if f not in exclude_fields]
         fields = tuple(tmp_fields)
+        if coalesce_window is not None and not isinstance(coalesce_window, datetime.timedelta):
+            coalesce_window = datetime.timedelta(seconds=coalesce_window)
         registration_info = RegistrationInfo(fields, file_fields, follow, 
-                                             format)
+                                             format, coalesce_window,
+                                             tuple(search_fields), shadow_table)
+        # Connect the model signals, once for all registered models.
+        if not self._registry:
+            for signal in SIGNAL_RECEIVERS:
+                signal.connect(self.signal_dispatcher)
         self._registry[model_class] = registration_info
-        # Connect to the post save signal of the model.
-        post_save.connect(self.post_save_receiver, model_class)
-        pre_delete.connect(self.pre_delete_receiver, model_class)
-        pre_save.connect(self.pre_save_receiver, model_class)
-        post_init.connect(self.post_init_receiver, model_class)
+        if shadow_table:
+            shadow.get_history_model(model_class)
+    
+    def get_registered_models(self):
+        """Returns a list of the models registered with this revision manager."""
+        return self._registry.keys()
     
     def get_registration_info(self, model_class):
         """Returns the registration information for the given model class."""
@@ -165,10 +308,9 @@ class RevisionManager(object):
         else:
             for field in registration_info.file_fields:
                 field.storage = field.storage.wrapped_storage
-            post_save.disconnect(self.post_save_receiver, model_class)
-            pre_delete.disconnect(self.pre_delete_receiver, model_class)
-            pre_save.disconnect(self.pre_save_receiver, model_class)
-            post_init.disconnect(self.post_init_receiver, model_class)
+            if not self._registry:
+                for signal in SIGNAL_RECEIVERS:
+                    signal.disconnect(self.signal_dispatcher)
     
     # Low-level revision management methods.
     
@@ -186,6 +328,35 @@ class RevisionManager(object):
         """Returns whether there is an active revision for this thread."""
         return self._state.depth > 0
     
+    def defer(self, request):
+        """
+        Defers a revision for the given request.
+        
+        The revision is only started when a registered model is saved or
+        deleted, or its meta information is set, and the user of the request
+        is only looked up when the revision is written.  This MUST be balanced
+        by a call to `end_deferred`.
+        """
+        self._state.request = request
+        
+    def start_deferred(self):
+        """
+        Starts the deferred revision for this thread, if there is one.
+        
+        Returns whether there is now an active revision.
+        """
+        if not self.is_active() and self._state.request is not None:
+            self.start()
+        return self.is_active()
+    
+    def end_deferred(self):
+        """Ends the deferred revision for this thread, if it was started."""
+        try:
+            while self.is_active():
+                self.end()
+        finally:
+            self._state.request = None
+    
     def assert_active(self):
         """Checks for an active revision, throwning an exception if none."""
         if not self.is_active():
@@ -208,8 +379,211 @@ class RevisionManager(object):
         else:
             self._state.objects.add(obj)
         
+    def _filter_in_chunks(self, model_class, lookup, values):
+        """
+        Yields the objects of the given model matching any of the given values
+        of the lookup, running a query for each chunk of values.
+        """
+        values = list(values)
+        for start in xrange(0, len(values), BULK_CHUNK_SIZE):
+            chunk = values[start:start+BULK_CHUNK_SIZE]
+            for obj in model_class._base_manager.filter(**{"%s__in" % lookup: chunk}).distinct():
+                yield obj
+    
+    def _add_bulk_objects(self, model_class, object_ids, added_ids):
+        """
+        Loads the given objects in chunks, and adds them to the current
+        revision, replacing any copies already in it.
+        """
+        for obj in self._filter_in_chunks(model_class, "pk", object_ids):
+            if obj.pk in added_ids:
+                obj._reversion.action = ADDITION
+            else:
+                obj._reversion.action = CHANGE
+            self._state.objects.discard(obj)
+            self.add(obj)
+    
+    def _get_bulk_ancestors(self, model_class, objects):
+        """
+        Returns a list of the ancestors of each of the given objects, loading
+        them with one query per parent model.
+        """
+        ancestors = [[] for obj in objects]
+        for parent_class, field in model_class._meta.parents.items():
+            if not field:
+                # Proxy models do not have a parent field.
+                continue
+            parent_ids = [getattr(obj, field.attname) for obj in objects]
+            parents = dict([(parent.pk, parent) for parent
+                            in self._filter_in_chunks(parent_class, "pk", set(parent_ids))])
+            found_parents = parents.values()
+            grandparents = dict(zip([parent.pk for parent in found_parents],
+                                    self._get_bulk_ancestors(parent_class, found_parents)))
+            for object_ancestors, parent_id in zip(ancestors, parent_ids):
+                if parent_id in parents:
+                    object_ancestors.append(parents[parent_id])
+                    object_ancestors.extend(grandparents[parent_id])
+        return ancestors
+    
+    def _cache_bulk_foreign_keys(self, model_class, objects):
+        """
+        Loads the objects referred to by the registered foreign keys of the
+        given objects with one query per field, and caches them on the
+        objects, so that serializing the objects does not query each one.
+        """
+        registration_info = self.get_registration_info(model_class)
+        for field in model_class._meta.fields:
+            if not isinstance(field, models.ForeignKey) or not field.name in registration_info.fields:
+                continue
+            related_ids = set([getattr(obj, field.attname) for obj in objects])
+            related_ids.discard(None)
+            related_attname = field.rel.get_related_field().attname
+            related = dict([(getattr(related_obj, related_attname), related_obj) for related_obj
+                            in self._filter_in_chunks(field.rel.to, field.rel.field_name, related_ids)])
+            for obj in objects:
+                related_id = getattr(obj, field.attname)
+                if related_id in related:
+                    setattr(obj, field.get_cache_name(), related[related_id])
+    
+    def _get_bulk_neighbours(self, model_class, objects):
+        """
+        Returns the set of registered objects that the given objects follow,
+        loading them with one query per relationship.
+        """
+        opts = model_class._meta
+        pks = [obj.pk for obj in objects]
+        neighbours = set()
+        for relationship in self.get_registration_info(model_class).follow:
+            try:
+                field = opts.get_field(relationship)
+            except models.FieldDoesNotExist:
+                field = None
+            if isinstance(field, models.ForeignKey):
+                related = self._filter_in_chunks(field.rel.to, "pk",
+                                                 set([getattr(obj, field.attname) for obj in objects]))
+            elif isinstance(field, models.ManyToManyField):
+                related = self._filter_in_chunks(field.rel.to, field.related_query_name(), pks)
+            else:
+                for related_object in opts.get_all_related_objects() + opts.get_all_related_many_to_many_objects():
+                    if related_object.get_accessor_name() == relationship:
+                        related = self._filter_in_chunks(related_object.model, related_object.field.name, pks)
+                        break
+                else:
+                    # Fall back to following the relationship of each object.
+                    related = self.follow_relationships(objects, max_recursion=1, inclusive=False)
+            for obj in related:
+                if self.is_registered(obj.__class__):
+                    neighbours.add(obj)
+        return neighbours
+    
+    def _add_bulk_deletions(self, objects_by_model):
+        """
+        Snapshots the given objects, which are about to be deleted, and adds
+        them to the current revision, along with the objects they follow.
+        """
+        neighbours = set()
+        for model_class, objects in objects_by_model.iteritems():
+            registration_info = self.get_registration_info(model_class)
+            self._cache_bulk_foreign_keys(model_class, objects)
+            for obj, ancestors in zip(objects, self._get_bulk_ancestors(model_class, objects)):
+                obj._reversion.action = DELETION
+                tmp = copy.copy(obj)
+                tmp._reversion.serialized_data = serializers.serialize(registration_info.format,
+                                                                       [obj] + ancestors,
+                                                                       fields=registration_info.fields)
+                tmp._reversion.repr = repr(tmp)
+                self._state.dead_objects.add(tmp)
+            neighbours |= self._get_bulk_neighbours(model_class, objects)
+        for obj in neighbours - self._state.dead_objects:
+            obj._reversion.action = CHANGE
+            self._state.objects.add(obj)
+        self._state.objects -= self._state.dead_objects
+    
+    def bulk_save(self, objects):
+        """
+        Saves the given objects, and adds them to the current revision.
+        
+        The objects of each registered model are checked for existence with
+        one query before they are saved, and reloaded with one query after
+        they are saved, rather than passing through the model signals one at
+        a time.  Their versions are inserted in bulk when the revision ends.
+        """
+        objects = list(objects)
+        if not self.start_deferred():
+            for obj in objects:
+                obj.save()
+            return
+        objects_by_model = {}
+        for obj in objects:
+            objects_by_model.setdefault(obj.__class__, []).append(obj)
+        for model_class, model_objects in objects_by_model.iteritems():
+            if not self.is_registered(model_class):
+                for obj in model_objects:
+                    obj.save()
+                continue
+            # Find out which objects already exist before saving them.
+            object_ids = [obj.pk for obj in model_objects if obj.pk is not None]
+            existing_ids = set()
+            for start in xrange(0, len(object_ids), BULK_CHUNK_SIZE):
+                existing_ids.update(model_class._base_manager.filter(pk__in=object_ids[start:start+BULK_CHUNK_SIZE]).values_list("pk", flat=True))
+            self._state.is_bulk = True
+            try:
+                for obj in model_objects:
+                    obj.save()
+            finally:
+                self._state.is_bulk = False
+            object_ids = [obj.pk for obj in model_objects]
+            self._add_bulk_objects(model_class, object_ids,
+                                   set([object_id for object_id in object_ids if object_id not in existing_ids]))
+    
+    def bulk_update(self, queryset, **kwargs):
+        """
+        Updates the objects in the given queryset, and adds them to the current
+        revision.
+        
+        The primary keys of the matching objects are read with one query
+        before the update, and the updated objects are reloaded with one query
+        after it.  Returns the number of rows updated.
+        """
+        model_class = queryset.model
+        if not self.is_registered(model_class) or not self.start_deferred():
+            return QuerySet.update(queryset, **kwargs)
+        object_ids = list(queryset.values_list("pk", flat=True))
+        rows = QuerySet.update(queryset, **kwargs)
+        self._add_bulk_objects(model_class, object_ids, ())
+        return rows
+    
+    def bulk_delete(self, queryset):
+        """
+        Deletes the objects in the given queryset, and adds them, and the
+        objects their deletion cascades to, to the current revision.
+        
+        The whole set of objects collected for deletion is snapshotted before
+        it is deleted, with one query per parent model and followed
+        relationship, rather than passing through the model signals one at a
+        time.  Their versions are inserted in bulk when the revision ends.
+        """
+        if not self.start_deferred():
+            return QuerySet.delete(queryset)
+        # Collect the objects from the database that they will be deleted from.
+        queryset = queryset._clone()
+        queryset._for_write = True
+        collector = Collector(using=queryset.db)
+        collector.collect(queryset)
+        objects_by_model = {}
+        for model_class, objects in collector.data.iteritems():
+            if self.is_registered(model_class) and not model_class._meta.proxy:
+                objects_by_model[model_class] = list(objects)
+        self._add_bulk_deletions(objects_by_model)
+        self._state.is_bulk = True
+        try:
+            collector.delete()
+        finally:
+            self._state.is_bulk = False
+        
     def set_user(self, user):
         """Sets the user for the current revision"""
+        self.start_deferred()
         self.assert_active()
         self._state.user = user
         
@@ -224,6 +598,7 @@ class RevisionManager(object):
         
     def set_comment(self, comment):
         """Sets the comment for the current revision"""
+        self.start_deferred()
         self.assert_active()
         self._state.comment = comment
         
@@ -236,8 +611,22 @@ class RevisionManager(object):
                        set_comment,
                        doc="The comment for the current revision.")
         
+    def get_request_user(self):
+        """
+        Returns the user to save with the current revision, falling back to
+        the authenticated user of a deferred request.
+        """
+        user = self._state.user
+        request = self._state.request
+        if user is None and request is not None:
+            request_user = getattr(request, "user", None)
+            if request_user is not None and request_user.is_authenticated():
+                user = request_user
+        return user
+        
     def add_meta(self, cls, **kwargs):
         """Adds a class of meta information to the current revision."""
+        self.start_deferred()
         self.assert_active()
         self._state.meta.append((cls, kwargs))
     
@@ -260,7 +649,7 @@ class RevisionManager(object):
         result_set = set()
         def _follow_relationships(obj, level = 0):
             # Prevent recursion.
-            if obj in result_dict or obj.pk is None:  # This last condition is because during a delete action the parent field for a subclassing model will be set to None.
+            if obj in result_set or obj.pk is None:  # This last condition is because during a delete action the parent field for a subclassing model will be set to None.
                 return
             if inclusive or level > 0:
                 result_set.add(obj)
@@ -324,21 +713,28 @@ class RevisionManager(object):
             models = self._state.objects
             dead_models = self._state.dead_objects
             models -= dead_models
+            # Only collect stats if there is somewhere to send them.
+            stats = None
             try:
                 if (dead_models or models) and not self.is_invalid():
-                    # Save a new revision.
-                    revision = Revision.objects.create(user=self._state.user,
-                                                    comment=self._state.comment)
+                    if self.stats_sink is not None:
+                        stats = RevisionStats()
+                        stats.begin()
+                        mark = stats.mark()
                     # Follow relationships.
                     revision_set = \
                             self.follow_relationships(self._state.objects)
+                    if stats is not None:
+                        stats.add_follow(mark)
                     # Because we might have uncomitted data in models, we need 
                     # to replace the models in revision_set which might have 
                     # come from the db, with the actual models sent to 
                     # reversion.
                     diff = revision_set.difference(models)
                     revision_set = models.union(diff)
-                    # Save version models.
+                    # Build version models, to be inserted in bulk.
+                    versions = []
+                    search_enabled = search.is_enabled()
                     for obj in revision_set:
                         # Proxy models should not actually be saved to the 
                         # revision set.
@@ -346,25 +742,36 @@ class RevisionManager(object):
                             continue
                         action = obj._reversion.action
                         registration_info = self.get_registration_info(obj.__class__)
-                        object_id = unicode(obj.pk)
+                        key_values = get_key_values(obj.__class__, obj.pk)
                         content_type = ContentType.objects.get_for_model(obj)
                         if action is DELETION:
                             raise ValueError, "BUG: there's a dead model " \
                                               "among live ones. %r" % obj
                         else:
+                            if stats is not None:
+                                mark = stats.mark()
                             ancestors_and_self = \
                                 self.follow_relationships([obj], ancestors=True)
+                            if stats is not None:
+                                stats.add_follow(mark)
+                                mark = stats.mark()
                             serialized_data = \
                                 serializers.serialize(registration_info.format, 
                                                       ancestors_and_self,
                                                 fields=registration_info.fields)
-                        Version.objects.create(revision=revision,
-                                               object_id=object_id,
-                                               content_type=content_type,
-                                               format=registration_info.format,
-                                               serialized_data=serialized_data,
-                                               object_repr=unicode(repr(obj)),
-                                               action_flag=action)
+                            if stats is not None:
+                                stats.add_serialization(mark, serialized_data)
+                        versions.append(Version(content_type=content_type,
+                                                format=registration_info.format,
+                                                serialized_data=serialized_data,
+                                                object_repr=unicode(repr(obj)),
+                                                action_flag=action,
+                                                **key_values))
+                        if search_enabled:
+                            versions[-1].search_text = search.get_object_text(obj, versions[-1].object_repr,
+                                                                              registration_info.search_fields)
+                        if stats is not None:
+                            stats.object_count += 1
                     
                     # For objects that have already been deleted, get the stored 
                     # serialized data and attach it to the version.
@@ -372,24 +779,112 @@ class RevisionManager(object):
                         action = obj._reversion.action
                         assert action is DELETION, "%r action: %d" % (obj, action)
                         registration_info = self.get_registration_info(obj.__class__)
-                        object_id = unicode(obj.pk)
+                        key_values = get_key_values(obj.__class__, obj.pk)
                         content_type = ContentType.objects.get_for_model(obj)
                         serialized_data = obj._reversion.serialized_data
                         original_repr = obj._reversion.repr
-                        Version.objects.create(revision=revision,
-                                               object_id=object_id,
-                                               content_type=content_type,
-                                               format=registration_info.format,
-                                               serialized_data=serialized_data,
-                                               object_repr=unicode(original_repr),
-                                               action_flag=action)
+                        versions.append(Version(content_type=content_type,
+                                                format=registration_info.format,
+                                                serialized_data=serialized_data,
+                                                object_repr=unicode(original_repr),
+                                                action_flag=action,
+                                                **key_values))
+                        if search_enabled:
+                            versions[-1].search_text = search.get_object_text(obj, versions[-1].object_repr,
+                                                                              registration_info.search_fields)
+                        if stats is not None:
+                            stats.add_bytes(serialized_data)
+                            stats.object_count += 1
+                            stats.dead_object_count += 1
+                    
+                    user = self.get_request_user()
+                    if self.spool is not None and not self._state.meta:
+                        # Leave the revision for the spool to write.  Spooled
+                        # versions are not coalesced, and send no stats.
+                        self.spool.enqueue(user, self._state.comment, versions)
+                        versions = []
+                    else:
+                        # Merge versions into recent versions of the same
+                        # objects, if their models have a coalescing window.
+                        new_versions = []
+                        merged_versions = []
+                        for version in versions:
+                            if self._coalesce_version(version, user):
+                                merged_versions.append(version)
+                            else:
+                                new_versions.append(version)
+                        versions = new_versions
+                        VersionFile.objects.record_versions(merged_versions, replace=True)
+                        shadow.record_versions(merged_versions, replace=True)
+                        if search_enabled:
+                            search.index_versions(merged_versions)
+                    if versions or self._state.meta:
+                        if stats is not None:
+                            mark = stats.mark()
+                        # Save a new revision.
+                        revision = Revision.objects.create(user=user,
+                                                           comment=self._state.comment)
+                        # Save version models.
+                        for version in versions:
+                            version.revision = revision
+                        get_version_store().write_batch(versions)
+                        if stats is not None:
+                            stats.add_insert(mark)
                         
-                    for cls, kwargs in self._state.meta:
-                        cls._default_manager.create(revision=revision, **kwargs)
+                        for cls, kwargs in self._state.meta:
+                            cls._default_manager.create(revision=revision, **kwargs)
+                        if stats is not None:
+                            stats.finish()
+                            self.stats_sink(revision, stats)
+                            stats = None
             finally:
+                if stats is not None:
+                    stats.finish()
                 self._state.clear()
         
+    def _coalesce_version(self, version, user):
+        """
+        Merges the given unsaved version into the latest version of its object,
+        if its model has a coalescing window, and the latest version was saved
+        by the same user within the window.
+        
+        Returns whether the version was merged.
+        """
+        window = self.get_registration_info(version.content_type.model_class()).coalesce_window
+        if window is None or version.action_flag == DELETION:
+            return False
+        versions = Version.objects.filter(content_type=version.content_type,
+                                          **version.get_key_lookup())
+        try:
+            latest = versions.select_related("revision").order_by("-pk")[0]
+        except IndexError:
+            return False
+        if latest.action_flag == DELETION or \
+           latest.revision.user_id != (user and user.pk) or \
+           latest.revision.date_created < datetime.datetime.now() - window:
+            return False
+        # The latest version is only updated if no concurrent writer has updated
+        # it or added a newer version, otherwise a new version is added.
+        if not Version.objects.replace_latest(latest, get_version_store().encode(version.serialized_data),
+                                              version.object_repr):
+            return False
+        version.id = latest.pk
+        version.revision = latest.revision
+        version.action_flag = latest.action_flag
+        return True
+    
     # Signal receivers.
+    
+    def signal_dispatcher(self, signal, sender, **kwargs):
+        """
+        Passes the model signals of registered models on to their receivers.
+        
+        A single dispatcher is connected to each signal, rather than a receiver
+        per registered model, as signal dispatch slows down with the number of
+        connected receivers.
+        """
+        if sender in self._registry:
+            getattr(self, SIGNAL_RECEIVERS[signal])(sender=sender, **kwargs)
         
     def post_init_receiver(self, instance, sender, **kwargs):
         """Creates the reversion meta and attaches it to the instance."""
@@ -404,11 +899,11 @@ class RevisionManager(object):
 
     def post_save_receiver(self, instance, sender, **kwargs):
         """Adds registered models to the current revision, if any."""
-        if self.is_active():
-            if created:
-                self.add(instance, VERSION_ADD)
-            else:
-                self.add(instance, VERSION_CHANGE)
+        # Bulk operations add their objects once they have all been saved.
+        if self._state.is_bulk:
+            return
+        if self.start_deferred():
+            self.add(instance)
             
     def pre_delete_receiver(self, instance, **kwargs):
         """Adds registerted models to the current revision, if any."""
@@ -420,6 +915,9 @@ class RevisionManager(object):
         Freezes the instance contents and adds registered models to the current 
         revision, if any.
         """
+        # Bulk deletions have already been added.
+        if self._state.is_bulk:
+            return
         instance._reversion.action = DELETION
         tmp = copy.copy(instance)
         ancestors_and_self = self.follow_relationships([instance], 
@@ -430,7 +928,7 @@ class RevisionManager(object):
                                                                fields=registration_info.fields)
         tmp._reversion.repr = repr(tmp)
 
-        if self.is_active():
+        if self.start_deferred():
             self.add(tmp)
 
     # High-level revision management methods.
@@ -0,0 +1,288 @@
+"""
+Full-text search over the history of versioned models.
+
+When enabled, the object representation and registered `search_fields` of
+each saved version are added to a full-text index, which can be searched with
+`Version.objects.search()`.
+
+The index is kept by the backend named by the REVERSION_SEARCH_BACKEND
+setting.  The default backend keeps a SQLite FTS5 index in the local file set
+by the REVERSION_SEARCH_INDEX setting:
+
+    REVERSION_SEARCH_INDEX = "/var/lib/reversion/search.db"
+
+Sites on PostgreSQL can keep the index in the database instead:
+
+    REVERSION_SEARCH_BACKEND = "reversion.search.PostgresSearchBackend"
+
+Existing versions are added to the index by the indexversions command, which
+also creates the index table of the PostgreSQL backend.  Run it before
+enabling the backend; until the table exists, versions are not indexed.
+"""
+
+
+from __future__ import with_statement
+
+import logging
+import sqlite3
+import threading
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.utils.importlib import import_module
+
+
+DEFAULT_SEARCH_BACKEND = "reversion.search.SQLiteSearchBackend"
+
+DEFAULT_LIMIT = 50
+
+
+class SearchBackend(object):
+
+    """A full-text index of versions."""
+
+    def index(self, entries):
+        """
+        Adds the given list of (version_id, content_type_id, text) entries to
+        the index, replacing any existing entries for the same versions.
+        """
+        raise NotImplementedError
+
+    def search(self, query, content_type_ids=None, limit=DEFAULT_LIMIT):
+        """
+        Returns the ids of the versions matching all the words of the given
+        query, most relevant first.
+
+        If `content_type_ids` is given, only versions of those content types
+        are returned.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """Removes all entries from the index."""
+        raise NotImplementedError
+
+    def install(self):
+        """Creates the index, if it does not exist yet."""
+
+    def close(self):
+        """Releases the resources held by the backend."""
+
+
+def _quote_words(query):
+    """
+    Returns an FTS5 query matching all the words in the given text, quoted so
+    that they are not read as query syntax.
+    """
+    return u" ".join([u'"%s"' % word.replace(u'"', u'""') for word in query.split()])
+
+
+class SQLiteSearchBackend(SearchBackend):
+
+    """A full-text index kept in a local SQLite FTS5 table."""
+
+    def __init__(self, path=None):
+        """Initializes the SQLiteSearchBackend."""
+        path = path or getattr(settings, "REVERSION_SEARCH_INDEX", None)
+        if not path:
+            raise ImproperlyConfigured("The REVERSION_SEARCH_INDEX setting is required by the SQLite search backend.")
+        # Guards the index, which is shared between threads.
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS version_search "
+                         "USING fts5(content, content_type_id UNINDEXED)")
+        self._db.commit()
+
+    def index(self, entries):
+        """Adds the given entries to the index."""
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO version_search (rowid, content_type_id, content) VALUES (?, ?, ?)",
+                                 entries)
+            self._db.commit()
+
+    def search(self, query, content_type_ids=None, limit=DEFAULT_LIMIT):
+        """Returns the ids of the matching versions, most relevant first."""
+        query = _quote_words(query)
+        if not query:
+            return []
+        sql = "SELECT rowid FROM version_search WHERE version_search MATCH ?"
+        params = [query]
+        if content_type_ids is not None:
+            sql += " AND content_type_id IN (%s)" % ", ".join(["?"] * len(content_type_ids))
+            params.extend(content_type_ids)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            return [row[0] for row in self._db.execute(sql, params)]
+
+    def clear(self):
+        """Removes all entries from the index."""
+        with self._lock:
+            self._db.execute("DELETE FROM version_search")
+            self._db.commit()
+
+    def close(self):
+        """Closes the index."""
+        with self._lock:
+            self._db.close()
+
+
+class PostgresSearchBackend(SearchBackend):
+
+    """A full-text index kept in a tsvector column of a PostgreSQL table."""
+
+    def __init__(self, config=None):
+        """
+        Initializes the PostgresSearchBackend, using the given text search
+        configuration, or the REVERSION_SEARCH_CONFIG setting.
+        """
+        self.config = config or getattr(settings, "REVERSION_SEARCH_CONFIG", "simple")
+        self._installed = False
+
+    def is_installed(self):
+        """Checks whether the index table has been created by install()."""
+        if not self._installed:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1 FROM pg_class WHERE relname = 'reversion_versionsearch'")
+            self._installed = bool(cursor.fetchone())
+        return self._installed
+
+    def install(self):
+        """
+        Creates the index table, if it does not exist yet.
+
+        This is only done by the indexversions command, so that tables are
+        never created inside the transaction of a request.
+        """
+        if not self.is_installed():
+            cursor = connection.cursor()
+            cursor.execute("CREATE TABLE reversion_versionsearch ("
+                           "version_id integer PRIMARY KEY, "
+                           "content_type_id integer NOT NULL, "
+                           "document tsvector NOT NULL)")
+            cursor.execute("CREATE INDEX reversion_versionsearch_document ON reversion_versionsearch USING gin (document)")
+            transaction.commit_unless_managed()
+            self._installed = True
+
+    def index(self, entries):
+        """
+        Adds the given entries to the index.
+
+        If the index table has not been created yet, the entries are skipped.
+        """
+        if not entries:
+            return
+        if not self.is_installed():
+            logging.getLogger("reversion").warning("The search index table does not exist, so %s versions were not indexed.  "
+                                                   "Run the indexversions command to create it.", len(entries))
+            return
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM reversion_versionsearch WHERE version_id IN (%s)" % ", ".join(["%s"] * len(entries)),
+                       [entry[0] for entry in entries])
+        cursor.executemany("INSERT INTO reversion_versionsearch (version_id, content_type_id, document) "
+                           "VALUES (%s, %s, to_tsvector(%s, %s))",
+                           [(version_id, content_type_id, self.config, text)
+                            for version_id, content_type_id, text in entries])
+        transaction.commit_unless_managed()
+
+    def search(self, query, content_type_ids=None, limit=DEFAULT_LIMIT):
+        """Returns the ids of the matching versions, most relevant first."""
+        sql = ("SELECT version_id FROM reversion_versionsearch, plainto_tsquery(%s, %s) query "
+               "WHERE document @@ query")
+        params = [self.config, query]
+        if content_type_ids is not None:
+            sql += " AND content_type_id IN (%s)" % ", ".join(["%s"] * len(content_type_ids))
+            params.extend(content_type_ids)
+        sql += " ORDER BY ts_rank(document, query) DESC LIMIT %s"
+        params.append(limit)
+        if not self.is_installed():
+            return []
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+    def clear(self):
+        """Removes all entries from the index."""
+        if not self.is_installed():
+            return
+        connection.cursor().execute("DELETE FROM reversion_versionsearch")
+        transaction.commit_unless_managed()
+
+
+_backend = None
+
+_backend_lock = threading.Lock()
+
+
+def is_enabled():
+    """Checks whether versions are added to a search index."""
+    return bool(getattr(settings, "REVERSION_SEARCH_BACKEND", None) or
+                getattr(settings, "REVERSION_SEARCH_INDEX", None))
+
+
+def get_search_backend():
+    """Returns the search backend configured by the REVERSION_SEARCH_BACKEND setting."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            path = getattr(settings, "REVERSION_SEARCH_BACKEND", DEFAULT_SEARCH_BACKEND)
+            module_name, class_name = path.rsplit(".", 1)
+            try:
+                backend_class = getattr(import_module(module_name), class_name)
+            except (ImportError, AttributeError), e:
+                raise ImproperlyConfigured("Could not load the search backend %r: %s" % (path, e))
+            _backend = backend_class()
+        return _backend
+
+
+def reset_search_backend():
+    """Closes the search backend, so that it is reloaded from the settings."""
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            _backend.close()
+            _backend = None
+
+
+def get_search_text(object_repr, field_values):
+    """Returns the text indexed for a version with the given representation and field values."""
+    return u" ".join([object_repr] + [unicode(value) for value in field_values if value])
+
+
+def get_version_text(version):
+    """Returns the text indexed for the given saved version."""
+    from reversion.revisions import revision
+    model_class = ContentType.objects.get_for_id(version.content_type_id).model_class()
+    search_fields = ()
+    if model_class is not None and revision.is_registered(model_class):
+        search_fields = revision.get_registration_info(model_class).search_fields
+    field_values = ()
+    if search_fields:
+        field_dict = version.field_dict
+        field_values = [field_dict.get(field_name) for field_name in search_fields]
+    return get_search_text(version.object_repr, field_values)
+
+
+def index_versions(versions):
+    """
+    Adds the given saved versions to the search index.
+
+    The text of each version is read from its `search_text` attribute, if it
+    has one, or otherwise from its stored data.
+    """
+    entries = []
+    for version in versions:
+        text = getattr(version, "search_text", None)
+        if text is None:
+            text = get_version_text(version)
+        entries.append((version.pk, version.content_type_id, text))
+    if entries:
+        get_search_backend().index(entries)
+
+
+def get_object_text(obj, object_repr, search_fields):
+    """Returns the text indexed for a version of the given live object."""
+    return get_search_text(object_repr, [getattr(obj, field_name, None) for field_name in search_fields])
+
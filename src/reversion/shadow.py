@@ -0,0 +1,229 @@
+"""
+Shadow history tables with a real column for each registered field.
+
+Models registered with `shadow_table=True` have each version written to a
+history table, as well as to the serialized data of the version:
+
+    reversion.register(Page, shadow_table=True)
+
+The history table is named after the table of the model, with a "_history"
+suffix, and has a column for each registered field of the model, along with
+the version id, revision id, action and revision date of each row.  History
+can then be queried with plain, indexed SQL:
+
+    PageHistory = get_history_model(Page)
+    PageHistory.objects.filter(title__icontains="draft", history_date__gte=start)
+
+History tables are created by syncdb for models registered when it runs,
+and otherwise by the rebuildhistorytables command, which should also be run
+for sites that manage the reversion app with South.  Tables are never created
+while versions are written; until the table of a model exists, its versions
+are not written to it.
+"""
+
+
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.color import no_style
+from django.db import connections, models, router
+from django.db.models.query import QuerySet
+
+from reversion.managers import BulkInsertManager
+from reversion.stream import deserialize_chunk
+
+
+# Field classes that are stored as another type in history tables.
+FIELD_CLASS_SUBSTITUTES = {
+    models.AutoField: models.IntegerField,
+}
+
+# The constructor arguments copied from the fields of versioned models.
+COPIED_FIELD_ARGUMENTS = ("max_length", "max_digits", "decimal_places")
+
+
+def _copy_field(field):
+    """
+    Returns a field that stores the values of the given field in a history
+    table, without its constraints.
+    """
+    value_field = field
+    if field.rel:
+        value_field = field.rel.get_related_field()
+    field_class = FIELD_CLASS_SUBSTITUTES.get(value_field.__class__, value_field.__class__)
+    kwargs = {"null": True,
+              "blank": True,
+              "db_column": field.column,
+              "db_index": bool(field.db_index or field.unique or field.rel)}
+    for argument in COPIED_FIELD_ARGUMENTS:
+        if getattr(value_field, argument, None) is not None:
+            kwargs[argument] = getattr(value_field, argument)
+    return field_class(**kwargs)
+
+
+class HistoryModelBase(models.Model):
+
+    """The base class of the generated history models."""
+
+    history_version_id = models.IntegerField(primary_key=True,
+                                             help_text="The version stored in this row.")
+
+    history_revision_id = models.IntegerField(db_index=True,
+                                              help_text="The revision that contains the version.")
+
+    history_action_flag = models.PositiveSmallIntegerField(help_text="The action that describes the version.")
+
+    history_date = models.DateTimeField(db_index=True,
+                                        help_text="The date and time the revision was created.")
+
+    objects = BulkInsertManager()
+
+    class Meta:
+        abstract = True
+
+    def get_version(self):
+        """Returns the version stored in this row."""
+        from reversion.models import Version
+        return Version.objects.get(pk=self.history_version_id)
+
+
+_history_models = {}
+
+_existing_tables = set()
+
+
+def is_shadowed(model_class):
+    """Checks whether versions of the given model are written to a shadow table."""
+    from reversion.revisions import revision
+    return revision.is_registered(model_class) and revision.get_registration_info(model_class).shadow_table
+
+
+def get_history_model(model_class):
+    """Returns the generated model of the history table of the given model."""
+    try:
+        return _history_models[model_class]
+    except KeyError:
+        from reversion.revisions import revision
+        opts = model_class._meta
+        registered_fields = revision.get_registration_info(model_class).fields
+        attrs = {"__module__": HistoryModelBase.__module__,
+                 "Meta": type("Meta", (object,), {"app_label": "reversion",
+                                                  "db_table": "%s_history" % opts.db_table})}
+        history_fields = []
+        for field in opts.fields:
+            if field.name in registered_fields:
+                attrs[field.name] = _copy_field(field)
+                history_fields.append(field.name)
+        attrs["history_fields"] = tuple(history_fields)
+        name = str("%s%sHistory" % (opts.app_label.title().replace("_", ""), opts.object_name))
+        history_model = _history_models[model_class] = type(name, (HistoryModelBase,), attrs)
+        return history_model
+
+
+def table_exists(history_model):
+    """Checks whether the table of the given history model exists."""
+    using = router.db_for_write(history_model)
+    if (using, history_model) in _existing_tables:
+        return True
+    if history_model._meta.db_table in connections[using].introspection.table_names():
+        _existing_tables.add((using, history_model))
+        return True
+    return False
+
+
+def ensure_table(history_model):
+    """
+    Creates the table of the given history model, if it does not exist yet.
+
+    This is only done by the rebuildhistorytables command, since on some
+    databases creating a table commits the open transaction.
+    """
+    if table_exists(history_model):
+        return
+    using = router.db_for_write(history_model)
+    connection = connections[using]
+    style = no_style()
+    statements = connection.creation.sql_create_model(history_model, style)[0]
+    statements.extend(connection.creation.sql_indexes_for_model(history_model, style))
+    cursor = connection.cursor()
+    for statement in statements:
+        cursor.execute(statement)
+    _existing_tables.add((using, history_model))
+
+
+def get_shadowed_content_types():
+    """Returns the ids of the content types of the models with shadow tables."""
+    return [ContentType.objects.get_for_model(model_class).pk
+            for model_class in _history_models if is_shadowed(model_class)]
+
+
+def record_versions(versions, replace=False):
+    """
+    Writes rows for the given saved versions, of any model, to the history
+    tables of their models.  Versions of models without a shadow table are
+    skipped.
+
+    The versions can be a queryset, or a list of versions with their revision
+    set.  If `replace` is true, existing rows for the versions are replaced.
+    Versions of models whose history table does not exist yet are skipped.
+    """
+    content_type_ids = get_shadowed_content_types()
+    if not content_type_ids:
+        return
+    if isinstance(versions, QuerySet):
+        versions = versions.filter(content_type__in=content_type_ids).select_related("revision")
+    versions_by_content_type = {}
+    for version in versions:
+        if version.content_type_id in content_type_ids:
+            versions_by_content_type.setdefault(version.content_type_id, []).append(version)
+    for content_type_id, content_type_versions in versions_by_content_type.iteritems():
+        history_model = get_history_model(ContentType.objects.get_for_id(content_type_id).model_class())
+        if not table_exists(history_model):
+            logging.getLogger("reversion").warning("The history table %s does not exist, so %s versions were not written to it.  "
+                                                   "Run the rebuildhistorytables command to create it.",
+                                                   history_model._meta.db_table, len(content_type_versions))
+            continue
+        if replace:
+            history_model.objects.filter(pk__in=[version.pk for version in content_type_versions]).delete()
+        field_dicts = deserialize_chunk([(version.format, version.serialized_data)
+                                         for version in content_type_versions])
+        rows = []
+        for version, field_dict in zip(content_type_versions, field_dicts):
+            row = history_model(history_version_id=version.pk,
+                                history_revision_id=version.revision_id,
+                                history_action_flag=version.action_flag,
+                                history_date=version.revision.date_created)
+            for name in history_model.history_fields:
+                setattr(row, name, field_dict.get(name))
+            rows.append(row)
+        history_model.objects.insert_many(rows)
+
+
+def delete_versions(version_ids):
+    """Deletes the rows of the given versions from the history tables."""
+    for history_model in _history_models.values():
+        if table_exists(history_model):
+            history_model.objects.filter(pk__in=version_ids).delete()
+
+
+def rebuild(model_class, chunk_size=500):
+    """
+    Rewrites the history table of the given model from its stored versions,
+    returning the number of rows written.
+    """
+    from reversion.models import Version
+    history_model = get_history_model(model_class)
+    ensure_table(history_model)
+    history_model.objects.all().delete()
+    versions = Version.objects.filter(content_type=ContentType.objects.get_for_model(model_class))
+    versions = versions.order_by("pk")
+    count = 0
+    last_pk = 0
+    while True:
+        chunk = list(versions.filter(pk__gt=last_pk).values_list("pk", flat=True)[:chunk_size])
+        if not chunk:
+            break
+        record_versions(Version.objects.filter(pk__in=chunk))
+        last_pk = chunk[-1]
+        count += len(chunk)
+    return count
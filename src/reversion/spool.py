@@ -0,0 +1,230 @@
+"""
+Write-behind persistence of revisions.
+
+When a RevisionSpool is set as the `spool` of the revision manager, ending a
+revision serializes its versions and commits them to a local SQLite spool,
+instead of writing them to the history tables.  A worker thread then writes
+batches of spooled revisions to the history tables, each batch in a single
+transaction.
+
+    spool = RevisionSpool("/var/spool/reversion.db")
+    spool.start()
+    reversion.revision.spool = spool
+
+Revisions left in the spool by a crash are written when the spool is next
+started or flushed.  Spooled revisions are committed independently of the
+database transaction of the request that saved them.
+"""
+
+
+from __future__ import with_statement
+
+import datetime
+import logging
+import sqlite3
+import threading
+import uuid
+
+from django.db import connection, transaction
+from django.utils import simplejson
+
+from reversion.models import Revision, Version
+from reversion.stores import get_version_store
+
+
+# Spooled revisions that have not been written yet.
+STATE_PENDING = 0
+
+# Spooled revisions that are being written, which may already be in the
+# history tables if the writer crashed.
+STATE_WRITING = 1
+
+DEFAULT_BATCH_SIZE = 100
+
+DEFAULT_INTERVAL = 1.0
+
+
+def _pack_date(date):
+    """Packs a datetime into a list, keeping its microseconds."""
+    return list(date.timetuple()[:6]) + [date.microsecond]
+
+
+def _unpack_date(value):
+    """Unpacks a datetime packed by _pack_date."""
+    return datetime.datetime(*value)
+
+
+class RevisionSpool(object):
+
+    """A durable local queue of revisions waiting to be written."""
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, interval=DEFAULT_INTERVAL):
+        """
+        Initializes the RevisionSpool.
+
+        The worker writes up to `batch_size` revisions in each transaction,
+        and checks the spool at least every `interval` seconds.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        # Guards the spool database, which is shared between threads.
+        self._lock = threading.RLock()
+        # Stops more than one thread writing the same revisions.
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA synchronous = FULL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS spool ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "state INTEGER NOT NULL, "
+                         "payload TEXT NOT NULL)")
+        self._db.commit()
+
+    def enqueue(self, user, comment, versions):
+        """
+        Commits a revision by the given user, containing the given unsaved
+        versions, to the spool.
+
+        The revision is durable as soon as this returns, and is written even if
+        the database transaction of the request that saved it is later rolled
+        back.
+        """
+        # The key of the entry is stored with the written revision, so that it
+        # is only written once.
+        payload = {"key": uuid.uuid4().hex,
+                   "date_created": _pack_date(datetime.datetime.now()),
+                   "user": user and user.pk,
+                   "comment": comment,
+                   "versions": [{"content_type": version.content_type_id,
+                                 "object_id": version.object_id,
+                                 "object_key": version.object_key,
+                                 "format": version.format,
+                                 "serialized_data": unicode(version.serialized_data),
+                                 "object_repr": version.object_repr,
+                                 "action_flag": version.action_flag}
+                                for version in versions]}
+        with self._lock:
+            self._db.execute("INSERT INTO spool (state, payload) VALUES (?, ?)",
+                             (STATE_PENDING, simplejson.dumps(payload)))
+            self._db.commit()
+        self._wakeup.set()
+
+    def pending_count(self):
+        """Returns the number of revisions waiting to be written."""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def _take_batch(self):
+        """
+        Returns the next batch of spooled revisions as (id, state, payload)
+        tuples, marking them as being written.
+        """
+        with self._lock:
+            entries = [(entry_id, state, simplejson.loads(payload)) for entry_id, state, payload
+                       in self._db.execute("SELECT id, state, payload FROM spool ORDER BY id LIMIT ?",
+                                           (self.batch_size,))]
+            self._db.executemany("UPDATE spool SET state = ? WHERE id = ?",
+                                 [(STATE_WRITING, entry[0]) for entry in entries])
+            self._db.commit()
+        return entries
+
+    def _remove(self, entry_ids):
+        """Removes the given written revisions from the spool."""
+        with self._lock:
+            self._db.executemany("DELETE FROM spool WHERE id = ?",
+                                 [(entry_id,) for entry_id in entry_ids])
+            self._db.commit()
+
+    def write_batch(self):
+        """
+        Writes the next batch of spooled revisions to the history tables,
+        returning the number of revisions written.
+        """
+        with self._write_lock:
+            entries = self._take_batch()
+            if entries:
+                _write_revisions(entries)
+                self._remove([entry[0] for entry in entries])
+            return len(entries)
+
+    def flush(self):
+        """Writes all spooled revisions to the history tables in this thread."""
+        while self.write_batch():
+            pass
+
+    def _run(self):
+        """Writes spooled revisions until the spool is stopped."""
+        try:
+            while not self._stopping:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+                try:
+                    self.flush()
+                except Exception:
+                    logging.getLogger("reversion").exception("Could not write spooled revisions.")
+        finally:
+            connection.close()
+
+    def start(self):
+        """
+        Starts the worker thread, which first writes any revisions left in the
+        spool.
+        """
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="reversion-spool")
+            self._thread.setDaemon(True)
+            self._thread.start()
+            self._wakeup.set()
+
+    def stop(self):
+        """Stops the worker thread, once it has written the current batch."""
+        if self._thread is not None:
+            self._stopping = True
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """Stops the worker thread, and closes the spool."""
+        self.stop()
+        with self._lock:
+            self._db.close()
+
+
+def _get_source_key(payload):
+    """Returns the source key of the revision of a spooled payload."""
+    return "spool:%s" % payload["key"]
+
+
+@transaction.commit_on_success
+def _write_revisions(entries):
+    """Writes the given spooled revisions to the history tables."""
+    # Revisions that were being written by a crashed writer may have been
+    # committed already.
+    source_keys = [_get_source_key(payload) for entry_id, state, payload in entries if state == STATE_WRITING]
+    written_keys = set(Revision.objects.filter(source_key__in=source_keys).values_list("source_key", flat=True))
+    versions = []
+    for entry_id, state, payload in entries:
+        source_key = _get_source_key(payload)
+        if source_key in written_keys:
+            continue
+        revision = Revision(user_id=payload["user"],
+                            comment=payload["comment"],
+                            date_created=_unpack_date(payload["date_created"]),
+                            source_key=source_key)
+        # A raw save keeps the spooled creation date.
+        revision.save_base(raw=True, force_insert=True)
+        for version in payload["versions"]:
+            versions.append(Version(revision=revision,
+                                    content_type_id=version["content_type"],
+                                    object_id=version["object_id"],
+                                    object_key=version["object_key"],
+                                    format=version["format"],
+                                    serialized_data=version["serialized_data"],
+                                    object_repr=version["object_repr"],
+                                    action_flag=version["action_flag"]))
+    get_version_store().write_batch(versions)
@@ -0,0 +1,2 @@
+CREATE INDEX reversion_version_object ON reversion_version (content_type_id, object_id, id);
+CREATE INDEX reversion_version_object_key ON reversion_version (content_type_id, object_key, id);
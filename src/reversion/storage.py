@@ -1,6 +1,25 @@
 """File storage wrapper for version controlled file fields."""
 
 
+import datetime
+import hashlib
+import operator
+import os
+import posixpath
+
+from django.conf import settings
+from django.db import connection, models
+
+
+# The directory of content addressed files, within their storage.
+DEFAULT_FILE_DIRECTORY = "versioned"
+
+
+def get_file_directory():
+    """Returns the directory of content addressed files, from the REVERSION_FILE_DIRECTORY setting."""
+    return getattr(settings, "REVERSION_FILE_DIRECTORY", DEFAULT_FILE_DIRECTORY)
+
+
 class VersionFileStorageWrapper(object):
     
     """Wrapper for file storage implementations that blocks file deletions."""
@@ -19,3 +38,166 @@ class VersionFileStorageWrapper(object):
         """File deletions are blocked for this storage class."""
         pass
 
+
+class ContentAddressedStorageWrapper(VersionFileStorageWrapper):
+    
+    """
+    Wrapper for file storage implementations that stores each distinct file
+    once, named by the hash of its content.
+    
+    Files are never deleted through the wrapper.  Files that are no longer
+    referenced are removed by collect_files().
+    """
+    
+    __slots__ = "directory",
+    
+    def __init__(self, storage, directory=None):
+        """Initializes the ContentAddressedStorageWrapper."""
+        super(ContentAddressedStorageWrapper, self).__init__(storage)
+        self.directory = directory or get_file_directory()
+    
+    def get_content_name(self, name, digest):
+        """Returns the name of a file with the given original name and content hash."""
+        extension = os.path.splitext(name)[1].lower()
+        return posixpath.join(self.directory, digest[:2], digest[2:4], digest + extension)
+    
+    def save(self, name, content):
+        """
+        Saves the given content, unless a file with the same content has
+        already been saved, and returns its content addressed name.
+        
+        An existing file is touched, so that collect_files() keeps it until
+        the version referencing it again has been saved.
+        """
+        content.seek(0)
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        name = self.get_content_name(name, digest.hexdigest())
+        if self.wrapped_storage.exists(name):
+            self.touch(name)
+            return name
+        return self.wrapped_storage.save(name, content)
+    
+    def touch(self, name):
+        """
+        Sets the modification time of the given file to now, if the wrapped
+        storage keeps files on the local filesystem.
+        """
+        try:
+            path = self.wrapped_storage.path(name)
+        except NotImplementedError:
+            return
+        os.utime(path, None)
+    
+    def iter_files(self):
+        """Yields the names of the stored files."""
+        directories = [self.directory]
+        while directories:
+            directory = directories.pop()
+            if not self.wrapped_storage.exists(directory):
+                continue
+            subdirectories, files = self.wrapped_storage.listdir(directory)
+            directories.extend([posixpath.join(directory, subdirectory) for subdirectory in subdirectories])
+            for name in files:
+                yield posixpath.join(directory, name)
+
+
+def _get_storages():
+    """
+    Returns a list of the content addressed storage wrappers of the file
+    fields of registered models, with one wrapper for each distinct storage
+    and directory.
+    """
+    from reversion.revisions import revision
+    storages = {}
+    for model_class in revision.get_registered_models():
+        for field in revision.get_registration_info(model_class).file_fields:
+            if isinstance(field.storage, ContentAddressedStorageWrapper):
+                storages.setdefault((id(field.storage.wrapped_storage), field.storage.directory), field.storage)
+    return storages.values()
+
+
+def _get_file_fields():
+    """
+    Yields the (model_class, field) pairs of the file fields of every model
+    with a table, rather than just the registered models, so that files are
+    kept for models that are no longer registered.
+    """
+    table_names = set(connection.introspection.table_names())
+    for model_class in models.get_models():
+        if model_class._meta.db_table not in table_names:
+            continue
+        for field in model_class._meta.fields:
+            if isinstance(field, models.FileField):
+                yield model_class, field
+
+
+def get_referenced_files(prefixes):
+    """
+    Returns the set of file names, starting with any of the given prefixes,
+    that are referenced by the file fields of live objects or by the stored
+    versions of any model.
+    
+    References from stored versions are read from the file references that
+    are written with each version, rather than from the versions themselves.
+    """
+    from reversion.models import VersionFile
+    prefixes = tuple(prefixes)
+    referenced = set()
+    for model_class, field in _get_file_fields():
+        query = reduce(operator.or_, [models.Q(**{field.name + "__startswith": prefix}) for prefix in prefixes])
+        names = model_class._default_manager.filter(query).values_list(field.attname, flat=True)
+        referenced.update(names.iterator())
+    query = reduce(operator.or_, [models.Q(name__startswith=prefix) for prefix in prefixes])
+    referenced.update(VersionFile.objects.filter(query).values_list("name", flat=True).iterator())
+    return referenced
+
+
+def is_referenced(name):
+    """
+    Checks whether the given file is referenced by the file field of a live
+    object or by a stored version.
+    """
+    from reversion.models import VersionFile
+    if VersionFile.objects.filter(name=name).exists():
+        return True
+    for model_class, field in _get_file_fields():
+        if model_class._default_manager.filter(**{field.name: name}).exists():
+            return True
+    return False
+
+
+def collect_files(min_age=datetime.timedelta(days=1), dry_run=False, callback=None):
+    """
+    Deletes the content addressed files of registered models that are not
+    referenced by any live object or stored version, returning the number of
+    files deleted.
+
+    Files modified within `min_age` are kept, since they may belong to
+    revisions that have not been saved yet.  Each unreferenced file is checked
+    again just before it is deleted, in case a version referencing it has been
+    saved since the references were read.  If `dry_run` is true, nothing is
+    deleted.  `callback` is called with the name of each unreferenced file.
+    """
+    storages = _get_storages()
+    if not storages:
+        return 0
+    referenced = get_referenced_files([storage.directory + "/" for storage in storages])
+    cutoff = datetime.datetime.now() - min_age
+    count = 0
+    for storage in storages:
+        for name in storage.iter_files():
+            if name in referenced:
+                continue
+            if min_age and storage.wrapped_storage.modified_time(name) > cutoff:
+                continue
+            if is_referenced(name):
+                continue
+            if callback is not None:
+                callback(name)
+            if not dry_run:
+                storage.wrapped_storage.delete(name)
+            count += 1
+    return count
@@ -0,0 +1,142 @@
+"""
+Pluggable storage of versions.
+
+A version store decides how batches of versions are written, and how their
+serialized data is encoded.  The rows of the versions table are kept by every
+store, and are queried directly by the version manager, so a store cannot
+keep versions elsewhere; it may only keep the serialized data of each version
+in another form.
+
+The store is set by the REVERSION_VERSION_STORE setting:
+
+    REVERSION_VERSION_STORE = "reversion.stores.CompressedVersionStore"
+
+The default store keeps the serialized data in the versions table as it is.
+"""
+
+
+from __future__ import with_statement
+
+import base64
+import threading
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from reversion import search, shadow
+from reversion.archive import read_serialized_data
+from reversion.models import Version, VersionHead, ActivityRollup, VersionFile
+
+
+DEFAULT_VERSION_STORE = "reversion.stores.DatabaseVersionStore"
+
+# The prefix of the serialized data of versions compressed by the
+# CompressedVersionStore.
+COMPRESSED_PREFIX = "zlib:"
+
+
+class VersionStore(object):
+
+    """The interface of a version store."""
+
+    def encode(self, serialized_data):
+        """Returns the form in which the given serialized data is stored."""
+        raise NotImplementedError
+
+    def decode(self, stored_data):
+        """Returns the serialized data of the given stored data."""
+        raise NotImplementedError
+
+    def write_batch(self, versions, update_summaries=True):
+        """
+        Saves the given unsaved versions, whose revisions have been saved and
+        set, setting their primary keys.
+        
+        If `update_summaries` is false, the version heads and activity
+        rollups are not updated, and must be rebuilt by the caller.
+        """
+        raise NotImplementedError
+
+
+class DatabaseVersionStore(VersionStore):
+
+    """Stores versions in the versions table, with their serialized data as it is."""
+
+    def encode(self, serialized_data):
+        """Returns the given serialized data."""
+        return serialized_data
+
+    def decode(self, stored_data):
+        """Returns the given stored data, reading it from the archive if required."""
+        return read_serialized_data(stored_data)
+
+    def write_batch(self, versions, update_summaries=True):
+        """
+        Inserts the given versions in bulk, and updates the version heads,
+        activity rollups, file references, shadow tables and search index.
+        """
+        if not versions:
+            return
+        for version in versions:
+            version.serialized_data = self.encode(version.serialized_data)
+        Version.objects.insert_many(versions)
+        Version.objects.assign_pks(versions)
+        if update_summaries:
+            VersionHead.objects.record_versions(versions)
+            ActivityRollup.objects.record_versions(versions)
+        VersionFile.objects.record_versions(versions)
+        shadow.record_versions(versions)
+        if search.is_enabled():
+            search.index_versions(versions)
+
+
+class CompressedVersionStore(DatabaseVersionStore):
+
+    """Stores the serialized data of versions compressed with zlib."""
+
+    def __init__(self, level=6):
+        """Initializes the CompressedVersionStore."""
+        self.level = level
+
+    def encode(self, serialized_data):
+        """Returns the given serialized data, compressed and base64 encoded."""
+        if isinstance(serialized_data, basestring) and serialized_data.startswith(COMPRESSED_PREFIX):
+            return serialized_data
+        compressed = zlib.compress(unicode(serialized_data).encode("utf8"), self.level)
+        return COMPRESSED_PREFIX + base64.b64encode(compressed)
+
+    def decode(self, stored_data):
+        """Returns the serialized data of the given stored data, decompressing it if required."""
+        stored_data = super(CompressedVersionStore, self).decode(stored_data)
+        if stored_data.startswith(COMPRESSED_PREFIX):
+            return zlib.decompress(base64.b64decode(stored_data[len(COMPRESSED_PREFIX):])).decode("utf8")
+        return stored_data
+
+
+_store = None
+
+_store_lock = threading.Lock()
+
+
+def get_version_store():
+    """Returns the version store configured by the REVERSION_VERSION_STORE setting."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            path = getattr(settings, "REVERSION_VERSION_STORE", DEFAULT_VERSION_STORE)
+            module_name, class_name = path.rsplit(".", 1)
+            try:
+                store_class = getattr(import_module(module_name), class_name)
+            except (ImportError, AttributeError), e:
+                raise ImproperlyConfigured("Could not load the version store %r: %s" % (path, e))
+            _store = store_class()
+        return _store
+
+
+def reset_version_store():
+    """Forgets the version store, so that it is reloaded from the settings."""
+    global _store
+    with _store_lock:
+        _store = None
@@ -0,0 +1,315 @@
+"""
+Constant-memory iteration over large numbers of versions.
+
+    for record in iter_versions(Version.objects.filter(content_type=content_type)):
+        audit(record.object_pk, record.field_dict)
+
+Versions are read in chunks, paging on the primary key, so that neither the
+database cursor nor the queryset result cache holds more than one chunk.  The
+serialized data of each chunk is parsed in a single pass into plain field
+dictionaries, without building model instances.
+
+Deserialization is CPU-bound, so bulk jobs can spread it over a pool of
+worker processes:
+
+    for record in iter_versions(processes=8):
+        ...
+
+Version.objects.as_of() takes the same `processes` argument.
+
+The default pool size is set by the REVERSION_DESERIALIZE_PROCESSES setting.
+Without it, versions are deserialized in the current process.
+"""
+
+
+import collections
+import datetime
+import multiprocessing
+
+from django.conf import settings
+from django.contrib.admin.models import DELETION
+from django.core import serializers
+from django.db import connections, models
+from django.utils import simplejson
+
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class VersionRecord(object):
+
+    """A lightweight, read-only record of a stored version."""
+
+    __slots__ = "pk", "revision_id", "content_type_id", "object_pk", "object_repr", "action_flag", "field_dict",
+
+    def __init__(self, pk, revision_id, content_type_id, object_pk, object_repr, action_flag, field_dict):
+        """Initializes the VersionRecord."""
+        self.pk = pk
+        self.revision_id = revision_id
+        self.content_type_id = content_type_id
+        self.object_pk = object_pk
+        self.object_repr = object_repr
+        self.action_flag = action_flag
+        self.field_dict = field_dict
+
+    def is_deletion(self):
+        """Checks whether this version records the deletion of its object."""
+        return self.action_flag == DELETION
+
+    def __repr__(self):
+        """Returns a representation of the record."""
+        return "<VersionRecord %s: %s>" % (self.pk, self.object_repr)
+
+
+class FieldConverter(object):
+
+    """Converts serialized field values of a model to python values."""
+
+    __slots__ = "pk_name", "fields",
+
+    def __init__(self, model_class):
+        """Initializes the FieldConverter."""
+        opts = model_class._meta
+        self.pk_name = opts.pk.name
+        self.fields = dict([(field.name, field) for field in opts.fields])
+
+    def convert(self, pk, fields):
+        """Returns the field dictionary of a serialized object."""
+        result = {}
+        for name, value in fields.iteritems():
+            field = self.fields.get(name)
+            if field is not None and value is not None and not field.rel:
+                value = field.to_python(value)
+            result[name] = value
+        pk_field = self.fields[self.pk_name]
+        if not pk_field.rel:
+            pk = pk_field.to_python(pk)
+        result[self.pk_name] = pk
+        return result
+
+
+_converters = {}
+
+
+def _get_converter(label):
+    """Returns the field converter for the model with the given app_label.model_name label."""
+    try:
+        return _converters[label]
+    except KeyError:
+        model_class = models.get_model(*label.split("."))
+        converter = _converters[label] = model_class and FieldConverter(model_class)
+        return converter
+
+
+def _merge_objects(objects):
+    """
+    Returns the field dictionary of a version from its serialized objects,
+    which include the parents of inherited models.
+    """
+    result = {}
+    # The fields of child models override the fields of their parents.
+    for obj in reversed(objects):
+        converter = _get_converter(obj["model"])
+        if converter is None:
+            result.update(obj["fields"])
+        else:
+            result.update(converter.convert(obj["pk"], obj["fields"]))
+    return result
+
+
+def _deserialize_model_objects(serialized_data, format):
+    """Returns the field dictionary of a payload in a format that cannot be parsed directly."""
+    result = {}
+    for deserialized in reversed(list(serializers.deserialize(format, serialized_data.encode("utf8")))):
+        obj = deserialized.object
+        for field in obj._meta.fields:
+            result[field.name] = field.value_from_object(obj)
+        result.update(deserialized.m2m_data)
+    return result
+
+
+def deserialize_payloads(rows):
+    """
+    Returns the field dictionaries of the given (format, serialized_data)
+    rows, whose serialized data has been read from the archive.
+
+    The JSON payloads of a chunk are decoded together in a single pass, and
+    python payloads are evaluated directly.  Other formats are deserialized
+    through Django, one payload at a time.
+    """
+    results = [None] * len(rows)
+    json_positions = []
+    json_payloads = []
+    for position, (format, serialized_data) in enumerate(rows):
+        if format == "json":
+            json_positions.append(position)
+            json_payloads.append(serialized_data)
+        elif format == "python":
+            # Unsaved versions hold the serialized objects themselves.
+            if isinstance(serialized_data, basestring):
+                serialized_data = eval(serialized_data, {"datetime": datetime})
+            results[position] = _merge_objects(serialized_data)
+        else:
+            results[position] = _deserialize_model_objects(serialized_data, format)
+    if json_payloads:
+        decoded = simplejson.loads(u"[%s]" % u",".join(json_payloads))
+        for position, objects in zip(json_positions, decoded):
+            results[position] = _merge_objects(objects)
+    return results
+
+
+def _read_payload(serialized_data):
+    """Returns the serialized data of the given stored data."""
+    from reversion.stores import get_version_store
+    if isinstance(serialized_data, basestring):
+        return get_version_store().decode(serialized_data)
+    return serialized_data
+
+
+def deserialize_chunk(rows):
+    """Returns the field dictionaries of the given (format, serialized_data) rows."""
+    return deserialize_payloads([(format, _read_payload(serialized_data))
+                                 for format, serialized_data in rows])
+
+
+def build_instance(model_class, field_dict):
+    """
+    Returns an unsaved instance of the given model from a field dictionary
+    returned by deserialize_chunk().  Many-to-many values are not set.
+    """
+    kwargs = {}
+    for field in model_class._meta.fields:
+        if field.name in field_dict:
+            kwargs[field.attname] = field_dict[field.name]
+    return model_class(**kwargs)
+
+
+def _init_worker():
+    """
+    Drops the database connections inherited by a worker process, which are
+    still in use by the parent process.
+    """
+    for connection in connections.all():
+        connection.connection = None
+
+
+def get_process_count(processes=None):
+    """
+    Returns the number of worker processes to deserialize with, from the given
+    count or the REVERSION_DESERIALIZE_PROCESSES setting.
+    """
+    if processes is None:
+        processes = getattr(settings, "REVERSION_DESERIALIZE_PROCESSES", None)
+    return processes or 0
+
+
+class DeserializerPool(object):
+
+    """
+    A pool of worker processes that deserialize chunks of versions, returning
+    them in the order they were submitted.
+    """
+
+    def __init__(self, processes):
+        """
+        Initializes the DeserializerPool.
+
+        At most two chunks per process are in flight at a time, so that the
+        memory used does not grow with the number of chunks.
+        """
+        self.max_pending = processes * 2
+        self._pool = multiprocessing.Pool(processes, _init_worker)
+        self._pending = collections.deque()
+
+    def submit(self, chunk, rows):
+        """
+        Submits the given (format, serialized_data) rows for deserialization,
+        along with a chunk of data that is returned with their results.
+        """
+        # Stored data is decoded here, since the archive is not shared with
+        # the workers.
+        rows = [(format, _read_payload(serialized_data)) for format, serialized_data in rows]
+        self._pending.append((chunk, self._pool.apply_async(deserialize_payloads, (rows,))))
+
+    def is_full(self):
+        """Checks whether the maximum number of chunks are in flight."""
+        return len(self._pending) >= self.max_pending
+
+    def has_pending(self):
+        """Checks whether any chunks are in flight."""
+        return bool(self._pending)
+
+    def get(self):
+        """Returns the oldest submitted chunk and its field dictionaries."""
+        chunk, result = self._pending.popleft()
+        return chunk, result.get()
+
+    def close(self):
+        """Stops the worker processes."""
+        self._pool.terminate()
+        self._pool.join()
+
+
+def _iter_chunks(queryset, chunk_size):
+    """Yields chunks of version rows from the given queryset, paging on the primary key."""
+    queryset = queryset.order_by("pk")
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk.values_list("pk", "revision", "content_type", "object_id", "object_key",
+                                       "object_repr", "action_flag", "format", "serialized_data")[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1][0]
+        yield chunk
+
+
+def _make_records(chunk, field_dicts):
+    """Yields the version records of a chunk of version rows."""
+    for row, field_dict in zip(chunk, field_dicts):
+        pk, revision_id, content_type_id, object_id, object_key, object_repr, action_flag = row[:7]
+        if object_id is None:
+            object_pk = object_key
+        else:
+            object_pk = object_id
+        yield VersionRecord(pk, revision_id, content_type_id, object_pk, object_repr, action_flag, field_dict)
+
+
+def iter_versions(queryset=None, chunk_size=DEFAULT_CHUNK_SIZE, processes=None):
+    """
+    Yields a VersionRecord for each version in the given queryset, or of every
+    version, in primary key order.
+
+    Versions are fetched `chunk_size` at a time, with each chunk starting
+    after the last primary key of the previous chunk, so the memory used does
+    not grow with the number of versions.  Any ordering of the queryset is
+    ignored.
+
+    If `processes`, or the REVERSION_DESERIALIZE_PROCESSES setting, is more
+    than one, chunks are deserialized in a pool of that many worker
+    processes while the next chunks are fetched.
+    """
+    if queryset is None:
+        from reversion.models import Version
+        queryset = Version.objects.all()
+    processes = get_process_count(processes)
+    if processes <= 1:
+        for chunk in _iter_chunks(queryset, chunk_size):
+            for record in _make_records(chunk, deserialize_chunk([(row[7], row[8]) for row in chunk])):
+                yield record
+        return
+    pool = DeserializerPool(processes)
+    try:
+        for chunk in _iter_chunks(queryset, chunk_size):
+            pool.submit(chunk, [(row[7], row[8]) for row in chunk])
+            if pool.is_full():
+                for record in _make_records(*pool.get()):
+                    yield record
+        while pool.has_pending():
+            for record in _make_records(*pool.get()):
+                yield record
+    finally:
+        pool.close()
@@ -8,13 +8,41 @@ These tests require Python version 2.5 or higher to run.
 from __future__ import with_statement
 
 import datetime
+import os
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
 
-from django.db import models, transaction
+from django.conf import settings
+from django.conf.urls.defaults import patterns, url, include
+from django.contrib import admin
+from django.contrib.admin.models import ADDITION, CHANGE, DELETION
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.core.urlresolvers import clear_url_caches
+from django.db import connection, models, reset_queries, transaction
+from django.db.models.signals import post_save
 from django.test import TestCase
 
 import reversion
-from reversion.models import Version, Revision, VERSION_ADD, VERSION_CHANGE, VERSION_DELETE
+from reversion import archive, search, shadow, spool
+from reversion.admin import VersionAdmin
+from reversion.export import export_versions, import_versions, USERS_BY_ID, USERS_NONE
+from reversion.managers import VersionedQuerySet, supports_window_functions
+from reversion.middleware import LazyRevisionMiddleware
+from reversion.models import Version, VersionHead, ActivityRollup, VersionFile, Revision, VERSION_ADD, VERSION_CHANGE, VERSION_DELETE
+from reversion.restore import restore, RESTORE_CHANGE, RESTORE_DELETE
 from reversion.revisions import RegistrationError, DEFAULT_SERIALIZATION_FORMAT
+from reversion.spool import RevisionSpool
+from reversion.storage import collect_files, is_referenced
+from reversion.stores import COMPRESSED_PREFIX, get_version_store, reset_version_store
+from reversion.stream import iter_versions
 
 
 class TestModel(models.Model):
@@ -58,6 +86,15 @@ class ReversionRegistrationTest(TestCase):
         # Re-register the model.
         reversion.register(TestModel)
         
+    def testSignalsConnectedOnce(self):
+        """Tests that registering more models does not connect more receivers."""
+        receiver_count = len(post_save.receivers)
+        reversion.register(TestRelatedModel)
+        try:
+            self.assertEqual(len(post_save.receivers), receiver_count)
+        finally:
+            reversion.unregister(TestRelatedModel)
+        
     def tearDown(self):
         """Tears down the tests."""
         reversion.unregister(TestModel)
@@ -108,6 +145,111 @@ class ReversionCreateTest(TestCase):
             transaction.rollback()
         # Check that there is still only one revision.
         self.assertEqual(Version.objects.get_for_object(test).count(), 1)
+
+    def testRevisionStats(self):
+        """Tests that revision stats are sent to the stats sink."""
+        recorded = []
+        reversion.revision.stats_sink = lambda revision, stats: recorded.append((revision, stats))
+        try:
+            with reversion.revision:
+                test = TestModel.objects.create(name="test1.0")
+        finally:
+            reversion.revision.stats_sink = None
+        self.assertEqual(len(recorded), 1)
+        revision, stats = recorded[0]
+        self.assertEqual(revision, Version.objects.get_for_object(test)[0].revision)
+        self.assertEqual(stats.object_count, 1)
+        self.assertEqual(stats.dead_object_count, 0)
+        self.assertTrue(stats.serialized_bytes > 0)
+        self.assertTrue(stats.insert_time > 0)
+        
+    def testCanBulkSave(self):
+        """Tests that bulk saved models are added to the revision."""
+        test = TestModel.objects.create(name="test1.0")
+        test.name = "test1.1"
+        with reversion.revision:
+            reversion.bulk_save([test, TestModel(name="test2.0"), TestModel(name="test3.0")])
+        self.assertEqual(Revision.objects.count(), 1)
+        self.assertEqual(TestModel.objects.count(), 3)
+        versions = Version.objects.order_by("object_id")
+        self.assertEqual([version.field_dict["name"] for version in versions], ["test1.1", "test2.0", "test3.0"])
+        self.assertEqual([version.action_flag for version in versions], [CHANGE, ADDITION, ADDITION])
+        
+    def testCanBulkUpdate(self):
+        """Tests that versioned queryset updates are added to the revision."""
+        with reversion.revision:
+            test1 = TestModel.objects.create(name="test1.0")
+            test2 = TestModel.objects.create(name="test2.0")
+        with reversion.revision:
+            self.assertEqual(VersionedQuerySet(TestModel).filter(pk=test1.pk).update(name="test1.1"), 1)
+        self.assertEqual(Version.objects.get_for_object(test1).count(), 2)
+        self.assertEqual(Version.objects.get_for_object(test1).reverse()[0].field_dict["name"], "test1.1")
+        self.assertEqual(Version.objects.get_for_object(test2).count(), 1)
+        # Updates outside a revision are not versioned.
+        VersionedQuerySet(TestModel).update(name="test")
+        self.assertEqual(Version.objects.count(), 3)
+        
+    def tearDown(self):
+        """Tears down the tests."""
+        # Unregister the model.
+        reversion.unregister(TestModel)
+        # Clear the database.
+        Version.objects.all().delete()
+        TestModel.objects.all().delete()
+        
+        
+class ReversionCoalesceTest(TestCase):
+    
+    """Tests the coalescing of versions saved within a time window."""
+    
+    def setUp(self):
+        """Sets up the TestModel."""
+        # Clear the database.
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestModel.objects.all().delete()
+        # Register the model.
+        reversion.register(TestModel, coalesce_window=60)
+        with reversion.revision:
+            self.test = TestModel.objects.create(name="test1.0")
+    
+    def testVersionsCoalesced(self):
+        """Tests that saves within the window update the latest version."""
+        with reversion.revision:
+            self.test.name = "test1.1"
+            self.test.save()
+        self.assertEqual(Revision.objects.count(), 1)
+        self.assertEqual(Version.objects.get_for_object(self.test).get().field_dict["name"], "test1.1")
+    
+    def testVersionsNotCoalescedForOtherUser(self):
+        """Tests that saves by another user add a new version."""
+        with reversion.revision:
+            self.test.name = "test1.1"
+            self.test.save()
+            reversion.revision.user = User.objects.create(username="coalesce")
+        self.assertEqual(Version.objects.get_for_object(self.test).count(), 2)
+
+    def testVersionNotReplacedAfterNewerVersion(self):
+        """Tests that the latest version is not replaced once a newer version has been added."""
+        latest = Version.objects.get_for_object(self.test).get()
+        with reversion.revision:
+            self.test.name = "test1.1"
+            self.test.save()
+            reversion.revision.user = User.objects.create(username="coalesce")
+        self.assertFalse(Version.objects.replace_latest(latest, latest.serialized_data.replace("test1.0", "test1.2"), u"test1.2"))
+        self.assertEqual([version.field_dict["name"] for version in Version.objects.get_for_object(self.test)],
+                         ["test1.0", "test1.1"])
+        newest = Version.objects.get_for_object(self.test)[1]
+        self.assertTrue(Version.objects.replace_latest(newest, newest.serialized_data.replace("test1.1", "test1.2"), u"test1.2"))
+        self.assertEqual(Version.objects.get(pk=newest.pk).field_dict["name"], "test1.2")
+
+    def testVersionsNotCoalescedOutsideWindow(self):
+        """Tests that saves after the window add a new version."""
+        Revision.objects.update(date_created=datetime.datetime.now() - datetime.timedelta(minutes=2))
+        with reversion.revision:
+            self.test.name = "test1.1"
+            self.test.save()
+        self.assertEqual(Version.objects.get_for_object(self.test).count(), 2)
         
     def tearDown(self):
         """Tears down the tests."""
@@ -115,7 +257,11 @@ class ReversionCreateTest(TestCase):
         reversion.unregister(TestModel)
         # Clear the database.
         Version.objects.all().delete()
+        Revision.objects.all().delete()
         TestModel.objects.all().delete()
+        User.objects.all().delete()
+        # Clear references.
+        del self.test
         
         
 class ReversionQueryTest(TestCase):
@@ -161,6 +307,175 @@ class ReversionQueryTest(TestCase):
     def testCanGetForDate(self):
         """Tests that the latest version for a particular date can be loaded."""
         self.assertEqual(Version.objects.get_for_date(self.test, datetime.datetime.now()).field_dict["name"], "test1.2")
+        # Dates before the latest revision fall back to the versions table.
+        first_revision = Version.objects.get_for_object(self.test)[0].revision
+        Revision.objects.exclude(pk=first_revision.pk).update(date_created=datetime.datetime.now() + datetime.timedelta(days=1))
+        VersionHead.objects.rebuild()
+        self.assertEqual(Version.objects.get_for_date(self.test, datetime.datetime.now()).field_dict["name"], "test1.0")
+        
+    def testCanGetNeighbours(self):
+        """Tests that the previous and next versions of a version can be found."""
+        versions = list(Version.objects.get_for_object(self.test))
+        self.assertEqual(Version.objects.get_next(versions[0]), versions[1])
+        self.assertEqual(Version.objects.get_next(versions[2]), None)
+        self.assertEqual(Version.objects.get_previous(versions[2]), versions[1])
+        self.assertEqual(Version.objects.get_previous(versions[0]), None)
+        
+    def testCanAnnotateNeighbours(self):
+        """Tests that a list of versions can be annotated with their neighbours."""
+        with reversion.revision:
+            other = TestModel.objects.create(name="other1.0")
+        versions = list(Version.objects.get_for_object(self.test))
+        expected = [(None, None, versions[1].pk, versions[1].revision.date_created),
+                    (versions[0].pk, versions[0].revision.date_created, versions[2].pk, versions[2].revision.date_created),
+                    (versions[1].pk, versions[1].revision.date_created, None, None),
+                    (None, None, None, None)]
+        for use_window in (True, False):
+            if use_window and not supports_window_functions(connection):
+                continue
+            annotated = Version.objects.annotate_neighbours(Version.objects.order_by("pk"), use_window=use_window)
+            self.assertEqual([(version.previous_version_id, version.previous_revision_date,
+                               version.next_version_id, version.next_revision_date) for version in annotated], expected)
+        # The window query runs once for any number of versions.
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            Version.objects.annotate_neighbours(versions)
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+        self.assertEqual(len(connection.queries) - start, supports_window_functions(connection) and 1 or 3)
+        
+    def testVersionHeads(self):
+        """Tests that the head of an object tracks its latest version."""
+        versions = Version.objects.get_for_object(self.test)
+        self.assertEqual(Version.objects.get_latest_for_object(self.test), versions[2])
+        self.assertEqual(Version.objects.get_count_for_object(self.test), 3)
+        self.assertEqual(Version.objects.get_count_for_object(TestModel(pk=self.test.pk + 1)), 0)
+        head = VersionHead.objects.get()
+        self.assertEqual(head.revision_date, versions[2].revision.date_created)
+        self.assertFalse(head.is_deleted)
+        with reversion.revision:
+            self.test.delete()
+        head = VersionHead.objects.get()
+        self.assertEqual(head.version_count, 4)
+        self.assertTrue(head.is_deleted)
+        # Rebuilding the heads gives the same result.
+        VersionHead.objects.rebuild()
+        self.assertEqual(VersionHead.objects.values_list("version", "version_count", "is_deleted").get(),
+                         (head.version_id, 4, True))
+
+    def testVersionHeadsNotMovedBack(self):
+        """Tests that heads are counted but not moved back by older versions written later."""
+        versions = Version.objects.get_for_object(self.test)
+        # A writer that commits after the latest version counts its version.
+        VersionHead.objects.record_versions(Version.objects.filter(pk=versions[1].pk))
+        self.assertEqual(VersionHead.objects.values_list("version", "version_count").get(), (versions[2].pk, 4))
+        # A head created by a concurrent writer is updated instead of inserted.
+        VersionHead.objects._insert_many_heads([VersionHead(content_type=versions[2].content_type,
+                                                            object_id=self.test.pk,
+                                                            version=versions[1],
+                                                            version_count=1,
+                                                            revision_date=versions[1].revision.date_created)])
+        self.assertEqual(VersionHead.objects.values_list("version", "version_count").get(), (versions[2].pk, 5))
+
+    def testCanGetAsOf(self):
+        """Tests that all objects of a model can be reconstructed for a date."""
+        objs = list(Version.objects.as_of(TestModel, datetime.datetime.now()))
+        self.assertEqual(len(objs), 1)
+        self.assertEqual(objs[0].name, "test1.2")
+        self.assertEqual(objs[0].pk, self.test.pk)
+        # Each chunk is loaded and deserialized together.
+        with reversion.revision:
+            TestModel.objects.create(name="test2.0")
+            TestModel.objects.create(name="test3.0")
+        self.assertNumQueries(2, lambda: list(Version.objects.as_of(TestModel, datetime.datetime.now())))
+        self.assertEqual([obj.name for obj in Version.objects.as_of(TestModel, datetime.datetime.now(), chunk_size=2)],
+                         ["test1.2", "test2.0", "test3.0"])
+        # Chunks can be deserialized in worker processes.
+        self.assertEqual([(obj.pk, obj.name) for obj in Version.objects.as_of(TestModel, datetime.datetime.now(),
+                                                                               chunk_size=1, processes=2)],
+                         [(obj.pk, obj.name) for obj in Version.objects.as_of(TestModel, datetime.datetime.now())])
+        with reversion.revision:
+            for obj in TestModel.objects.exclude(pk=self.test.pk):
+                obj.delete()
+        # Objects that did not exist yet are not returned.
+        self.assertEqual(list(Version.objects.as_of(TestModel.objects.all(), datetime.datetime(1970, 1, 1))), [])
+        # Deleted objects are not returned.
+        with reversion.revision:
+            self.test.delete()
+        self.assertEqual(list(Version.objects.as_of(TestModel, datetime.datetime.now())), [])
+
+    def testCanRestore(self):
+        """Tests that many objects can be restored to their state at a date."""
+        date = datetime.datetime.now()
+        TestModel.objects.filter(pk=self.test.pk).update(name="test1.3")
+        # Dry runs make no changes.
+        changes = restore(TestModel, date, dry_run=True)
+        self.assertEqual([action for action, version in changes], [RESTORE_CHANGE])
+        self.assertEqual(TestModel.objects.get().name, "test1.3")
+        # Restore the model.
+        progress = []
+        restore(TestModel.objects.all(), date, callback=lambda *args: progress.append(args))
+        self.assertEqual(TestModel.objects.get().name, "test1.2")
+        self.assertEqual(progress, [(1, 1, self.test.pk)])
+        # Resuming skips objects that have already been processed.
+        self.assertEqual(restore(TestModel, date, resume_after=self.test.pk), [])
+        # Objects created after the date are only deleted if asked.
+        with reversion.revision:
+            later = TestModel.objects.create(name="later1.0")
+        self.assertEqual(restore(TestModel, date), [])
+        changes = restore(TestModel.objects.all(), date, delete=True)
+        self.assertEqual([(action, version.object_pk) for action, version in changes], [(RESTORE_DELETE, later.pk)])
+        self.assertEqual(list(TestModel.objects.values_list("pk", flat=True)), [self.test.pk])
+
+    def testCanExportAndImportVersions(self):
+        """Tests that revision history can be exported and imported as NDJSON."""
+        stream = StringIO()
+        self.assertEqual(export_versions(stream, model_classes=[TestModel], chunk_size=2), (3, 3))
+        # Limit the export by revision id.
+        first_revision_id = Version.objects.get_for_object(self.test)[0].revision_id
+        self.assertEqual(export_versions(StringIO(), revision_to=first_revision_id), (1, 1))
+        # Import the history again, as new revisions.
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        stream.seek(0)
+        self.assertEqual(import_versions(stream, chunk_size=2), (3, 3))
+        self.assertEqual(Revision.objects.count(), 3)
+        versions = Version.objects.get_for_object(self.test)
+        self.assertEqual([version.field_dict["name"] for version in versions], ["test1.0", "test1.1", "test1.2"])
+        self.assertEqual(len(set([version.revision_id for version in versions])), 3)
+        self.assertEqual(VersionHead.objects.values_list("version", "version_count").get(), (versions[2].pk, 3))
+        self.assertEqual(ActivityRollup.objects.values_list("addition_count", "change_count").get(), (1, 2))
+        # Importing the same history again changes nothing.
+        stream.seek(0)
+        self.assertEqual(import_versions(stream, chunk_size=2), (0, 0))
+        self.assertEqual(Version.objects.get_for_object(self.test).count(), 3)
+        self.assertEqual(VersionHead.objects.values_list("version", "version_count").get(), (versions[2].pk, 3))
+        self.assertEqual(ActivityRollup.objects.values_list("addition_count", "change_count").get(), (1, 2))
+
+    def testImportedUsersMapped(self):
+        """Tests that the users of imported revisions are found in this database."""
+        user = User.objects.create(username="exporter")
+        Revision.objects.update(user=user)
+        dates = list(Revision.objects.order_by("pk").values_list("date_created", flat=True))
+        stream = StringIO()
+        export_versions(stream)
+        # Another user has the username of the exported user in this database.
+        user.username = "renamed"
+        user.save()
+        other = User.objects.create(username="exporter")
+        def reimport(**kwargs):
+            Version.objects.all().delete()
+            Revision.objects.all().delete()
+            stream.seek(0)
+            self.assertEqual(import_versions(stream, **kwargs), (3, 3))
+            return list(Revision.objects.order_by("pk").values_list("user", flat=True))
+        self.assertEqual(reimport(), [other.pk] * 3)
+        self.assertEqual(list(Revision.objects.order_by("pk").values_list("date_created", flat=True)), dates)
+        self.assertEqual(reimport(users=USERS_BY_ID), [user.pk] * 3)
+        self.assertEqual(reimport(users=USERS_NONE), [None] * 3)
+        User.objects.all().delete()
     
     def testCanRevert(self):
         """Tests that an object can be reverted to a previous revision."""
@@ -264,8 +579,85 @@ class ReversionCustomRegistrationTest(TestCase):
         TestModel.objects.all().delete()
         # Clear references.
         del self.test
-        
-        
+
+
+class TestKeyedModel(models.Model):
+
+    """A model with a string primary key, used to test Reversion."""
+
+    key = models.CharField(max_length=36,
+                           primary_key=True)
+
+    name = models.CharField(max_length=100)
+
+    class Meta:
+        app_label = "reversion"
+
+
+class ReversionStringKeyTest(TestCase):
+
+    """Tests the versioning of models with string primary keys."""
+
+    def setUp(self):
+        """Sets up the TestKeyedModel."""
+        reversion.register(TestKeyedModel)
+        with reversion.revision:
+            self.test = TestKeyedModel.objects.create(key="0f4c9a2e-key", name="test1.0")
+        with reversion.revision:
+            self.test.name = "test1.1"
+            self.test.save()
+
+    def testCanGetVersions(self):
+        """Tests that versions are stored and found by their string key."""
+        versions = Version.objects.get_for_object(self.test)
+        self.assertEqual([version.field_dict["name"] for version in versions], ["test1.0", "test1.1"])
+        self.assertEqual([version.object_pk for version in versions], ["0f4c9a2e-key", "0f4c9a2e-key"])
+        self.assertEqual(versions[0].object_id, None)
+        self.assertEqual(Version.objects.get_next(versions[0]), versions[1])
+        self.assertEqual(Version.objects.get_previous(versions[1]), versions[0])
+        for use_window in (True, False):
+            if use_window and not supports_window_functions(connection):
+                continue
+            annotated = Version.objects.annotate_neighbours(versions, use_window=use_window)
+            self.assertEqual([(version.previous_version_id, version.next_version_id) for version in annotated],
+                             [(None, versions[1].pk), (versions[0].pk, None)])
+        self.assertEqual(Revision.objects.get_for_object(self.test).count(), 2)
+
+    def testCanRestore(self):
+        """Tests that objects with string keys can be restored and resumed."""
+        date = datetime.datetime.now()
+        TestKeyedModel.objects.filter(pk=self.test.pk).update(name="test1.2")
+        progress = []
+        changes = restore(TestKeyedModel, date, callback=lambda *args: progress.append(args))
+        self.assertEqual([(action, version.object_pk) for action, version in changes], [(RESTORE_CHANGE, "0f4c9a2e-key")])
+        self.assertEqual(TestKeyedModel.objects.get().name, "test1.1")
+        self.assertEqual(progress, [(1, 1, "0f4c9a2e-key")])
+        self.assertEqual(restore(TestKeyedModel, date, resume_after="0f4c9a2e-key"), [])
+
+    def testCanRecoverDeleted(self):
+        """Tests that deleted objects with string keys are found and recovered."""
+        with reversion.revision:
+            TestKeyedModel.objects.create(key="live", name="live")
+        with reversion.revision:
+            self.test.delete()
+        deleted = Version.objects.get_deleted(TestKeyedModel)
+        self.assertEqual([version.object_pk for version in deleted], ["0f4c9a2e-key"])
+        Version.objects.get_deleted_object(TestKeyedModel, "0f4c9a2e-key").revert()
+        self.assertEqual(TestKeyedModel.objects.get(pk="0f4c9a2e-key").name, "test1.1")
+        self.assertEqual(Version.objects.get_deleted(TestKeyedModel), [])
+
+    def tearDown(self):
+        """Tears down the tests."""
+        # Unregister the model.
+        reversion.unregister(TestKeyedModel)
+        # Clear the database.
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestKeyedModel.objects.all().delete()
+        # Clear references.
+        del self.test
+
+
 class TestRelatedModel(models.Model):
     
     """A model used to test Reversion relation following."""
@@ -328,7 +720,38 @@ class ReversionRelatedTest(TestCase):
         Version.objects.get_for_object(test)[0].revision.revert()
         self.assertEqual(TestModel.objects.get().name, "test1.0")
         self.assertEqual(TestRelatedModel.objects.get().name, "related1.0")
-        
+
+    def testCanRevertRevisionWithDelete(self):
+        """Tests that reverting a revision can delete newly related objects."""
+        with reversion.revision:
+            test = TestModel.objects.create(name="test1.0")
+            related = TestRelatedModel.objects.create(name="related1.0", relation=test)
+        with reversion.revision:
+            TestRelatedModel.objects.create(name="related2.0", relation=test)
+        # Attempt revert.
+        Version.objects.get_for_object(test)[0].revision.revert(delete=True)
+        self.assertEqual(TestModel.objects.get().name, "test1.0")
+        self.assertEqual(TestRelatedModel.objects.get().name, "related1.0")
+
+    def testCanBulkDelete(self):
+        """Tests that cascaded queryset deletions are added to the revision."""
+        with reversion.revision:
+            for n in xrange(2):
+                test = TestModel.objects.create(name="test%s.0" % n)
+                TestRelatedModel.objects.create(name="related%s.0" % n, relation=test)
+        with reversion.revision:
+            VersionedQuerySet(TestModel).delete()
+        self.assertEqual(TestModel.objects.count(), 0)
+        self.assertEqual(TestRelatedModel.objects.count(), 0)
+        self.assertEqual(Revision.objects.count(), 2)
+        self.assertEqual(len(Version.objects.get_deleted(TestModel)), 2)
+        self.assertEqual(len(Version.objects.get_deleted(TestRelatedModel)), 2)
+        # Recover the deleted models.
+        Version.objects.get_deleted(TestRelatedModel)[0].revision.revert()
+        self.assertEqual(TestModel.objects.count(), 2)
+        self.assertEqual(TestRelatedModel.objects.count(), 2)
+        self.assertEqual(sorted(TestRelatedModel.objects.values_list("name", flat=True)), ["related0.0", "related1.0"])
+
     def testCanRecoverRevision(self):
         """Tests that an entire revision can be recovered."""
         with reversion.revision:
@@ -442,6 +865,20 @@ class ReversionManyToManyTest(TestCase):
         self.assertEqual(Revision.objects.count(), 2)
         self.assertEqual(Version.objects.get_for_object(test)[0].revision.version_set.all().count(), 3)
     
+    def testCanRestoreRelations(self):
+        """Tests that objects whose relations alone have changed are restored."""
+        with reversion.revision:
+            test1 = TestModel.objects.create(name="test1.0")
+            test2 = TestModel.objects.create(name="test2.0")
+            related = TestManyToManyModel.objects.create(name="related1.0")
+            related.relations.add(test1)
+        date = datetime.datetime.now()
+        related.relations.add(test2)
+        changes = restore(TestManyToManyModel, date)
+        self.assertEqual([(action, version.object_pk) for action, version in changes], [(RESTORE_CHANGE, related.pk)])
+        self.assertEqual(list(related.relations.values_list("pk", flat=True)), [test1.pk])
+        self.assertEqual(restore(TestManyToManyModel, date), [])
+    
     def testCanRevertRevision(self):
         """Tests that an entire revision can be reverted."""
         with reversion.revision:
@@ -512,6 +949,875 @@ class ReversionManyToManyTest(TestCase):
         TestManyToManyModel.objects.all().delete()
 
 
+class ReversionActivityTest(TestCase):
+    
+    """Tests the per user, model and day activity rollups."""
+    
+    def setUp(self):
+        """Sets up the models and some revisions."""
+        reversion.register(TestModel)
+        reversion.register(TestRelatedModel)
+        self.user = User.objects.create(username="activity")
+        with reversion.revision:
+            reversion.revision.user = self.user
+            self.test = TestModel.objects.create(name="test1.0")
+            TestRelatedModel.objects.create(name="related1.0", relation=self.test)
+        with reversion.revision:
+            self.test.name = "test1.1"
+            self.test.save()
+        with reversion.revision:
+            reversion.revision.user = self.user
+            self.test.testrelatedmodel_set.all().delete()
+    
+    def getActivity(self, **kwargs):
+        """Returns the activity as a list of tuples."""
+        return [(row["user"], row["content_type"], row["additions"], row["changes"], row["deletions"])
+                for row in Revision.objects.get_activity(group_by=("user", "content_type"), **kwargs)]
+    
+    def testActivityRecorded(self):
+        """Tests that saved revisions are added to the rollups."""
+        test_type = ContentType.objects.get_for_model(TestModel).pk
+        related_type = ContentType.objects.get_for_model(TestRelatedModel).pk
+        self.assertEqual(self.getActivity(), sorted([(None, test_type, 0, 1, 0),
+                                                     (self.user.pk, test_type, 1, 0, 0),
+                                                     (self.user.pk, related_type, 1, 0, 1)]))
+        self.assertEqual(self.getActivity(user=self.user, model=TestRelatedModel), [(self.user.pk, related_type, 1, 0, 1)])
+        today = datetime.date.today()
+        self.assertEqual(list(Revision.objects.get_activity(start=today, end=today, group_by=("day",))),
+                         [{"day": today, "additions": 2, "changes": 1, "deletions": 1}])
+        self.assertEqual(list(Revision.objects.get_activity(end=today - datetime.timedelta(days=1))), [])
+
+    def testConcurrentRollupsAdded(self):
+        """Tests that rollups created by a concurrent writer are added to rather than inserted."""
+        test_type = ContentType.objects.get_for_model(TestModel).pk
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        ActivityRollup.objects._insert_many_rollups([
+            ActivityRollup(day=datetime.date.today(), user=self.user, content_type_id=test_type, change_count=2),
+            ActivityRollup(day=yesterday, user=self.user, content_type_id=test_type, addition_count=1),
+        ])
+        self.assertEqual(self.getActivity(user=self.user, model=TestModel), [(self.user.pk, test_type, 2, 2, 0)])
+        self.assertEqual(ActivityRollup.objects.filter(user=self.user, content_type=test_type).count(), 2)
+
+    def testActivityRebuilt(self):
+        """Tests that the rollups can be rebuilt from existing revisions."""
+        activity = self.getActivity()
+        ActivityRollup.objects.all().delete()
+        ActivityRollup.objects.create(day=datetime.date(2000, 1, 1), content_type=ContentType.objects.get_for_model(TestModel))
+        self.assertEqual(ActivityRollup.objects.rebuild(chunk_days=1), 3)
+        self.assertEqual(self.getActivity(), activity)
+        # Rebuilding recent days leaves older days alone.
+        ActivityRollup.objects.all().delete()
+        self.assertEqual(ActivityRollup.objects.rebuild(since=datetime.date.today() + datetime.timedelta(days=1)), 0)
+        self.assertEqual(ActivityRollup.objects.rebuild(since=datetime.date.today()), 3)
+        self.assertEqual(self.getActivity(), activity)
+    
+    def tearDown(self):
+        """Tears down the tests."""
+        reversion.unregister(TestModel)
+        reversion.unregister(TestRelatedModel)
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        ActivityRollup.objects.all().delete()
+        TestRelatedModel.objects.all().delete()
+        TestModel.objects.all().delete()
+        User.objects.all().delete()
+
+
+class ReversionArchiveTest(TestCase):
+    
+    """Tests the cold storage archive of serialized data."""
+    
+    def setUp(self):
+        """Sets up the TestModel and a temporary archive."""
+        # Clear the database.
+        Version.objects.all().delete()
+        TestModel.objects.all().delete()
+        # Register the model.
+        reversion.register(TestModel)
+        # Configure a temporary archive.
+        self.archive_root = tempfile.mkdtemp()
+        settings.REVERSION_ARCHIVE_ROOT = self.archive_root
+        archive._archive = None
+        # Create some initial revisions.
+        with reversion.revision:
+            self.test = TestModel.objects.create(name="test1.0")
+        with reversion.revision:
+            self.test.name = "test1.1"
+            self.test.save()
+    
+    def testCanArchiveAndRehydrate(self):
+        """Tests that serialized data can be archived and rehydrated."""
+        serialized_data = [version.serialized_data for version in Version.objects.order_by("pk")]
+        self.assertEqual(archive.archive_versions(datetime.datetime.now() + datetime.timedelta(days=1), chunk_size=1), 2)
+        # Archived versions keep a pointer, and can still be read.
+        versions = Version.objects.order_by("pk")
+        self.assertTrue(archive.is_archived(versions[0].serialized_data))
+        self.assertEqual(versions[0].field_dict["name"], "test1.0")
+        self.assertEqual(versions[1].field_dict["name"], "test1.1")
+        # Already archived versions are skipped.
+        self.assertEqual(archive.archive_versions(datetime.datetime.now() + datetime.timedelta(days=1)), 0)
+        # Rehydrate the versions.
+        self.assertEqual(archive.rehydrate_versions(), 2)
+        self.assertEqual([version.serialized_data for version in Version.objects.order_by("pk")], serialized_data)
+    
+    def testRecentVersionsNotArchived(self):
+        """Tests that only versions older than the given date are archived."""
+        self.assertEqual(archive.archive_versions(datetime.datetime(1970, 1, 1)), 0)
+    
+    def tearDown(self):
+        """Tears down the tests."""
+        # Unregister the model.
+        reversion.unregister(TestModel)
+        # Clear the database.
+        Version.objects.all().delete()
+        TestModel.objects.all().delete()
+        # Remove the archive.
+        archive.get_archive().close()
+        archive._archive = None
+        del settings.REVERSION_ARCHIVE_ROOT
+        shutil.rmtree(self.archive_root)
+        # Clear references.
+        del self.test
+
+
+class ReversionSearchTest(TestCase):
+    
+    """Tests the full-text search index of versions."""
+    
+    def setUp(self):
+        """Sets up the models and a temporary search index."""
+        reversion.register(TestModel, search_fields=("name",))
+        reversion.register(TestRelatedModel, search_fields=("name",))
+        self.search_root = tempfile.mkdtemp()
+        settings.REVERSION_SEARCH_INDEX = os.path.join(self.search_root, "search.db")
+        search.reset_search_backend()
+        with reversion.revision:
+            self.test = TestModel.objects.create(name="red apple")
+            TestRelatedModel.objects.create(name="red cherry", relation=self.test)
+        with reversion.revision:
+            self.test.name = "green apple"
+            self.test.save()
+    
+    def getNames(self, query, **kwargs):
+        """Returns the names of the versions matching the given query."""
+        return [version.field_dict["name"] for version in Version.objects.search(query, **kwargs)]
+    
+    def testCanSearchVersions(self):
+        """Tests that saved versions are indexed and can be searched."""
+        self.assertEqual(sorted(self.getNames("red")), ["red apple", "red cherry"])
+        self.assertEqual(self.getNames("RED apple"), ["red apple"])
+        self.assertEqual(self.getNames("red", model=TestRelatedModel), ["red cherry"])
+        self.assertEqual(sorted(self.getNames("apple", model=(TestModel, TestRelatedModel))), ["green apple", "red apple"])
+        self.assertEqual(self.getNames("banana"), [])
+        self.assertEqual(self.getNames('"'), [])
+    
+    def testResultsRankedByRelevance(self):
+        """Tests that the most relevant versions are returned first."""
+        with reversion.revision:
+            TestModel.objects.create(name="apple apple apple pie")
+        self.assertEqual(self.getNames("apple")[0], "apple apple apple pie")
+    
+    def testCanBackfillIndex(self):
+        """Tests that existing versions can be added to the index."""
+        search.get_search_backend().clear()
+        self.assertEqual(self.getNames("apple"), [])
+        call_command("indexversions", "reversion.TestModel", chunk_size=1, verbosity=0)
+        self.assertEqual(sorted(self.getNames("apple")), ["green apple", "red apple"])
+        self.assertEqual(self.getNames("cherry"), [])
+        search.index_versions(Version.objects.all())
+        # Versions that no longer exist are left out of the results.
+        Version.objects.filter(content_type=ContentType.objects.get_for_model(TestRelatedModel)).delete()
+        self.assertEqual(self.getNames("cherry"), [])
+    
+    def tearDown(self):
+        """Tears down the tests."""
+        reversion.unregister(TestModel)
+        reversion.unregister(TestRelatedModel)
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestRelatedModel.objects.all().delete()
+        TestModel.objects.all().delete()
+        search.reset_search_backend()
+        del settings.REVERSION_SEARCH_INDEX
+        shutil.rmtree(self.search_root)
+        del self.test
+
+
+class ReversionStreamTest(TestCase):
+    
+    """Tests the constant-memory iteration over versions."""
+    
+    def createVersions(self, format):
+        """Registers the models in the given format and creates some versions."""
+        reversion.register(TestModel, format=format)
+        reversion.register(TestRelatedModel, format=format)
+        with reversion.revision:
+            self.test = TestModel.objects.create(name="test1.0")
+            TestRelatedModel.objects.create(name="related1.0", relation=self.test)
+        with reversion.revision:
+            self.test.name = "test1.1"
+            self.test.save()
+        with reversion.revision:
+            self.test.testrelatedmodel_set.all().delete()
+    
+    def assertMatchesVersions(self, queryset, chunk_size):
+        """Checks that the streamed records match the given versions."""
+        records = list(iter_versions(queryset, chunk_size=chunk_size))
+        versions = list(queryset.order_by("pk"))
+        self.assertEqual([record.pk for record in records], [version.pk for version in versions])
+        for record, version in zip(records, versions):
+            self.assertEqual(record.revision_id, version.revision_id)
+            self.assertEqual(record.content_type_id, version.content_type_id)
+            self.assertEqual(record.object_pk, version.object_pk)
+            self.assertEqual(record.is_deletion(), version.is_deletion())
+            self.assertEqual(record.field_dict, version.field_dict)
+    
+    def testCanStreamJsonVersions(self):
+        """Tests that JSON versions are streamed in chunks."""
+        self.createVersions("json")
+        self.assertMatchesVersions(Version.objects.all(), 2)
+        self.assertMatchesVersions(Version.objects.filter(content_type=ContentType.objects.get_for_model(TestRelatedModel)), 1)
+        self.assertEqual(list(iter_versions(Version.objects.filter(pk=0))), [])
+    
+    def testCanStreamXmlVersions(self):
+        """Tests that versions in other formats are streamed."""
+        self.createVersions("xml")
+        self.assertMatchesVersions(Version.objects.all(), 3)
+    
+    def testCanDeserializeInParallel(self):
+        """Tests that versions can be deserialized in worker processes."""
+        self.createVersions("json")
+        serial = [(record.pk, record.field_dict) for record in iter_versions(chunk_size=1)]
+        parallel = [(record.pk, record.field_dict) for record in iter_versions(chunk_size=1, processes=2)]
+        self.assertEqual(parallel, serial)
+    
+    def tearDown(self):
+        """Tears down the tests."""
+        reversion.unregister(TestModel)
+        reversion.unregister(TestRelatedModel)
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestRelatedModel.objects.all().delete()
+        TestModel.objects.all().delete()
+
+
+class ReversionShadowTableTest(TestCase):
+    
+    """Tests the shadow history tables of versioned models."""
+    
+    def setUp(self):
+        """Sets up the models and some revisions."""
+        reversion.register(TestModel, shadow_table=True, coalesce_window=60)
+        reversion.register(TestRelatedModel)
+        self.history_model = shadow.get_history_model(TestModel)
+        # Create the history table before any data, as rebuildhistorytables
+        # would, since creating tables ends the test transaction on some
+        # databases.
+        shadow.ensure_table(self.history_model)
+        with reversion.revision:
+            self.test = TestModel.objects.create(name="test1.0")
+            TestRelatedModel.objects.create(name="related1.0", relation=self.test)
+        with reversion.revision:
+            self.test.name = "test1.1"
+            self.test.save()
+    
+    def testVersionsWrittenToShadowTable(self):
+        """Tests that versions are written to the history table of their model."""
+        self.assertEqual(self.history_model._meta.db_table, "reversion_testmodel_history")
+        self.assertEqual(self.history_model.history_fields, ("id", "name"))
+        # The coalesced version replaces the first row.
+        rows = list(self.history_model.objects.all())
+        self.assertEqual([(row.id, row.name, row.history_action_flag) for row in rows], [(self.test.pk, "test1.1", ADDITION)])
+        version = rows[0].get_version()
+        self.assertEqual(version.revision_id, rows[0].history_revision_id)
+        self.assertEqual(version.revision.date_created, rows[0].history_date)
+        self.assertEqual(version.get_object_version().object.name, "test1.1")
+        # Only versions of shadowed models are written.
+        self.assertEqual(Version.objects.count(), 2)
+    
+    def testCanQueryHistory(self):
+        """Tests that historical field values can be queried directly."""
+        with reversion.revision:
+            TestModel.objects.create(name="other1.0")
+        test_pk = self.test.pk
+        with reversion.revision:
+            self.test.delete()
+        self.assertEqual(self.history_model.objects.filter(name__startswith="test").count(), 2)
+        self.assertEqual(list(self.history_model.objects.filter(id=test_pk).order_by("pk").values_list("history_action_flag", flat=True)),
+                         [ADDITION, DELETION])
+    
+    def testCanRebuildShadowTable(self):
+        """Tests that the history table can be rebuilt from stored versions."""
+        self.history_model.objects.all().delete()
+        self.assertEqual(shadow.rebuild(TestModel, chunk_size=1), 1)
+        self.assertEqual(list(self.history_model.objects.values_list("name", flat=True)), ["test1.1"])
+        call_command("rebuildhistorytables", "reversion.TestModel", verbosity=0)
+        self.assertEqual(self.history_model.objects.count(), 1)
+    
+    def testMissingShadowTableSkipped(self):
+        """Tests that history tables are not created while versions are written."""
+        reversion.unregister(TestRelatedModel)
+        reversion.register(TestRelatedModel, shadow_table=True)
+        related_history_model = shadow.get_history_model(TestRelatedModel)
+        with reversion.revision:
+            TestRelatedModel.objects.create(name="related2.0", relation=self.test)
+        self.assertEqual(Version.objects.filter(content_type=ContentType.objects.get_for_model(TestRelatedModel)).count(), 2)
+        self.assertFalse(shadow.table_exists(related_history_model))
+    
+    def tearDown(self):
+        """Tears down the tests."""
+        reversion.unregister(TestModel)
+        reversion.unregister(TestRelatedModel)
+        self.history_model.objects.all().delete()
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestRelatedModel.objects.all().delete()
+        TestModel.objects.all().delete()
+        del self.test
+
+
+class VersionStoreConformanceTests(object):
+    
+    """
+    Tests that a version store meets the version store interface.  Test cases
+    for each store mix these tests in, and set `store_path`.
+    """
+    
+    store_path = None
+    
+    def setUp(self):
+        """Sets up the store and some revisions."""
+        settings.REVERSION_VERSION_STORE = self.store_path
+        reset_version_store()
+        self.store = get_version_store()
+        reversion.register(TestModel, format="json")
+        with reversion.revision:
+            self.test = TestModel.objects.create(name="test1.0")
+        with reversion.revision:
+            self.test.name = "test1.1"
+            self.test.save()
+        with reversion.revision:
+            self.other = TestModel.objects.create(name="other1.0")
+    
+    def getNames(self, versions):
+        """Returns the names stored in the given versions."""
+        return [version.get_object_version().object.name for version in versions]
+    
+    def testCanWriteBatch(self):
+        """Tests that batches of versions are saved, with their derived data."""
+        revision = Revision.objects.create()
+        self.test.name = "test1.2"
+        version = Version(revision=revision,
+                          content_type=ContentType.objects.get_for_model(TestModel),
+                          object_id=self.test.pk,
+                          format="json",
+                          serialized_data=serializers.serialize("json", [self.test]),
+                          object_repr=unicode(self.test),
+                          action_flag=CHANGE)
+        self.store.write_batch([version])
+        self.assertTrue(version.pk)
+        self.assertEqual(self.getNames([Version.objects.get(pk=version.pk)]), ["test1.2"])
+        self.assertEqual(Version.objects.get_latest_for_object(self.test).pk, version.pk)
+        self.assertEqual(Version.objects.get_count_for_object(self.test), 3)
+        self.assertEqual(sum(Revision.objects.get_activity().values_list("changes", flat=True)), 2)
+        self.store.write_batch([])
+    
+    def testStoredDataCanBeStreamed(self):
+        """Tests that the stored data of versions can be decoded in bulk."""
+        self.assertEqual([record.field_dict["name"] for record in iter_versions()], ["test1.0", "test1.1", "other1.0"])
+    
+    def tearDown(self):
+        """Tears down the tests."""
+        reversion.unregister(TestModel)
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        VersionHead.objects.all().delete()
+        ActivityRollup.objects.all().delete()
+        TestModel.objects.all().delete()
+        del settings.REVERSION_VERSION_STORE
+        reset_version_store()
+        del self.test
+        del self.other
+
+
+class DatabaseVersionStoreTest(VersionStoreConformanceTests, TestCase):
+    
+    """Tests the default version store."""
+    
+    store_path = "reversion.stores.DatabaseVersionStore"
+
+
+class CompressedVersionStoreTest(VersionStoreConformanceTests, TestCase):
+    
+    """Tests the compressed version store."""
+    
+    store_path = "reversion.stores.CompressedVersionStore"
+    
+    def testStoredDataCompressed(self):
+        """Tests that serialized data is stored compressed."""
+        for serialized_data in Version.objects.values_list("serialized_data", flat=True):
+            self.assertTrue(serialized_data.startswith(COMPRESSED_PREFIX))
+
+
+class TestFileModel(models.Model):
+    
+    """A model used to test version controlled files."""
+    
+    file = models.FileField(upload_to="uploads")
+    
+    class Meta:
+        app_label = "reversion"
+        
+        
+class ReversionContentAddressedFileTest(TestCase):
+    
+    """Tests the content addressed storage of version controlled files."""
+    
+    def setUp(self):
+        """Sets up the model with a temporary file storage."""
+        self.media_root = tempfile.mkdtemp()
+        self.field = TestFileModel._meta.get_field("file")
+        self.original_storage = self.field.storage
+        self.field.storage = FileSystemStorage(location=self.media_root)
+        reversion.register(TestFileModel, content_addressed_files=True)
+    
+    def createObject(self, content):
+        """Creates an object with a file of the given content in a revision."""
+        with reversion.revision:
+            obj = TestFileModel()
+            obj.file.save("upload.txt", ContentFile(content))
+        return obj
+    
+    def getStoredFiles(self):
+        """Returns the names of the stored files."""
+        return sorted(self.field.storage.iter_files())
+    
+    def testIdenticalFilesStoredOnce(self):
+        """Tests that files with the same content are stored once."""
+        first = self.createObject("hello")
+        second = self.createObject("hello")
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertTrue(first.file.name.startswith("versioned/"))
+        self.assertTrue(first.file.name.endswith(".txt"))
+        self.assertEqual(self.getStoredFiles(), [first.file.name])
+        self.assertEqual(open(os.path.join(self.media_root, first.file.name)).read(), "hello")
+        # Deleting an object keeps its file.
+        with reversion.revision:
+            first.delete()
+        self.assertEqual(self.getStoredFiles(), [second.file.name])
+    
+    def testUnreferencedFilesCollected(self):
+        """Tests that only files no longer referenced by objects or versions are deleted."""
+        obj = self.createObject("hello")
+        original_name = obj.file.name
+        with reversion.revision:
+            obj.file.save("upload.txt", ContentFile("goodbye"))
+        orphan_name = self.field.storage.save("orphan.txt", ContentFile("orphan"))
+        # Recent files are kept.
+        self.assertEqual(collect_files(), 0)
+        # The old file is referenced by a version.
+        self.assertEqual(collect_files(min_age=datetime.timedelta(0), dry_run=True), 1)
+        self.assertEqual(collect_files(min_age=datetime.timedelta(0)), 1)
+        self.assertEqual(self.getStoredFiles(), sorted([original_name, obj.file.name]))
+        self.assertFalse(orphan_name in self.getStoredFiles())
+        # Once the versions are gone, only the live file is kept.
+        Version.objects.all().delete()
+        call_command("collectversionfiles", min_age=0, verbosity=0)
+        self.assertEqual(self.getStoredFiles(), [obj.file.name])
+    
+    def testFileReferencesRecorded(self):
+        """Tests that the files referenced by versions are recorded with them."""
+        obj = self.createObject("hello")
+        original_name = obj.file.name
+        with reversion.revision:
+            obj.file.save("upload.txt", ContentFile("goodbye"))
+        self.assertEqual(sorted(VersionFile.objects.values_list("name", flat=True)), sorted([original_name, obj.file.name]))
+        self.assertTrue(is_referenced(original_name))
+        # References are deleted with their versions.
+        Version.objects.all().delete()
+        self.assertEqual(VersionFile.objects.count(), 0)
+        self.assertFalse(is_referenced(original_name))
+        self.assertTrue(is_referenced(obj.file.name))
+    
+    def testReusedFilesKept(self):
+        """Tests that saving an existing file again protects it from collection."""
+        obj = self.createObject("hello")
+        path = os.path.join(self.media_root, obj.file.name)
+        old_time = time.time() - 7 * 24 * 60 * 60
+        os.utime(path, (old_time, old_time))
+        with reversion.revision:
+            obj.delete()
+        Version.objects.all().delete()
+        self.assertEqual(self.field.storage.save("upload.txt", ContentFile("hello")), obj.file.name)
+        self.assertTrue(os.path.getmtime(path) > old_time)
+        self.assertEqual(collect_files(), 0)
+        self.assertEqual(self.getStoredFiles(), [obj.file.name])
+    
+    def tearDown(self):
+        """Tears down the tests."""
+        reversion.unregister(TestFileModel)
+        self.field.storage = self.original_storage
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestFileModel.objects.all().delete()
+        shutil.rmtree(self.media_root)
+
+
+class ReversionSpoolTest(TestCase):
+    
+    """Tests the write-behind spool of revisions."""
+    
+    def setUp(self):
+        """Sets up the TestModel and a temporary spool."""
+        # Clear the database.
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestModel.objects.all().delete()
+        # Register the model.
+        reversion.register(TestModel)
+        # Configure a temporary spool.
+        self.spool_root = tempfile.mkdtemp()
+        self.spool_path = os.path.join(self.spool_root, "spool.db")
+        self.spool = RevisionSpool(self.spool_path)
+        reversion.revision.spool = self.spool
+    
+    def testCanSpoolRevisions(self):
+        """Tests that spooled revisions are written when flushed."""
+        with reversion.revision:
+            test = TestModel.objects.create(name="test1.0")
+            reversion.revision.comment = "spooled"
+        self.assertEqual(Revision.objects.count(), 0)
+        self.assertEqual(self.spool.pending_count(), 1)
+        self.spool.flush()
+        self.assertEqual(self.spool.pending_count(), 0)
+        version = Version.objects.get_for_object(test).get()
+        self.assertEqual(version.field_dict["name"], "test1.0")
+        self.assertEqual(version.revision.comment, "spooled")
+        
+    def testCanRecoverSpool(self):
+        """Tests that revisions left in the spool by a crash are written once."""
+        with reversion.revision:
+            TestModel.objects.create(name="test1.0")
+        with reversion.revision:
+            TestModel.objects.create(name="test2.0")
+        # Write the revisions, and crash before removing them from the spool.
+        self.spool.batch_size = 1
+        spool._write_revisions(self.spool._take_batch())
+        self.spool.close()
+        # Reopen the spool, and write the remaining revisions.
+        self.spool = RevisionSpool(self.spool_path)
+        self.assertEqual(self.spool.pending_count(), 2)
+        self.spool.flush()
+        self.assertEqual(Revision.objects.count(), 2)
+        self.assertEqual(Version.objects.count(), 2)
+
+    def testCanWriteIdenticalRevisions(self):
+        """Tests that distinct spooled revisions with the same date, user and comment are all written."""
+        date_created = spool._pack_date(datetime.datetime.now())
+        entries = [(entry_id, spool.STATE_WRITING, {"key": key, "date_created": date_created,
+                                                     "user": None, "comment": "same", "versions": []})
+                   for entry_id, key in ((1, "a"), (2, "b"))]
+        spool._write_revisions(entries)
+        spool._write_revisions(entries)
+        self.assertEqual(Revision.objects.filter(comment="same").count(), 2)
+        
+    def tearDown(self):
+        """Tears down the tests."""
+        # Unregister the model.
+        reversion.unregister(TestModel)
+        # Clear the database.
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestModel.objects.all().delete()
+        # Remove the spool.
+        reversion.revision.spool = None
+        self.spool.close()
+        shutil.rmtree(self.spool_root)
+        # Clear references.
+        del self.spool
+
+
+class RecordingRequest(object):
+    
+    """A request that records whether its user has been looked up."""
+    
+    def __init__(self, user):
+        """Initializes the RecordingRequest."""
+        self._user = user
+        self.user_accessed = False
+        
+    @property
+    def user(self):
+        """Returns the user of the request."""
+        self.user_accessed = True
+        return self._user
+
+
+class ReversionMiddlewareTest(TestCase):
+    
+    """Tests the revision middleware."""
+    
+    def setUp(self):
+        """Sets up the TestModel and a user."""
+        # Clear the database.
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestModel.objects.all().delete()
+        # Register the model.
+        reversion.register(TestModel)
+        self.user = User.objects.create(username="middleware")
+        self.middleware = LazyRevisionMiddleware()
+    
+    def testLazyMiddlewareSkipsReadRequests(self):
+        """Tests that requests that save nothing do not start a revision."""
+        request = RecordingRequest(self.user)
+        self.middleware.process_request(request)
+        self.assertFalse(reversion.revision.is_active())
+        self.middleware.process_response(request, None)
+        self.assertFalse(request.user_accessed)
+        self.assertEqual(Revision.objects.count(), 0)
+        # Saves after the request are not versioned.
+        TestModel.objects.create(name="test1.0")
+        self.assertFalse(reversion.revision.is_active())
+    
+    def testLazyMiddlewareCreatesRevision(self):
+        """Tests that saving a registered model starts the revision."""
+        request = RecordingRequest(self.user)
+        self.middleware.process_request(request)
+        test = TestModel.objects.create(name="test1.0")
+        self.assertTrue(reversion.revision.is_active())
+        self.assertFalse(request.user_accessed)
+        self.middleware.process_response(request, None)
+        self.assertFalse(reversion.revision.is_active())
+        version = Version.objects.get_for_object(test).get()
+        self.assertEqual(version.revision.user, self.user)
+        
+    def tearDown(self):
+        """Tears down the tests."""
+        # Unregister the model.
+        reversion.unregister(TestModel)
+        # Clear the database.
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestModel.objects.all().delete()
+        User.objects.all().delete()
+
+
+class ReversionQueryBudgetTest(TestCase):
+    
+    """
+    Tests that the public reversion operations run a fixed number of queries.
+    
+    Each operation is run against several sizes of existing data, and must
+    run the same number of queries at every size, within its budget.
+    """
+    
+    urls = "reversion.tests"
+    
+    sizes = (1, 5, 10)
+    
+    def setUp(self):
+        """Sets up the models, the admin site and a superuser."""
+        # Clear the database.
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestModel.objects.all().delete()
+        TestRelatedModel.objects.all().delete()
+        # Register the models.
+        reversion.register(TestModel, follow=("testrelatedmodel_set",))
+        reversion.register(TestRelatedModel, follow=("relation",))
+        budget_site.register(TestModel, VersionAdmin)
+        clear_url_caches()
+        # Log in as a superuser.
+        User.objects.create_superuser("budget", "budget@example.com", "budget")
+        self.client.login(username="budget", password="budget")
+        # Count the queries made by views.
+        request_started.disconnect(reset_queries)
+    
+    def clearData(self):
+        """Removes the versioned data created for the previous size."""
+        Version.objects.all().delete()
+        Revision.objects.all().delete()
+        TestRelatedModel.objects.all().delete()
+        TestModel.objects.all().delete()
+    
+    def createHistory(self, size):
+        """Creates a test model with the given number of revisions."""
+        with reversion.revision:
+            test = TestModel.objects.create(name="test0")
+            TestRelatedModel.objects.create(name="related0", relation=test)
+        for n in xrange(1, size):
+            with reversion.revision:
+                test.name = "test%s" % n
+                test.save()
+        return test
+    
+    def countQueries(self, func):
+        """Returns the number of queries run by the given function."""
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            func()
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+        return len(connection.queries) - start
+    
+    def assertQueryBudget(self, budget, prepare, operation):
+        """
+        Checks that the operation runs the same number of queries for every
+        size of data created by `prepare`, and that this is within budget.
+        
+        `prepare` is called with each size, and its return value is passed to
+        `operation`.
+        """
+        counts = []
+        for size in self.sizes:
+            self.clearData()
+            data = prepare(size)
+            counts.append(self.countQueries(lambda: operation(data)))
+        self.assertEqual(len(set(counts)), 1, "Query count grows with data size: %s" % ", ".join(
+            ["%s queries for size %s" % (count, size) for size, count in zip(self.sizes, counts)]))
+        self.assertTrue(counts[0] <= budget, "%s queries exceeds the budget of %s." % (counts[0], budget))
+    
+    def testSaveBudget(self):
+        """Tests the queries run by saving a model in a revision."""
+        def save(test):
+            with reversion.revision:
+                test.save()
+        self.assertQueryBudget(11, self.createHistory, save)
+    
+    def testDeleteBudget(self):
+        """Tests the queries run by deleting a model in a revision."""
+        def delete(test):
+            with reversion.revision:
+                test.delete()
+        self.assertQueryBudget(14, self.createHistory, delete)
+    
+    def testRevertBudget(self):
+        """Tests the queries run by reverting a revision."""
+        def prepare(size):
+            return Version.objects.get_for_object(self.createHistory(size))[0].revision
+        self.assertQueryBudget(5, prepare, lambda revision: revision.revert())
+    
+    def testRecoverBudget(self):
+        """Tests the queries run by recovering a deleted model."""
+        def prepare(size):
+            test = self.createHistory(size)
+            test_pk = test.pk
+            with reversion.revision:
+                test.delete()
+            return test_pk
+        def recover(test_pk):
+            Version.objects.get_deleted_object(TestModel, test_pk).revision.revert()
+        self.assertQueryBudget(6, prepare, recover)
+    
+    def testBulkDeleteBudget(self):
+        """Tests the queries run by a cascading queryset deletion."""
+        def prepare(size):
+            with reversion.revision:
+                for n in xrange(size):
+                    test = TestModel.objects.create(name="test%s" % n)
+                    TestRelatedModel.objects.create(name="related%s" % n, relation=test)
+        def delete(data):
+            with reversion.revision:
+                VersionedQuerySet(TestModel).delete()
+        self.assertQueryBudget(15, prepare, delete)
+    
+    def testHistoryViewBudget(self):
+        """Tests the queries run by the admin history view."""
+        def history(test):
+            response = self.client.get("/admin/reversion/testmodel/%s/history/" % test.pk)
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(5, self.createHistory, history)
+    
+    def testRecoverListBudget(self):
+        """Tests the queries run by the admin recover list."""
+        def prepare(size):
+            with reversion.revision:
+                tests = [TestModel.objects.create(name="test%s" % n) for n in xrange(size)]
+            for test in tests:
+                with reversion.revision:
+                    test.delete()
+        def recover_list(data):
+            response = self.client.get("/admin/reversion/testmodel/recover/")
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget(6, prepare, recover_list)
+    
+    def testDiffBudget(self):
+        """Tests the queries run by diffing a version with its predecessor."""
+        def prepare(size):
+            return Version.objects.get_for_object(self.createHistory(size)).reverse()[0]
+        self.assertQueryBudget(2, prepare, Version.objects.diff_ver)
+    
+    def tearDown(self):
+        """Tears down the tests."""
+        request_started.connect(reset_queries)
+        # Unregister the models.
+        budget_site.unregister(TestModel)
+        reversion.unregister(TestModel)
+        reversion.unregister(TestRelatedModel)
+        # Clear the database.
+        self.clearData()
+        User.objects.all().delete()
+
+
+class ReversionQueryPlanTest(TestCase):
+
+    """Tests that the history lookups are planned against their indexes."""
+
+    def getQueryPlan(self, queryset):
+        """Returns the details of the SQLite query plan for the given queryset."""
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return u"\n".join([unicode(row[-1]) for row in cursor.fetchall()])
+
+    def testObjectLookupUsesIndex(self):
+        """Tests that the versions of an object are read from the composite index."""
+        if connection.vendor != "sqlite":
+            return
+        plan = self.getQueryPlan(Version.objects.get_for_object_reference(TestModel, "1"))
+        self.assertTrue("reversion_version_object" in plan, plan)
+        self.assertFalse("TEMP B-TREE" in plan, plan)
+        plan = self.getQueryPlan(Version.objects.get_for_object_reference(TestModel, 1).order_by("-pk"))
+        self.assertTrue("reversion_version_object" in plan, plan)
+        self.assertFalse("TEMP B-TREE" in plan, plan)
+        plan = self.getQueryPlan(Version.objects.get_for_object_reference(TestKeyedModel, "key"))
+        self.assertTrue("reversion_version_object_key" in plan, plan)
+        self.assertFalse("TEMP B-TREE" in plan, plan)
+
+    def testDateLookupUsesIndex(self):
+        """Tests that revisions are filtered by date using an index."""
+        if connection.vendor != "sqlite":
+            return
+        plan = self.getQueryPlan(Revision.objects.filter(date_created__lt=datetime.datetime.now()))
+        self.assertTrue("USING INDEX" in plan, plan)
+
+
+# An admin site used to check the query budgets of the admin views.
+
+budget_site = admin.AdminSite()
+
+
+class BudgetSiteUrls(object):
+    
+    """
+    Looks up the urls of the budget admin site when they are resolved, since
+    models are only registered with it by the tests.
+    """
+    
+    @property
+    def urlpatterns(self):
+        """Returns the urls of the budget admin site."""
+        return budget_site.get_urls()
+
+
+urlpatterns = patterns("",
+    url(r"^admin/", include((BudgetSiteUrls(), budget_site.app_name, budget_site.name))),
+)
+
+
 # Test the patch helpers, if available.
 
 try:
@@ -0,0 +1,26 @@
+"""
+Settings for running the reversion benchmarks.
+
+Usage: ./manage.py benchmark --settings=benchmark_settings --output=bench.json
+"""
+
+
+from settings import *
+
+
+DEBUG = False
+
+TEMPLATE_DEBUG = False
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+# The benchmarks create their tables with syncdb, instead of running migrations.
+INSTALLED_APPS = tuple([app for app in INSTALLED_APPS if app != 'south'])
+
+MIDDLEWARE_CLASSES = tuple([middleware for middleware in MIDDLEWARE_CLASSES
+                            if middleware != 'django.middleware.csrf.CsrfViewMiddleware'])
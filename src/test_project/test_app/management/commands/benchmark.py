@@ -0,0 +1,420 @@
+"""
+Benchmarks for the reversion hot paths.
+
+Run against the in-memory SQLite database of the benchmark settings:
+
+    ./manage.py benchmark --settings=benchmark_settings --output=bench.json
+
+The results are written as JSON, so that runs can be compared across commits.
+"""
+
+
+from __future__ import with_statement
+
+import datetime
+import multiprocessing
+import platform
+import subprocess
+import sys
+import time
+import traceback
+from optparse import make_option
+from StringIO import StringIO
+
+import django
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.auth.models import User, Group
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.signals import request_started
+from django.db import connection, models, reset_queries
+from django.db.models.signals import post_save, pre_delete, pre_save, post_init
+from django.test.client import Client, RequestFactory
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+
+import reversion
+from reversion.middleware import RevisionMiddleware, LazyRevisionMiddleware
+from reversion.models import Revision, Version
+from reversion.stream import iter_versions
+
+from test_project.test_app.models import ParentModel, ChildModel, RelatedModel
+
+
+class Timer(object):
+
+    """Times a block of code, and counts the queries it runs."""
+
+    def __enter__(self):
+        """Starts the timer."""
+        self.query_start = len(connection.queries)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stops the timer."""
+        self.seconds = time.time() - self.start
+        self.queries = len(connection.queries) - self.query_start
+        return False
+
+    def result(self, count, **extra):
+        """Returns the benchmark result for the given number of operations."""
+        result = {"count": count,
+                  "seconds": self.seconds,
+                  "per_second": self.seconds and count / self.seconds or None,
+                  "queries": self.queries}
+        result.update(extra)
+        return result
+
+
+def create_children(count, related_count=0, name="child"):
+    """Creates child models, with the given number of related models each."""
+    children = []
+    for n in xrange(count):
+        child = ChildModel.objects.create(parent_name=u"%s parent %s" % (name, n),
+                                          child_name=u"%s %s" % (name, n))
+        for m in xrange(related_count):
+            RelatedModel.objects.create(child_model=child,
+                                        related_name=u"%s related %s" % (name, m))
+        children.append(child)
+    return children
+
+
+def bench_save_outside_revision(rows):
+    """Saves of a registered model with no active revision."""
+    children = create_children(1)
+    with Timer() as timer:
+        for n in xrange(rows):
+            children[0].save()
+    return timer.result(rows)
+
+
+def bench_save_inside_revision(rows):
+    """Saves of a registered model, each in its own revision."""
+    children = create_children(1)
+    with Timer() as timer:
+        for n in xrange(rows):
+            with reversion.revision:
+                children[0].save()
+    return timer.result(rows)
+
+
+def bench_save_in_single_revision(rows):
+    """Saves of many registered models in a single revision."""
+    children = create_children(rows)
+    with Timer() as timer:
+        with reversion.revision:
+            for child in children:
+                child.save()
+    return timer.result(rows)
+
+
+def bench_end_by_revision_size(rows):
+    """The cost of ending a revision, by the number of followed objects."""
+    results = SortedDict()
+    for size in (1, 10, 100):
+        child = create_children(1, related_count=size - 1, name="size %s" % size)[0]
+        reversion.revision.start()
+        child.save()
+        with Timer() as timer:
+            reversion.revision.end()
+        results[str(size)] = timer.result(1, versions=Version.objects.filter(revision=Revision.objects.latest("pk")).count())
+    return results
+
+
+def bench_end_by_follow_depth(rows):
+    """The cost of ending a revision, by the depth of followed relationships."""
+    results = SortedDict()
+    child = create_children(1, related_count=1, name="depth")[0]
+    parent = ParentModel.objects.get(pk=child.pk)
+    related = child.relatedmodel_set.all()[0]
+    # Follow the child model from its related models.
+    reversion.unregister(RelatedModel)
+    reversion.register(RelatedModel, follow=("child_model",))
+    try:
+        for depth, obj in enumerate((parent, child, related)):
+            with Timer() as timer:
+                for n in xrange(rows):
+                    with reversion.revision:
+                        obj.save()
+            results[str(depth)] = timer.result(rows, versions=Version.objects.filter(revision=Revision.objects.latest("pk")).count())
+    finally:
+        reversion.unregister(RelatedModel)
+        reversion.register(RelatedModel)
+    return results
+
+
+def bench_delete(rows):
+    """Deletions of registered models, each in its own revision."""
+    children = create_children(rows, related_count=1, name="delete")
+    with Timer() as timer:
+        for child in children:
+            with reversion.revision:
+                child.delete()
+    return timer.result(rows)
+
+
+def bench_get_deleted(rows):
+    """Listing the deleted versions of a model."""
+    with reversion.revision:
+        children = create_children(rows, name="deleted")
+    with reversion.revision:
+        for child in children:
+            child.delete()
+    with Timer() as timer:
+        deleted = Version.objects.get_deleted(ChildModel)
+    return timer.result(len(deleted))
+
+
+def bench_diff_long_history(rows):
+    """Diffing every version of an object with a long history."""
+    child = create_children(1, name="diff")[0]
+    for n in xrange(rows):
+        with reversion.revision:
+            child.child_name = u"diff %s" % n
+            child.save()
+    versions = list(Version.objects.get_for_object_reference(ChildModel, child.pk))
+    with Timer() as timer:
+        for version in versions:
+            Version.objects.diff_ver(version)
+    return timer.result(len(versions))
+
+
+def bench_iter_versions(rows):
+    """Streaming the field dictionaries of many versions, against reading them one model at a time."""
+    with reversion.revision:
+        create_children(rows, name="stream")
+    versions = Version.objects.filter(content_type=ContentType.objects.get_for_model(ChildModel))
+    with Timer() as model_timer:
+        for version in versions.iterator():
+            version.field_dict
+    with Timer() as timer:
+        count = 0
+        for record in iter_versions(versions, chunk_size=100):
+            count += 1
+    return timer.result(count, model_seconds=model_timer.seconds, model_queries=model_timer.queries)
+
+
+def bench_iter_versions_parallel(rows):
+    """Streaming many versions with deserialization spread over one worker process per core."""
+    with reversion.revision:
+        create_children(rows, name="parallel")
+    versions = Version.objects.filter(content_type=ContentType.objects.get_for_model(ChildModel))
+    processes = max(multiprocessing.cpu_count(), 2)
+    with Timer() as serial_timer:
+        for record in iter_versions(versions, chunk_size=100, processes=0):
+            pass
+    with Timer() as timer:
+        count = 0
+        for record in iter_versions(versions, chunk_size=100, processes=processes):
+            count += 1
+    return timer.result(count, processes=processes, serial_seconds=serial_timer.seconds,
+                        speedup=timer.seconds and serial_timer.seconds / timer.seconds or None)
+
+
+def bench_admin_history_view(rows):
+    """Rendering the admin history view of an object with a long history."""
+    child = create_children(1, name="history")[0]
+    for n in xrange(rows):
+        with reversion.revision:
+            child.save()
+    client = Client()
+    client.login(username="benchmark", password="benchmark")
+    with Timer() as timer:
+        response = client.get("/admin/test_app/childmodel/%s/history/" % child.pk)
+    return timer.result(1, status_code=response.status_code)
+
+
+def bench_admin_revision_view(rows):
+    """Rendering the admin revision view of an object with related objects."""
+    child = create_children(1, related_count=rows, name="revision")[0]
+    with reversion.revision:
+        child.save()
+    version = Version.objects.get_for_object_reference(ChildModel, child.pk).latest("pk")
+    client = Client()
+    client.login(username="benchmark", password="benchmark")
+    with Timer() as timer:
+        response = client.get("/admin/test_app/childmodel/%s/history/%s/" % (child.pk, version.pk))
+    return timer.result(1, status_code=response.status_code)
+
+
+def bench_middleware_read_request(rows):
+    """The overhead of the revision middleware on requests that save nothing."""
+    client = Client()
+    client.login(username="benchmark", password="benchmark")
+    session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+    factory = RequestFactory()
+    results = SortedDict()
+    for name, middleware in (("eager", RevisionMiddleware()), ("lazy", LazyRevisionMiddleware())):
+        # Authenticated requests, whose user is loaded from the session on first use.
+        requests = []
+        for n in xrange(rows):
+            request = factory.get("/")
+            request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+            SessionMiddleware().process_request(request)
+            AuthenticationMiddleware().process_request(request)
+            requests.append(request)
+        with Timer() as timer:
+            for request in requests:
+                middleware.process_request(request)
+                middleware.process_response(request, None)
+        results[name] = timer.result(rows)
+    return results
+
+
+def noop_receiver(sender, **kwargs):
+    """A signal receiver that does nothing."""
+
+
+def create_registered_models(count):
+    """Creates and registers the given number of versioned models."""
+    model_classes = []
+    for n in xrange(count):
+        model_class = type("BenchmarkModel%s" % n, (models.Model,), {
+            "__module__": __name__,
+            "Meta": type("Meta", (object,), {"app_label": "test_app"}),
+            "name": models.CharField(max_length=100),
+        })
+        reversion.register(model_class)
+        model_classes.append(model_class)
+    return model_classes
+
+
+def bench_save_unregistered_model(rows):
+    """
+    Saves of an unregistered model while many models are registered, with
+    the shared signal dispatcher and with a receiver per registered model.
+    """
+    model_classes = create_registered_models(150)
+    group = Group.objects.create(name="unregistered")
+    results = SortedDict()
+    try:
+        with Timer() as timer:
+            for n in xrange(rows):
+                group.save()
+        results["dispatcher"] = timer.result(rows)
+        # Connect a receiver to each signal per model, as registration used to,
+        # in place of the dispatcher.
+        signals = (post_save, pre_delete, pre_save, post_init)
+        for signal in signals:
+            signal.disconnect(reversion.revision.signal_dispatcher)
+            for model_class in model_classes:
+                signal.connect(noop_receiver, model_class)
+        try:
+            with Timer() as timer:
+                for n in xrange(rows):
+                    group.save()
+            results["per_model_receivers"] = timer.result(rows)
+        finally:
+            for signal in signals:
+                for model_class in model_classes:
+                    signal.disconnect(noop_receiver, model_class)
+                signal.connect(reversion.revision.signal_dispatcher)
+    finally:
+        for model_class in model_classes:
+            reversion.unregister(model_class)
+    return results
+
+
+def bench_createinitialrevisions(rows):
+    """Running createinitialrevisions against unversioned rows."""
+    create_children(rows, name="initial")
+    # The command prints its progress, which would corrupt the JSON output.
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        with Timer() as timer:
+            call_command("createinitialrevisions", "test_app.ChildModel", verbosity=0)
+    finally:
+        sys.stdout = stdout
+    return timer.result(rows)
+
+
+BENCHMARKS = (
+    ("createinitialrevisions", bench_createinitialrevisions),
+    ("save_outside_revision", bench_save_outside_revision),
+    ("save_inside_revision", bench_save_inside_revision),
+    ("save_in_single_revision", bench_save_in_single_revision),
+    ("end_by_revision_size", bench_end_by_revision_size),
+    ("end_by_follow_depth", bench_end_by_follow_depth),
+    ("delete", bench_delete),
+    ("get_deleted", bench_get_deleted),
+    ("diff_long_history", bench_diff_long_history),
+    ("iter_versions", bench_iter_versions),
+    ("iter_versions_parallel", bench_iter_versions_parallel),
+    ("admin_history_view", bench_admin_history_view),
+    ("admin_revision_view", bench_admin_revision_view),
+    ("middleware_read_request", bench_middleware_read_request),
+    ("save_unregistered_model", bench_save_unregistered_model),
+)
+
+
+def get_commit():
+    """Returns the current git commit, if available."""
+    try:
+        process = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+    except OSError:
+        return None
+    return output.strip() or None
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--rows",
+            action="store",
+            type="int",
+            dest="rows",
+            default=200,
+            help="The number of rows or operations to use in each benchmark. Defaults to 200."),
+        make_option("--output",
+            action="store",
+            dest="output",
+            default=None,
+            help="Write the JSON results to the given file instead of standard output."),
+        make_option("--only",
+            action="append",
+            dest="only",
+            default=[],
+            help="Only run the named benchmark. Can be given several times."),
+        )
+    help = "Runs the reversion benchmarks, and writes the results as JSON."
+
+    def handle(self, *args, **options):
+        rows = options["rows"]
+        # Register the versioned models.
+        admin.autodiscover()
+        call_command("syncdb", interactive=False, verbosity=0)
+        User.objects.create_superuser("benchmark", "benchmark@example.com", "benchmark")
+        # Log queries so that they can be counted, including those made by views.
+        connection.use_debug_cursor = True
+        request_started.disconnect(reset_queries)
+        results = SortedDict()
+        for name, benchmark in BENCHMARKS:
+            if options["only"] and name not in options["only"]:
+                continue
+            try:
+                results[name] = benchmark(rows)
+            except Exception:
+                results[name] = {"error": traceback.format_exc()}
+            # Keep the query log small.
+            del connection.queries[:]
+        report = {"commit": get_commit(),
+                  "date": datetime.datetime.now().isoformat(),
+                  "python": platform.python_version(),
+                  "django": django.get_version(),
+                  "rows": rows,
+                  "results": results}
+        output = simplejson.dumps(report, indent=2)
+        if options["output"]:
+            output_file = open(options["output"], "wb")
+            try:
+                output_file.write(output)
+            finally:
+                output_file.close()
+        else:
+            sys.stdout.write(output + "\n")